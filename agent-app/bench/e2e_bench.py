@@ -0,0 +1,399 @@
+"""
+main_agent.lambda_handler をローカルのフェイクに対して実行するエンドツーエンドのベンチマーク
+
+Salesforce と Tavily は HTTP のフェイクサーバー、sf_api / web_search の呼び出しは
+JSON で受け渡すフェイクの lambda クライアント、モデルは決まった回答を返す
+フェイクの Agent に置き換える（いずれも fakes.py）。各フェイクの応答時間の分布と
+エラー率は 'median[:p99[:error_rate]]'（ミリ秒）で指定する。
+
+スループットと、パイプライン全体（ハンドラーの呼び出し元で計測）および
+各関数が EMF で出力する段階ごとの p50 / p95 / p99 を表示する。
+--save-baseline で結果を保存し、--compare で保存済みの結果と比較して
+p50 / p95 が許容範囲を超えて悪化した項目があれば終了コード 1 で終わる。
+
+使い方:
+    python bench/e2e_bench.py --requests 200 --concurrency 4
+    python bench/e2e_bench.py --sf-query 40:200:0.01 --model-ttft 300:1200
+    python bench/e2e_bench.py --save-baseline bench/baseline.json
+    python bench/e2e_bench.py --compare bench/baseline.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+sys.path[:0] = [SRC_DIR, os.path.join(SRC_DIR, 'main_agent')]
+
+from fakes import (  # noqa: E402
+    LatencyProfile, FakeSalesforceServer, FakeTavilyServer, FakeLambdaClient, FakeLambdaContext, FakeModelAgent,
+    make_cases
+)
+
+QUESTIONS = (
+    'どうすればこの問題を解決できますか？',
+    '回避策はありますか？',
+    '同じ事象の過去の対応を教えてください。',
+)
+
+# 比較で悪化とみなさない差の下限（ミリ秒、短い段階のばらつきを無視する）
+DEFAULT_MIN_DELTA_MS = 2.0
+
+
+class MetricsCollector:
+    """
+    各ハンドラーが出力する EMF の行を集める出力先（metrics.set_stream で登録）
+    """
+
+    def __init__(self):
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        for line in text.splitlines():
+            if line.strip():
+                entry = json.loads(line)
+                with self._lock:
+                    self.entries.append(entry)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def clear(self):
+        with self._lock:
+            self.entries = []
+
+    def stage_samples(self):
+        """
+        '関数.メトリクス名' ごとの時間（ミリ秒）の値のリスト
+        """
+        with self._lock:
+            entries = list(self.entries)
+        samples = {}
+        for entry in entries:
+            for definition in entry['_aws']['CloudWatchMetrics']:
+                for metric in definition['Metrics']:
+                    if metric['Unit'] != 'Milliseconds':
+                        continue
+                    values = entry[metric['Name']]
+                    key = f"{entry['Service']}.{metric['Name']}"
+                    samples.setdefault(key, []).extend(values if isinstance(values, list) else [values])
+        return samples
+
+    def counters(self):
+        """
+        '関数.メトリクス名' ごとの件数（リトライ・キャッシュ・エラーなど）の合計
+        """
+        with self._lock:
+            entries = list(self.entries)
+        totals = {}
+        for entry in entries:
+            for definition in entry['_aws']['CloudWatchMetrics']:
+                for metric in definition['Metrics']:
+                    if metric['Unit'] == 'Count':
+                        key = f"{entry['Service']}.{metric['Name']}"
+                        totals[key] = totals.get(key, 0) + entry[metric['Name']]
+        return dict(sorted(totals.items()))
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'p50': round(percentile(ordered, 50), 2),
+        'p95': round(percentile(ordered, 95), 2),
+        'p99': round(percentile(ordered, 99), 2),
+        'max': round(ordered[-1], 2)
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--cases', type=int, default=50, help='フェイクの Salesforce に置くケース数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--sf-oauth', default='80:300', help='トークン取得の応答時間・エラー率')
+    parser.add_argument('--sf-query', default='40:150', help='SOQL（/query）の応答時間・エラー率')
+    parser.add_argument('--sf-search', default='60:250', help='SOSL（/search）の応答時間・エラー率')
+    parser.add_argument('--sf-composite', default='70:250', help='Composite API の応答時間・エラー率')
+    parser.add_argument('--tavily', default='400:1500', help='Tavily の検索の応答時間・エラー率')
+    parser.add_argument('--invoke', default='15:60', help='Lambda 呼び出し1回の追加の待ち時間・スロットリング率')
+    parser.add_argument('--model-ttft', default='300:1000', help='モデルの最初のトークンまでの時間・エラー率')
+    parser.add_argument('--model-tps', type=float, default=400.0, help='モデルの出力速度（トークン/秒）')
+    parser.add_argument('--model-tokens', type=int, default=120, help='モデルの出力トークン数')
+    parser.add_argument('--tool-calls', type=int, default=1,
+                        help='回答ごとに Agent が呼び出す Web 検索ツールの回数')
+    parser.add_argument('--no-model', action='store_true', help='Agent を使わずシンプル版の回答を生成する')
+    parser.add_argument('--warm-caches', action='store_true',
+                        help='ケース分析・検索結果のキャッシュを有効にする（既定では無効にして毎回取得する）')
+    parser.add_argument('--timeout', type=float, default=60, help='main_agent の Lambda タイムアウト（秒）')
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='比較で許容する悪化の割合')
+    parser.add_argument('--min-delta-ms', type=float, default=DEFAULT_MIN_DELTA_MS)
+    parser.add_argument('--check', action='store_true', help='失敗したリクエストがあれば終了コード 1 で終わる')
+    return parser.parse_args()
+
+
+def configure_environment(args, salesforce, tavily):
+    """
+    フェイクを向く設定（呼び出し元で指定済みの環境変数は上書きしない）
+    """
+    defaults = {
+        'SALESFORCE_INSTANCE_URL': salesforce.url,
+        'SALESFORCE_CLIENT_ID': 'bench-client',
+        'SALESFORCE_CLIENT_SECRET': 'bench-secret',
+        'SALESFORCE_TOKEN_STORE': 'memory',
+        'SIMILAR_CASE_INDEX_ENABLED': 'false',
+        'TAVILY_API_KEY': 'bench-key',
+        'TAVILY_API_URL': tavily.url,
+        'SEARCH_CACHE_DISK_ENABLED': 'false',
+        'METRICS_ENABLED': 'true',
+        'LOG_LEVEL': 'WARNING',
+        'SF_API_FUNCTION_NAME': 'sf_api',
+        'WEB_SEARCH_FUNCTION_NAME': 'web_search'
+    }
+    if not args.warm_caches:
+        defaults.update({'CASE_ANALYSIS_CACHE_TTL_SECONDS': '0', 'SEARCH_CACHE_TTL_SECONDS': '0'})
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+
+
+def install_handlers(args, invoke_profile, model_profile=None):
+    """
+    sf_api / web_search をフェイクの lambda クライアント経由で呼び出す main_agent のハンドラーを返す
+    """
+    from common import metrics
+    from agents import integration_manager
+    from agents import strands_tools
+    from agents.invoke_client import InvokeClient, set_invoke_client
+    from agents.inprocess_transport import SERVICES, load_handler
+
+    handlers = {}
+    for service in ('sf_api', 'web_search'):
+        dir_env, default_dir, _ = SERVICES[service]
+        handlers[service] = load_handler(service, os.environ.get(dir_env, default_dir))
+    lambda_client = FakeLambdaClient(handlers, invoke_profile)
+    set_invoke_client(InvokeClient(lambda_client=lambda_client))
+
+    import lambda_function as main_agent
+    if model_profile is None:
+        main_agent.reset_integration_manager()
+    else:
+        tools = [strands_tools.search_external_knowledge] * args.tool_calls
+
+        class BenchIntegrationManager(integration_manager.IntegrationManager):
+            def _initialize_support_agent(self, token_sink=None):
+                return FakeModelAgent(
+                    model_profile, tokens_per_second=args.model_tps, output_tokens=args.model_tokens,
+                    callback_handler=self._make_callback_handler(token_sink or {}), tools=tools
+                )
+
+        # Strands がインストールされていない環境でも Agent の経路を通す
+        integration_manager.STRANDS_AVAILABLE = True
+        main_agent.reset_integration_manager(BenchIntegrationManager())
+
+    collector = MetricsCollector()
+    metrics.set_stream(collector)
+    return main_agent.lambda_handler, lambda_client, collector
+
+
+def make_events(count, case_ids, seed):
+    events = []
+    for i in range(count):
+        body = {
+            'case_id': case_ids[(i * 7 + seed) % len(case_ids)],
+            'question': QUESTIONS[i % len(QUESTIONS)]
+        }
+        events.append({
+            'headers': {'Content-Type': 'application/json'},
+            'requestContext': {'requestId': f'bench-{i}'},
+            'body': json.dumps(body, ensure_ascii=False)
+        })
+    return events
+
+
+def run(handler, events, concurrency, timeout):
+    """
+    イベントを concurrency 件ずつ並列に実行し、(経過秒, 結果のリスト) を返す
+    """
+    def call(event):
+        started = time.perf_counter()
+        try:
+            response = handler(event, FakeLambdaContext(timeout))
+            body = json.loads(response.get('body') or '{}')
+            status = response.get('statusCode')
+        except Exception as e:
+            body, status = {'error': str(e)}, None
+        return {
+            'latency_ms': (time.perf_counter() - started) * 1000,
+            'status': status,
+            'response_source': body.get('response_source'),
+            'partial': bool(body.get('partial'))
+        }
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        results = list(executor.map(call, events))
+    return time.perf_counter() - started, results
+
+
+def build_report(args, profiles, elapsed, results, collector):
+    ok = [r for r in results if r['status'] == 200]
+    sources = {}
+    for r in ok:
+        sources[r['response_source']] = sources.get(r['response_source'], 0) + 1
+    stages = {key: summarize(values) for key, values in sorted(collector.stage_samples().items())}
+    return {
+        'config': {
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'model': not args.no_model,
+            'tool_calls': args.tool_calls,
+            'warm_caches': args.warm_caches,
+            'profiles': {name: profile.to_dict() for name, profile in profiles.items()}
+        },
+        'environment': {'python': platform.python_version(), 'machine': platform.machine()},
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        'succeeded': len(ok),
+        'failed': len(results) - len(ok),
+        'partial': sum(1 for r in ok if r['partial']),
+        'response_sources': sources,
+        'counters': collector.counters(),
+        'pipeline': summarize([r['latency_ms'] for r in ok]) if ok else None,
+        'stages': stages
+    }
+
+
+def print_report(report, fake_requests):
+    print(f"requests: {report['succeeded']} ok, {report['failed']} failed, {report['partial']} partial  "
+          f"throughput: {report['throughput_rps']} req/s  sources: {report['response_sources']}")
+    print(f"fake calls: {fake_requests}")
+    print(f"counters: {report['counters']}")
+    print()
+    print(f"{'stage':<44} {'count':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    rows = [('pipeline', report['pipeline'])] if report['pipeline'] else []
+    rows += list(report['stages'].items())
+    for name, stats in rows:
+        print(f"{name:<44} {stats['count']:>6} " + ' '.join(f"{stats[key]:>9.2f}" for key in ('p50', 'p95', 'p99', 'max')))
+
+
+def compare(report, baseline, tolerance, min_delta_ms):
+    """
+    保存済みの結果と比較し、悪化した項目の説明のリストを返す
+    """
+    if baseline.get('config') != report.get('config'):
+        print('warning: baseline was recorded with a different configuration')
+
+    current = dict(report['stages'], pipeline=report['pipeline'])
+    previous = dict(baseline.get('stages', {}), pipeline=baseline.get('pipeline'))
+    regressions = []
+    print()
+    print(f"{'stage':<44} {'p50 base':>9} {'p50 now':>9} {'p95 base':>9} {'p95 now':>9}")
+    for name in ['pipeline'] + sorted(key for key in current if key != 'pipeline'):
+        before, after = previous.get(name), current.get(name)
+        if not before or not after:
+            continue
+        flags = []
+        for key in ('p50', 'p95'):
+            limit = max(before[key] * (1 + tolerance), before[key] + min_delta_ms)
+            if after[key] > limit:
+                flags.append(f'{key} {before[key]:.2f} -> {after[key]:.2f}ms')
+        print(f"{name:<44} {before['p50']:>9.2f} {after['p50']:>9.2f} {before['p95']:>9.2f} {after['p95']:>9.2f}"
+              + ('  REGRESSION' if flags else ''))
+        regressions.extend(f'{name}: {flag}' for flag in flags)
+
+    before_rps = baseline.get('throughput_rps') or 0
+    if before_rps and report['throughput_rps'] < before_rps * (1 - tolerance):
+        regressions.append(f"throughput: {before_rps} -> {report['throughput_rps']} req/s")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    seed = args.seed
+    profiles = {
+        'sf_oauth': LatencyProfile.parse(args.sf_oauth, seed=seed),
+        'sf_query': LatencyProfile.parse(args.sf_query, seed=seed + 1),
+        'sf_search': LatencyProfile.parse(args.sf_search, seed=seed + 2),
+        'sf_composite': LatencyProfile.parse(args.sf_composite, seed=seed + 3),
+        'tavily': LatencyProfile.parse(args.tavily, seed=seed + 4),
+        'invoke': LatencyProfile.parse(args.invoke, seed=seed + 5)
+    }
+    if not args.no_model:
+        profiles['model_ttft'] = LatencyProfile.parse(args.model_ttft, seed=seed + 6)
+
+    cases, histories = make_cases(args.cases)
+    salesforce = FakeSalesforceServer(cases, histories, profiles={
+        'oauth': profiles['sf_oauth'],
+        'query': profiles['sf_query'],
+        'search': profiles['sf_search'],
+        'composite': profiles['sf_composite']
+    })
+    tavily = FakeTavilyServer(profiles['tavily'])
+
+    with salesforce, tavily:
+        configure_environment(args, salesforce, tavily)
+        handler, lambda_client, collector = install_handlers(args, profiles['invoke'], profiles.get('model_ttft'))
+        # ハンドラーのログは標準エラーに出し、結果の表示と分ける
+        logging.getLogger().setLevel(os.environ['LOG_LEVEL'])
+        for log_handler in logging.getLogger().handlers:
+            log_handler.setStream(sys.stderr)
+
+        case_ids = [case['Id'] for case in cases]
+        if args.warmup:
+            run(handler, make_events(args.warmup, case_ids, seed + 100), args.concurrency, args.timeout)
+            collector.clear()
+
+        elapsed, results = run(handler, make_events(args.requests, case_ids, seed), args.concurrency, args.timeout)
+        report = build_report(args, profiles, elapsed, results, collector)
+        fake_requests = {
+            'salesforce': dict(salesforce.requests),
+            'tavily': dict(tavily.requests),
+            'lambda': dict(lambda_client.calls)
+        }
+
+    print_report(report, fake_requests)
+
+    exit_code = 0
+    if args.check and report['failed']:
+        print(f"\n{report['failed']} requests failed")
+        exit_code = 1
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"\n{len(regressions)} regressions (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            exit_code = 1
+        else:
+            print('\nno regressions')
+
+    if args.save_baseline:
+        directory = os.path.dirname(os.path.abspath(args.save_baseline))
+        os.makedirs(directory, exist_ok=True)
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nbaseline saved to {args.save_baseline}")
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,472 @@
+"""
+ベンチマーク用のローカルのフェイク（Salesforce・Tavily・モデル・Lambda 呼び出し）
+
+Salesforce と Tavily は 127.0.0.1 で待ち受ける HTTP サーバーとして動かし、
+SalesforceClient / TavilyClient は実際の HTTP セッション（接続プール・リトライ）を
+通して呼び出す。いずれのフェイクも LatencyProfile で応答時間の分布と
+エラー率を指定でき、乱数のシードを固定すれば同じ系列を再現できる。
+"""
+import io
+import re
+import json
+import math
+import time
+import uuid
+import zlib
+import random
+import threading
+import contextvars
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from botocore.exceptions import ClientError
+
+# 正規分布の 99 パーセンタイル点
+_Z99 = 2.3263
+
+SUBJECTS = (
+    'ログイン時にセッションタイムアウトが発生する',
+    'レポートのエクスポートが途中で失敗する',
+    'メール送信がバウンスして顧客に届かない',
+    'ダッシュボードの表示が遅い',
+    'API 連携でトークンの更新に失敗する',
+    '承認プロセスが途中で止まる',
+    'モバイルアプリで添付ファイルを開けない',
+    'シングルサインオン後に権限が反映されない',
+)
+
+
+class LatencyProfile:
+    """
+    応答時間（対数正規分布、中央値と p99 で指定）とエラー率
+
+    p99_ms が median_ms 以下の場合は常に median_ms を返す。
+    """
+
+    def __init__(self, median_ms=0.0, p99_ms=None, error_rate=0.0, seed=None):
+        self.median_ms = float(median_ms)
+        self.p99_ms = float(p99_ms if p99_ms is not None else median_ms)
+        self.error_rate = float(error_rate)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def parse(cls, spec, seed=None):
+        """
+        'median[:p99[:error_rate]]' 形式（例: '40:200:0.01'）から生成
+        """
+        parts = [float(part) for part in str(spec).split(':') if part != '']
+        return cls(
+            median_ms=parts[0] if parts else 0.0,
+            p99_ms=parts[1] if len(parts) > 1 else None,
+            error_rate=parts[2] if len(parts) > 2 else 0.0,
+            seed=seed
+        )
+
+    def sample_ms(self):
+        if self.median_ms <= 0:
+            return 0.0
+        if self.p99_ms <= self.median_ms:
+            return self.median_ms
+        sigma = math.log(self.p99_ms / self.median_ms) / _Z99
+        with self._lock:
+            return self.median_ms * math.exp(self._random.gauss(0, sigma))
+
+    def fails(self):
+        if self.error_rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def wait(self):
+        delay = self.sample_ms()
+        if delay:
+            time.sleep(delay / 1000)
+        return delay
+
+    def to_dict(self):
+        return {'median_ms': self.median_ms, 'p99_ms': self.p99_ms, 'error_rate': self.error_rate}
+
+
+def make_cases(count=50, history_per_case=5):
+    """
+    ベンチマーク用のケースと履歴（件名は SUBJECTS を順に使う）
+    """
+    cases = []
+    histories = {}
+    for i in range(count):
+        case_id = f'500BENCH{i:07d}'
+        subject = SUBJECTS[i % len(SUBJECTS)]
+        cases.append({
+            'attributes': {'type': 'Case'},
+            'Id': case_id,
+            'CaseNumber': f'{i + 1:08d}',
+            'Subject': subject,
+            'Description': f'{subject}。発生手順と環境の詳細を記載します。' * 4,
+            'Status': ('New', 'Working', 'Closed')[i % 3],
+            'Priority': ('High', 'Medium', 'Low')[i % 3],
+            'Account': {'Name': f'取引先 {i % 7}'},
+            'Contact': {'Name': f'担当者 {i % 11}'},
+            'Owner': {'Name': 'サポート担当'},
+            'CreatedDate': '2024-01-01T00:00:00.000+0000',
+            'LastModifiedDate': f'2024-02-{i % 28 + 1:02d}T00:00:00.000+0000',
+            'IsDeleted': False
+        })
+        histories[case_id] = [
+            {
+                'attributes': {'type': 'CaseHistory'},
+                'Id': f'017BENCH{i:04d}{j:03d}',
+                'Field': 'Status',
+                'OldValue': 'New',
+                'NewValue': 'Working',
+                'CreatedDate': f'2024-02-01T0{j}:00:00.000+0000',
+                'CreatedBy': {'Name': 'サポート担当'}
+            }
+            for j in range(history_per_case)
+        ]
+    return cases, histories
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _FakeServer:
+    """
+    バックグラウンドスレッドで動く HTTP サーバー（with 文で起動・停止）
+    """
+
+    handler_class = _QuietHandler
+
+    def __init__(self):
+        handler = type('Handler', (self.handler_class,), {'fake': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True)
+        self.requests = {}
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, kind):
+        with self._lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _SalesforceHandler(_QuietHandler):
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        body = self._read_body()
+        if path == '/services/oauth2/token':
+            status, result = self.fake.handle('oauth', lambda: self.fake.token())
+        elif path.endswith('/composite'):
+            status, result = self.fake.handle('composite', lambda: self.fake.composite(json.loads(body)))
+        elif path.endswith('/composite/batch'):
+            status, result = self.fake.handle('composite', lambda: self.fake.batch(json.loads(body)))
+        else:
+            status, result = 404, [{'errorCode': 'NOT_FOUND', 'message': path}]
+        self._send_json(status, result)
+
+    def do_GET(self):
+        kind = 'search' if urlsplit(self.path).path.endswith('/search') else 'query'
+        status, result = self.fake.handle(kind, lambda: self.fake.get(self.path))
+        self._send_json(status, result)
+
+
+class FakeSalesforceServer(_FakeServer):
+    """
+    Salesforce REST API（OAuth トークン・SOQL・SOSL・Composite）のフェイク
+
+    profiles は 'oauth' / 'query' / 'search' / 'composite' ごとの LatencyProfile。
+    エラーは 503（SERVER_UNAVAILABLE）で返す（GET は HTTP セッションがリトライする）。
+    """
+
+    handler_class = _SalesforceHandler
+
+    def __init__(self, cases=None, histories=None, profiles=None):
+        super().__init__()
+        if cases is None:
+            cases, histories = make_cases()
+        self.cases = {case['Id']: case for case in cases}
+        self.histories = histories or {}
+        self.profiles = profiles or {}
+
+    def handle(self, kind, fn):
+        self.count(kind)
+        profile = self.profiles.get(kind)
+        if profile is not None:
+            profile.wait()
+            if profile.fails():
+                return 503, [{'errorCode': 'SERVER_UNAVAILABLE', 'message': 'Injected failure'}]
+        try:
+            return 200, fn()
+        except LookupError as e:
+            return 400, [{'errorCode': 'MALFORMED_QUERY', 'message': str(e)}]
+
+    def token(self):
+        return {'access_token': uuid.uuid4().hex, 'instance_url': self.url, 'token_type': 'Bearer'}
+
+    def get(self, url):
+        """
+        /query・/queryAll・/search の応答（url はバージョンを含むパス）
+        """
+        parts = urlsplit(url)
+        query = parse_qs(parts.query).get('q', [''])[0]
+        if parts.path.endswith('/search'):
+            return self.search(query)
+        return self.query(query)
+
+    def query(self, soql):
+        if 'FROM CaseHistory' in soql:
+            match = re.search(r"CaseId = '([^']*)'", soql)
+            if not match:
+                raise LookupError(f'Unsupported query: {soql}')
+            records = self.histories.get(match.group(1), [])
+        else:
+            match = re.search(r"WHERE Id = '([^']*)'", soql)
+            if match:
+                records = [self.cases[match.group(1)]] if match.group(1) in self.cases else []
+            else:
+                records = list(self.cases.values())
+        return {'totalSize': len(records), 'done': True, 'records': records}
+
+    def search(self, sosl):
+        match = re.search(r'FIND \{(.*?)\}', sosl)
+        term = (match.group(1) if match else '').replace("\\'", "'")
+        records = [
+            dict(case, attributes={'type': 'Case'})
+            for case in self.cases.values()
+            if term and (term in case['Subject'] or case['Subject'] in term)
+        ][:15]
+        return {'searchRecords': records}
+
+    def composite(self, payload):
+        """
+        /composite（@{ref.records[0].Id} 形式の参照を前段の結果で解決する）
+        """
+        results = {}
+        responses = []
+        for sub in payload.get('compositeRequest', []):
+            url = unquote(sub['url'])
+
+            def resolve(match):
+                body = results.get(match.group(1)) or {}
+                records = body.get('records') or []
+                if not records:
+                    raise LookupError(f'Unresolved reference: {match.group(0)}')
+                return records[0]['Id']
+
+            try:
+                body = self.get(re.sub(r'@\{(\w+)\.records\[0\]\.Id\}', resolve, url))
+                status = 200
+            except LookupError as e:
+                body, status = [{'errorCode': 'PROCESSING_HALTED', 'message': str(e)}], 400
+            results[sub['referenceId']] = body
+            responses.append({'referenceId': sub['referenceId'], 'httpStatusCode': status, 'body': body})
+        return {'compositeResponse': responses}
+
+    def batch(self, payload):
+        return {
+            'hasErrors': False,
+            'results': [
+                {'statusCode': 200, 'result': self.get('/' + sub['url'])}
+                for sub in payload.get('batchRequests', [])
+            ]
+        }
+
+
+class _TavilyHandler(_QuietHandler):
+
+    def do_POST(self):
+        payload = json.loads(self._read_body() or b'{}')
+        self.fake.count('search')
+        started = time.perf_counter()
+        profile = self.fake.profile
+        profile.wait()
+        if profile.fails():
+            self._send_json(503, {'detail': {'error': 'Injected failure'}})
+            return
+        self._send_json(200, self.fake.results(payload, time.perf_counter() - started))
+
+
+class FakeTavilyServer(_FakeServer):
+    """
+    Tavily の /search のフェイク（クエリから決まる固定の結果を返す）
+    """
+
+    handler_class = _TavilyHandler
+
+    def __init__(self, profile=None, content_chars=600):
+        super().__init__()
+        self.profile = profile or LatencyProfile()
+        self.content_chars = content_chars
+
+    def results(self, payload, elapsed):
+        query = payload.get('query', '')
+        max_results = int(payload.get('max_results', 5))
+        return {
+            'query': query,
+            'answer': '',
+            'images': [],
+            'results': [
+                {
+                    'title': f'{query[:30]} - 解説 {i + 1}',
+                    'url': f"https://example.com/kb/{zlib.crc32(f'{query}-{i}'.encode('utf-8')) % 100000}",
+                    'content': ('既知の問題と回避策について説明します。' * 40)[:self.content_chars],
+                    'score': round(0.95 - i * 0.05, 2)
+                }
+                for i in range(max_results)
+            ],
+            'response_time': round(elapsed, 3)
+        }
+
+
+class FakeLambdaContext:
+    """
+    Lambda の context（リクエスト ID と残り時間）
+    """
+
+    def __init__(self, timeout_seconds=60, request_id=None):
+        self.aws_request_id = request_id or str(uuid.uuid4())
+        self.deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.monotonic()) * 1000))
+
+
+class FakeLambdaClient:
+    """
+    boto3 の lambda クライアントの代わりにハンドラーを呼び出す
+
+    Lambda と同様にペイロードを JSON で受け渡し、呼び出しごとに profile の待ち時間を
+    加える。profile のエラーはスロットリング（429）として返す。ハンドラーは空の
+    コンテキストで実行し、呼び出し元とは contextvars を共有しない（別の実行環境と同様）。
+    """
+
+    def __init__(self, handlers, profile=None, timeout_seconds=60):
+        self.handlers = handlers
+        self.profile = profile or LatencyProfile()
+        self.timeout_seconds = timeout_seconds
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType='RequestResponse', Payload=b'{}'):
+        with self._lock:
+            self.calls[FunctionName] = self.calls.get(FunctionName, 0) + 1
+        self.profile.wait()
+        if self.profile.fails():
+            raise ClientError(
+                {
+                    'Error': {'Code': 'TooManyRequestsException', 'Message': 'Rate exceeded'},
+                    'ResponseMetadata': {'HTTPStatusCode': 429}
+                },
+                'Invoke'
+            )
+
+        handler = self.handlers[FunctionName]
+        context = FakeLambdaContext(self.timeout_seconds)
+        result = contextvars.Context().run(handler, json.loads(Payload), context)
+        return {
+            'StatusCode': 200,
+            'Payload': io.BytesIO(json.dumps(result, ensure_ascii=False, default=str).encode('utf-8'))
+        }
+
+
+class _Usage:
+    def __init__(self, usage):
+        self.accumulated_usage = usage
+
+
+class FakeAgentResult:
+    """
+    Strands Agent の実行結果（str() で回答、metrics.accumulated_usage で使用量）
+    """
+
+    def __init__(self, text, usage):
+        self.text = text
+        self.metrics = _Usage(usage)
+
+    def __str__(self):
+        return self.text
+
+
+class FakeModelAgent:
+    """
+    決まった回答を返す Strands Agent の代わり
+
+    プロンプトから決まる output_tokens 個のトークンを、最初のトークンまで
+    profile の待ち時間、以降は tokens_per_second の速さで callback_handler に送る。
+    tools に渡した関数は最初のトークンの前に順に呼び出す（ツール呼び出しの再現）。
+    profile のエラーは例外として送出する。
+    """
+
+    def __init__(self, profile=None, tokens_per_second=400.0, output_tokens=120, callback_handler=None,
+                 tools=None, chunk_tokens=8):
+        self.profile = profile or LatencyProfile()
+        self.tokens_per_second = float(tokens_per_second)
+        self.output_tokens = int(output_tokens)
+        self.callback_handler = callback_handler
+        self.tools = list(tools or [])
+        self.chunk_tokens = chunk_tokens
+        self.messages = []
+
+    def __call__(self, prompt):
+        self.messages.append({'role': 'user', 'content': prompt})
+        question = prompt.rsplit('## 顧客からの現在の質問:', 1)[-1].strip()
+        for tool in self.tools:
+            tool(question)
+
+        self.profile.wait()
+        if self.profile.fails():
+            raise RuntimeError('Injected model failure')
+
+        seed = sum(prompt.encode('utf-8')) % 997
+        tokens = [f'回答{(seed + i) % 97}' for i in range(self.output_tokens)]
+        interval = self.chunk_tokens / self.tokens_per_second if self.tokens_per_second > 0 else 0
+        for start in range(0, len(tokens), self.chunk_tokens):
+            if interval:
+                time.sleep(interval)
+            if self.callback_handler is not None:
+                self.callback_handler(data=''.join(tokens[start:start + self.chunk_tokens]))
+
+        text = ''.join(tokens)
+        self.messages.append({'role': 'assistant', 'content': text})
+        return FakeAgentResult(text, {
+            'inputTokens': len(prompt) // 2,
+            'outputTokens': self.output_tokens,
+            'cacheReadInputTokens': 0,
+            'cacheWriteInputTokens': 0
+        })
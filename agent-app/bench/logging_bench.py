@@ -0,0 +1,220 @@
+"""
+ハンドラーごとのリクエストあたりのログ出力コストを測るベンチマーク
+
+main_agent / sf_api / web_search の lambda_handler を外部通信なしで実行し、
+ログを無効にした場合・LOG_LEVEL=INFO・DEBUG の処理時間を比較する。
+Salesforce と Tavily はフェイクに差し替え、main_agent からの呼び出しは
+InProcessTransport で同一プロセス内のハンドラーに渡す。ログの出力先は
+書き込みを捨てるストリーム（整形のコストは含む）。
+
+あわせて、DEBUG 無効時のイベント全体のログを、f-string で即時に
+シリアライズする場合と lazy_json() で遅延させる場合で比較する。
+
+使い方:
+    python bench/logging_bench.py --iterations 300
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+sys.path[:0] = [SRC_DIR, os.path.join(SRC_DIR, 'main_agent')]
+
+from common.log import configure_logging, lazy_json, verbose  # noqa: E402
+from agents.inprocess_transport import InProcessTransport, SERVICES, load_handler  # noqa: E402
+from agents.invoke_client import set_invoke_client  # noqa: E402
+
+CASE = {
+    'Id': '5001000000BENCH',
+    'CaseNumber': '00001234',
+    'Subject': 'ログイン時にセッションタイムアウトが発生する',
+    'Description': 'シングルサインオン経由でログインすると数分でセッションが切れる。' * 5,
+    'Priority': 'High',
+    'Status': 'New',
+    'LastModifiedDate': '2024-01-01T00:00:00.000+0000',
+    'Account': {'Name': 'Example'},
+    'Contact': {'Name': 'Taro'}
+}
+
+
+class NullStream:
+    """
+    書き込みを捨てるストリーム
+    """
+
+    def write(self, text):
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+class FakeSalesforceClient:
+    """
+    固定のケースデータを返す SalesforceClient
+    """
+
+    def get_case(self, case_id):
+        return dict(CASE, Id=case_id)
+
+    def get_case_last_modified(self, case_id):
+        return CASE['LastModifiedDate']
+
+    def find_similar_cases(self, subject, description=''):
+        return [dict(CASE, Id=f'500{i}', similarity=0.5) for i in range(5)]
+
+    def get_case_history(self, case_id):
+        return [{'Field': 'Status', 'OldValue': 'New', 'NewValue': 'Working'}] * 5
+
+    def get_case_bundle(self, case_id, include_case=True, include_history=True, include_similar_cases=True,
+                        subject=None, description=None):
+        return {
+            'case_data': self.get_case(case_id) if include_case else None,
+            'case_history': self.get_case_history(case_id) if include_history else [],
+            'similar_cases': self.find_similar_cases(subject or '') if include_similar_cases else [],
+            'errors': {}
+        }
+
+
+class FakeTavilyClient:
+    """
+    固定の検索結果を返す TavilyClient
+    """
+
+    def search(self, query, max_results=5, **options):
+        return {
+            'results': [
+                {'title': f'結果 {i}', 'url': f'https://example.com/{i}', 'content': 'x' * 400, 'score': 0.9}
+                for i in range(max_results)
+            ],
+            'answer': '',
+            'images': [],
+            'query': query,
+            'response_time': 0.1
+        }
+
+
+class FakeContext:
+    aws_request_id = 'bench-request'
+
+    def get_remaining_time_in_millis(self):
+        return 60000
+
+
+def load_handlers():
+    """
+    フェイクのクライアントを使う3つのハンドラーを読み込む
+    """
+    handlers = {}
+    for service in ('sf_api', 'web_search'):
+        dir_env, default_dir, _ = SERVICES[service]
+        handlers[service] = load_handler(service, os.environ.get(dir_env, default_dir))
+
+    handlers['sf_api'].__globals__['SalesforceClient'] = FakeSalesforceClient
+    handlers['web_search'].__globals__['_tavily_client'] = FakeTavilyClient()
+    set_invoke_client(InProcessTransport(handlers=dict(handlers)))
+
+    # 各ハンドラーは読み込み時に configure_logging() を呼ぶため、計測用の設定はこの後に行う
+    import lambda_function as main_agent
+    main_agent.reset_integration_manager()
+    handlers['main_agent'] = main_agent.lambda_handler
+    return handlers
+
+
+def events():
+    return {
+        'main_agent': {
+            'headers': {'Content-Type': 'application/json'},
+            'requestContext': {'requestId': 'bench'},
+            'body': json.dumps({
+                'case_id': CASE['Id'],
+                'question': 'どうすればセッションタイムアウトを防げますか？',
+                'bypass_cache': True
+            }, ensure_ascii=False)
+        },
+        'sf_api': {'action': 'analyze_case_bundle', 'case_id': CASE['Id']},
+        'web_search': {'query': 'Salesforce セッションタイムアウト 既知問題', 'max_results': 5, 'bypass_cache': True}
+    }
+
+
+def set_log_level(level):
+    """
+    level=None はログを完全に無効化する
+    """
+    logging.disable(logging.NOTSET if level is not None else logging.CRITICAL)
+    logging.getLogger().setLevel(level or logging.INFO)
+
+
+def measure(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1e6)
+    return samples
+
+
+def measure_levels(fn, levels, iterations, warmup, rounds=10):
+    """
+    ログレベルを切り替えながら交互に計測し、レベルごとの中央値（マイクロ秒）を返す
+
+    キャッシュの状態や CPU の周波数の変化が特定のレベルに偏らないよう、
+    計測を rounds 回に分けて順番に実行する。
+    """
+    samples = {label: [] for label, _ in levels}
+    per_round = max(1, iterations // rounds)
+    for _ in range(rounds):
+        for label, level in levels:
+            set_log_level(level)
+            samples[label].extend(measure(fn, per_round, warmup))
+    return {label: statistics.median(values) for label, values in samples.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.setdefault('CASE_ANALYSIS_CACHE_TTL_SECONDS', '0')
+    # ハンドラーが標準出力に書く EMF の行が計測結果に混ざらないようにする
+    os.environ.setdefault('METRICS_ENABLED', 'false')
+    handlers = load_handlers()
+    configure_logging()
+    for handler in logging.getLogger().handlers:
+        handler.setStream(NullStream())
+
+    context = FakeContext()
+    levels = (('off', None), ('INFO', logging.INFO), ('DEBUG', logging.DEBUG))
+    print(f"{'handler':<11} {'off':>10} {'INFO':>10} {'DEBUG':>10} {'INFO-off':>10}  (median us/request, n={args.iterations})")
+    for name, event in events().items():
+        handler = handlers[name]
+        results = measure_levels(lambda: handler(event, context), levels, args.iterations, args.warmup)
+        print(
+            f"{name:<11} {results['off']:>10.1f} {results['INFO']:>10.1f} {results['DEBUG']:>10.1f} "
+            f"{results['INFO'] - results['off']:>10.1f}"
+        )
+
+    # DEBUG 無効時のイベント全体のログ: 即時シリアライズと遅延評価の比較
+    set_log_level(logging.INFO)
+    logger = logging.getLogger('bench')
+    event = events()['main_agent']
+    eager = statistics.median(measure(
+        lambda: logger.debug(f"Full event: {json.dumps(event, default=str)}"), args.iterations * 10, 100
+    ))
+    deferred = statistics.median(measure(
+        lambda: verbose(logger, "Full event: %s", lazy_json(event)), args.iterations * 10, 100
+    ))
+    print()
+    print(f"debug off, full event log: eager f-string {eager:.2f}us, lazy {deferred:.2f}us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,573 @@
+"""
+記録したトラフィック（common.recorder）を lambda_handler で再生する性能の回帰確認
+
+RECORD_TRAFFIC=true で記録したファイル（またはそのディレクトリ）を読み、指定した
+関数（--service）のリクエストを記録時の間隔（--speed で倍率、0 で待たずに投入）で
+ハンドラーに渡す。下流の呼び出しは記録したレスポンスを記録時の所要時間
+（--latency-scale で倍率）だけ待って返す。
+
+    main_agent  : sf_api / web_search の呼び出しとモデルの回答
+    sf_api      : Salesforce への HTTP
+    web_search  : Tavily への HTTP
+
+記録した呼び出しは種類とアクション（HTTP はメソッドとパス）ごとに、同じリクエストを
+優先し、なければ記録順に割り当てる。同じリクエストの記録に見つからない呼び出し
+（記録時はキャッシュにヒットしたなど）は、他のリクエストで記録したレスポンスを使う。
+モデルの所要時間は、回答中の Web 検索ツールの呼び出しを含む。
+
+パイプライン全体と各関数が EMF で出力する段階ごとの p50 / p95 / p99 に加え、
+待ち時間なしで1件ずつ再生したときのリクエストごとのメモリ確保のピークと、
+再生後も残ったメモリの多い箇所（tracemalloc）を表示する。--save で結果を保存し、
+--compare で保存済みの結果（別のバージョンのコードで再生したもの）と比較して、
+許容範囲を超えて悪化した項目があれば終了コード 1 で終わる。
+
+使い方:
+    python bench/replay.py /tmp/traffic
+    python bench/replay.py traffic/ --service sf_api --speed 2 --concurrency 16
+    python bench/replay.py traffic/ --speed 0 --save bench/replay-baseline.json
+    python bench/replay.py traffic/ --compare bench/replay-baseline.json --tolerance 0.2
+"""
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import platform
+import threading
+import tracemalloc
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+sys.path[:0] = [SRC_DIR, os.path.join(SRC_DIR, 'main_agent')]
+
+import requests  # noqa: E402
+from requests.adapters import HTTPAdapter  # noqa: E402
+from requests.structures import CaseInsensitiveDict  # noqa: E402
+
+from common import recorder, metrics  # noqa: E402
+from agents.invoke_client import FunctionError, InvokeError  # noqa: E402
+from e2e_bench import MetricsCollector, summarize, print_report, compare, DEFAULT_MIN_DELTA_MS  # noqa: E402
+from fakes import FakeAgentResult, FakeLambdaContext  # noqa: E402
+
+SERVICES = ('main_agent', 'sf_api', 'web_search')
+
+# 比較で悪化とみなさないメモリの差の下限（KiB）
+DEFAULT_MIN_DELTA_KB = 64.0
+
+# 再生中のリクエストに割り当てる記録済みの呼び出し
+_active = contextvars.ContextVar('replay_calls', default=None)
+
+
+def _key(kind, action):
+    return f'{kind} {action}'
+
+
+class ResponseLibrary:
+    """
+    全リクエストで記録した呼び出し（同じリクエストの記録にない呼び出しの代わりに使う）
+    """
+
+    def __init__(self, records):
+        self._calls = {}
+        for record in records:
+            for call in record.get('calls') or ():
+                self._calls.setdefault(_key(call['kind'], call['action']), []).append(call)
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def borrow(self, kind, action):
+        key = _key(kind, action)
+        with self._lock:
+            calls = self._calls.get(key)
+            if not calls:
+                return None
+            index = self._next.get(key, 0)
+            self._next[key] = index + 1
+            return calls[index % len(calls)]
+
+
+class ReplayCalls:
+    """
+    1リクエスト分の記録済みの呼び出しの割り当てと、割り当て結果の集計
+    """
+
+    def __init__(self, calls, library, latency_scale=1.0):
+        self.library = library
+        self.latency_scale = latency_scale
+        self.matched = 0
+        self.borrowed = 0
+        self.missing = []
+        self._pending = {}
+        for call in calls or ():
+            self._pending.setdefault(_key(call['kind'], call['action']), []).append(call)
+        self._lock = threading.Lock()
+
+    def take(self, kind, action, request=None):
+        """
+        呼び出しに対応する記録を返す（見つからなければ None）
+        """
+        key = _key(kind, action)
+        with self._lock:
+            candidates = self._pending.get(key)
+            if candidates:
+                call = next((c for c in candidates if c.get('request') == request), candidates[0])
+                candidates.remove(call)
+                self.matched += 1
+                return call
+
+        call = self.library.borrow(kind, action)
+        with self._lock:
+            if call is None:
+                self.missing.append(key)
+            else:
+                self.borrowed += 1
+        return call
+
+    def wait(self, call):
+        if self.latency_scale > 0:
+            time.sleep(call['duration_ms'] * self.latency_scale / 1000)
+
+    def unused(self):
+        with self._lock:
+            return sum(len(calls) for calls in self._pending.values())
+
+
+class ReplayTransport:
+    """
+    sf_api / web_search の呼び出しに記録したレスポンスを返す InvokeClient 互換のトランスポート
+    """
+
+    def invoke(self, function_name, payload, action=None):
+        action = action or payload.get('action') or function_name
+        calls = _active.get()
+        call = calls.take(recorder.KIND_INVOKE, action, recorder.mask_pii(payload)) if calls else None
+        if call is None:
+            raise InvokeError(f'No recorded response for {action}', function_name, action)
+
+        started = time.perf_counter()
+        calls.wait(call)
+        metrics.record(f'invoke_{action}', round((time.perf_counter() - started) * 1000, 1))
+        if call.get('error'):
+            raise FunctionError(call['error'], function_name, action)
+        # Lambda と同様に JSON をデコードした新しいオブジェクトを返す
+        return json.loads(json.dumps(call['response'], ensure_ascii=False))
+
+    def invoke_async(self, function_name, payload):
+        pass
+
+    def stats(self):
+        return {'transport': 'replay'}
+
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    Salesforce / Tavily のセッションに取り付け、記録した HTTP レスポンスを返すアダプター
+    """
+
+    def send(self, request, **kwargs):
+        action, described = recorder.describe_http_request(request)
+        calls = _active.get()
+        call = calls.take(recorder.KIND_HTTP, action, described) if calls else None
+        if call is None:
+            if action.endswith('/oauth2/token'):
+                # 記録時はトークンがキャッシュ済みだった場合
+                call = {'status': 200, 'response': {'access_token': 'replay', 'instance_url': ''}, 'duration_ms': 0}
+            else:
+                raise requests.exceptions.ConnectionError(f'No recorded response for {action}', request=request)
+        else:
+            calls.wait(call)
+
+        body = call.get('response')
+        response = requests.Response()
+        response.status_code = call.get('status') or 200
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response._content = b'' if body is None else (
+            body.encode('utf-8') if isinstance(body, str) else json.dumps(body, ensure_ascii=False).encode('utf-8')
+        )
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.reason = 'Replayed'
+        return response
+
+
+class ReplayAgent:
+    """
+    記録したモデルの回答を、記録時の所要時間をかけてストリーミングで返す Strands Agent の代わり
+    """
+
+    def __init__(self, callback_handler=None, chunk_chars=16):
+        self.callback_handler = callback_handler
+        self.chunk_chars = chunk_chars
+        self.messages = []
+
+    def __call__(self, prompt):
+        calls = _active.get()
+        call = calls.take(recorder.KIND_MODEL, 'agent') if calls else None
+        if call is None:
+            raise RuntimeError('No recorded model response')
+        if call.get('error'):
+            calls.wait(call)
+            raise RuntimeError(call['error'])
+
+        response = call.get('response') or {}
+        text = response.get('text') or ''
+        chunks = [text[i:i + self.chunk_chars] for i in range(0, len(text), self.chunk_chars)] or ['']
+        interval = call['duration_ms'] * calls.latency_scale / 1000 / len(chunks)
+        for chunk in chunks:
+            if interval:
+                time.sleep(interval)
+            if self.callback_handler is not None:
+                self.callback_handler(data=chunk)
+        return FakeAgentResult(text, response.get('usage') or {})
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help='記録したファイルまたはディレクトリ')
+    parser.add_argument('--service', choices=SERVICES, default='main_agent')
+    parser.add_argument('--limit', type=int, default=0, help='再生するリクエスト数の上限（0 で全件）')
+    parser.add_argument('--warmup', type=int, default=5, help='計測前に待ち時間なしで再生する件数')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='記録時の間隔に対する投入の速さの倍率（0 で間隔を空けずに投入）')
+    parser.add_argument('--concurrency', type=int, default=16, help='同時に処理するリクエスト数の上限')
+    parser.add_argument('--latency-scale', type=float, default=1.0,
+                        help='下流の呼び出しで待つ時間の記録時に対する倍率（0 で待たない）')
+    parser.add_argument('--timeout', type=float, default=60, help='Lambda タイムアウト（秒）')
+    parser.add_argument('--no-allocations', action='store_true', help='メモリ確保の計測を行わない')
+    parser.add_argument('--top', type=int, default=10, help='表示する残ったメモリの多い箇所の数')
+    parser.add_argument('--save', metavar='PATH')
+    parser.add_argument('--compare', metavar='PATH')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='比較で許容する悪化の割合')
+    parser.add_argument('--min-delta-ms', type=float, default=DEFAULT_MIN_DELTA_MS)
+    parser.add_argument('--min-delta-kb', type=float, default=DEFAULT_MIN_DELTA_KB)
+    parser.add_argument('--check', action='store_true',
+                        help='失敗・ステータスの不一致・割り当てられない呼び出しがあれば終了コード 1 で終わる')
+    return parser.parse_args()
+
+
+def load_records(paths, service, limit=0):
+    """
+    記録したファイルから service のリクエストを記録時刻の順に読み込む
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, '**', '*' + recorder.FILE_SUFFIX), recursive=True)))
+        else:
+            files.append(path)
+
+    records = [
+        record
+        for path in files
+        for record in recorder.iter_records(path)
+        if record.get('service') == service and record.get('v') == recorder.FORMAT_VERSION
+    ]
+    records.sort(key=lambda record: record['ts'])
+    return records[:limit] if limit else records
+
+
+def configure_environment():
+    """
+    再生用の設定（呼び出し元で指定済みの環境変数は上書きしない、記録は常に無効）
+    """
+    defaults = {
+        'SALESFORCE_INSTANCE_URL': 'https://replay.invalid',
+        'SALESFORCE_CLIENT_ID': 'replay-client',
+        'SALESFORCE_CLIENT_SECRET': 'replay-secret',
+        'SALESFORCE_TOKEN_STORE': 'memory',
+        'SIMILAR_CASE_INDEX_ENABLED': 'false',
+        'TAVILY_API_KEY': 'replay-key',
+        'TAVILY_API_URL': 'https://replay.invalid',
+        'SEARCH_CACHE_DISK_ENABLED': 'false',
+        'METRICS_ENABLED': 'true',
+        'LOG_LEVEL': 'WARNING'
+    }
+    for key, value in defaults.items():
+        os.environ.setdefault(key, value)
+    os.environ['RECORD_TRAFFIC'] = 'false'
+
+
+def install_handler(service, records):
+    """
+    下流を記録したレスポンスに差し替えた service のハンドラーを返す
+    """
+    from common import http_session
+
+    if service == 'main_agent':
+        from agents import integration_manager
+        from agents.invoke_client import set_invoke_client
+
+        set_invoke_client(ReplayTransport())
+        import lambda_function as main_agent
+        has_model = any(
+            call['kind'] == recorder.KIND_MODEL for record in records for call in record.get('calls') or ()
+        )
+        if has_model:
+            class ReplayIntegrationManager(integration_manager.IntegrationManager):
+                def _initialize_support_agent(self, token_sink=None):
+                    return ReplayAgent(callback_handler=self._make_callback_handler(token_sink or {}))
+
+            # Strands がインストールされていない環境でも Agent の経路を通す
+            integration_manager.STRANDS_AVAILABLE = True
+            main_agent.reset_integration_manager(ReplayIntegrationManager())
+        else:
+            main_agent.reset_integration_manager()
+        handler = main_agent.lambda_handler
+    else:
+        from agents.inprocess_transport import SERVICES as HANDLER_DIRS, load_handler
+
+        dir_env, default_dir, _ = HANDLER_DIRS[service]
+        handler = load_handler(service, os.environ.get(dir_env, default_dir))
+        targets = {
+            call['target'] for record in records for call in record.get('calls') or ()
+            if call['kind'] == recorder.KIND_HTTP
+        }
+        adapter = ReplayAdapter()
+        for target in targets | {'salesforce', 'tavily'}:
+            session = http_session.get_session(target)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+    collector = MetricsCollector()
+    metrics.set_stream(collector)
+    return handler, collector
+
+
+def replay_one(handler, record, library, latency_scale, timeout):
+    """
+    1リクエストを空のコンテキストで再生する（別の実行環境と同様に contextvars を共有しない）
+    """
+    return contextvars.Context().run(_replay_one, handler, record, library, latency_scale, timeout)
+
+
+def _replay_one(handler, record, library, latency_scale, timeout):
+    calls = ReplayCalls(record.get('calls'), library, latency_scale)
+    _active.set(calls)
+    event = json.loads(json.dumps(record['event'], ensure_ascii=False))
+    started = time.perf_counter()
+    try:
+        response = handler(event, FakeLambdaContext(timeout, record.get('request_id')))
+        error = None
+    except Exception as e:
+        response, error = None, f'{type(e).__name__}: {e}'
+    latency_ms = (time.perf_counter() - started) * 1000
+
+    recorded = record.get('response')
+    status = response.get('statusCode') if isinstance(response, dict) else None
+    recorded_status = recorded.get('statusCode') if isinstance(recorded, dict) else None
+    return {
+        'latency_ms': latency_ms,
+        'recorded_ms': record.get('duration_ms'),
+        'status': status,
+        'error': error,
+        'status_mismatch': error is None and status != recorded_status,
+        'matched': calls.matched,
+        'borrowed': calls.borrowed,
+        'missing': calls.missing,
+        'unused': calls.unused()
+    }
+
+
+def replay(handler, records, library, speed, concurrency, latency_scale, timeout):
+    """
+    記録時の間隔を speed 倍にして投入し、(経過秒, 結果のリスト) を返す
+
+    投入が予定より遅れた時間（処理が追いつかない場合の待ち行列を含む）は lag_ms に入れる。
+    """
+    base_ts = records[0]['ts'] if records else 0
+    started = time.perf_counter()
+
+    def run(record, due):
+        lag_ms = max(0.0, (time.perf_counter() - started - due) * 1000)
+        result = replay_one(handler, record, library, latency_scale, timeout)
+        result['lag_ms'] = lag_ms
+        return result
+
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for record in records:
+            due = (record['ts'] - base_ts) / speed if speed > 0 else 0.0
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(executor.submit(run, record, due))
+        results = [future.result() for future in futures]
+    return time.perf_counter() - started, results
+
+
+def measure_allocations(handler, records, library, timeout, top):
+    """
+    下流を待たずに1件ずつ再生し、リクエストごとのメモリ確保のピークと再生後に残ったメモリを計測
+    """
+    peaks = []
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        for record in records:
+            tracemalloc.reset_peak()
+            baseline, _ = tracemalloc.get_traced_memory()
+            replay_one(handler, record, library, 0, timeout)
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append((peak - baseline) / 1024)
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    source_filter = [tracemalloc.Filter(True, os.path.join(SRC_DIR, '*'))]
+    diffs = after.filter_traces(source_filter).compare_to(before.filter_traces(source_filter), 'lineno')
+    retained = sum(diff.size_diff for diff in diffs) / 1024
+    return {
+        'request_peak_kb': summarize(peaks),
+        'retained_kb': round(retained, 1),
+        'top': [
+            {
+                'site': f'{os.path.relpath(diff.traceback[0].filename, SRC_DIR)}:{diff.traceback[0].lineno}',
+                'size_kb': round(diff.size_diff / 1024, 1),
+                'count': diff.count_diff
+            }
+            for diff in diffs[:top] if diff.size_diff > 0
+        ]
+    }
+
+
+def build_report(args, records, elapsed, results, collector):
+    ok = [r for r in results if r['error'] is None and r['status'] in (None, 200)]
+    missing = {}
+    for r in results:
+        for key in r['missing']:
+            missing[key] = missing.get(key, 0) + 1
+    recorded = [r['recorded_ms'] for r in results if r['recorded_ms'] is not None]
+    return {
+        'config': {
+            'service': args.service,
+            'requests': len(results),
+            'speed': args.speed,
+            'concurrency': args.concurrency,
+            'latency_scale': args.latency_scale
+        },
+        'environment': {'python': platform.python_version(), 'machine': platform.machine()},
+        'recorded_span_seconds': round(records[-1]['ts'] - records[0]['ts'], 1) if records else 0.0,
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        'succeeded': len(ok),
+        'failed': len(results) - len(ok),
+        'partial': 0,
+        'status_mismatches': sum(1 for r in results if r['status_mismatch']),
+        'response_sources': {},
+        'calls': {
+            'matched': sum(r['matched'] for r in results),
+            'borrowed': sum(r['borrowed'] for r in results),
+            'unused': sum(r['unused'] for r in results),
+            'missing': missing
+        },
+        'counters': collector.counters(),
+        'lag': summarize([r['lag_ms'] for r in results]) if results else None,
+        'recorded': summarize(recorded) if recorded else None,
+        'pipeline': summarize([r['latency_ms'] for r in ok]) if ok else None,
+        'stages': {key: summarize(values) for key, values in sorted(collector.stage_samples().items())},
+        'allocations': None
+    }
+
+
+def print_allocations(allocations):
+    peak = allocations['request_peak_kb']
+    print()
+    print(f"allocations per request (KiB): p50 {peak['p50']:.1f}  p95 {peak['p95']:.1f}  max {peak['max']:.1f}  "
+          f"retained after replay: {allocations['retained_kb']:.1f} KiB")
+    for item in allocations['top']:
+        print(f"  {item['size_kb']:>9.1f} KiB {item['count']:>7} blocks  {item['site']}")
+
+
+def compare_allocations(allocations, baseline, tolerance, min_delta_kb):
+    """
+    メモリ確保を保存済みの結果と比較し、悪化した項目の説明のリストを返す
+    """
+    if not allocations or not baseline:
+        return []
+    checks = [
+        (f'request_peak_kb.{key}', baseline['request_peak_kb'][key], allocations['request_peak_kb'][key])
+        for key in ('p50', 'p95')
+    ]
+    checks.append(('retained_kb', baseline['retained_kb'], allocations['retained_kb']))
+
+    regressions = []
+    print()
+    print(f"{'allocations':<44} {'base':>9} {'now':>9}  (KiB)")
+    for name, before, after in checks:
+        regressed = after > max(before * (1 + tolerance), before + min_delta_kb)
+        print(f"{name:<44} {before:>9.1f} {after:>9.1f}" + ('  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(f'{name}: {before:.1f} -> {after:.1f}KiB')
+    return regressions
+
+
+def main():
+    args = parse_args()
+    records = load_records(args.paths, args.service, args.limit)
+    if not records:
+        print(f'no recorded requests for {args.service}')
+        return 1
+
+    configure_environment()
+    handler, collector = install_handler(args.service, records)
+    # ハンドラーのログは標準エラーに出し、結果の表示と分ける
+    logging.getLogger().setLevel(os.environ['LOG_LEVEL'])
+    for log_handler in logging.getLogger().handlers:
+        log_handler.setStream(sys.stderr)
+
+    library = ResponseLibrary(records)
+    if args.warmup:
+        replay(handler, records[:args.warmup], library, 0, args.concurrency, 0, args.timeout)
+        collector.clear()
+
+    elapsed, results = replay(
+        handler, records, library, args.speed, args.concurrency, args.latency_scale, args.timeout
+    )
+    report = build_report(args, records, elapsed, results, collector)
+    if not args.no_allocations:
+        report['allocations'] = measure_allocations(handler, records, library, args.timeout, args.top)
+    allocations = report['allocations']
+    print(f"replayed {len(results)} {args.service} requests recorded over {report['recorded_span_seconds']}s "
+          f"(speed {args.speed}, latency scale {args.latency_scale})")
+    print_report(report, report['calls'])
+    print(f"status mismatches: {report['status_mismatches']}  "
+          f"schedule lag p95: {report['lag']['p95']:.2f}ms  recorded p50/p95: "
+          + (f"{report['recorded']['p50']:.2f} / {report['recorded']['p95']:.2f}ms" if report['recorded'] else '-'))
+    if allocations:
+        print_allocations(allocations)
+
+    exit_code = 0
+    if args.check and (report['failed'] or report['status_mismatches'] or report['calls']['missing']):
+        print(f"\n{report['failed']} failed, {report['status_mismatches']} status mismatches, "
+              f"missing calls: {report['calls']['missing']}")
+        exit_code = 1
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.min_delta_ms)
+        regressions += compare_allocations(allocations, baseline.get('allocations'), args.tolerance, args.min_delta_kb)
+        if regressions:
+            print(f"\n{len(regressions)} regressions (tolerance {args.tolerance:.0%}):")
+            for regression in regressions:
+                print(f"  {regression}")
+            exit_code = 1
+        else:
+            print('\nno regressions')
+
+    if args.save:
+        directory = os.path.dirname(os.path.abspath(args.save))
+        os.makedirs(directory, exist_ok=True)
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nresults saved to {args.save}")
+
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""
+Lambda 経由と in-process トランスポートの呼び出しレイテンシを比較するベンチマーク
+
+既定では外部通信を行わない。web_search ハンドラーの Tavily クライアントを固定応答の
+フェイクに差し替え、Lambda 経由の経路は JSON シリアライズと --invoke-overhead-ms の
+待ち時間を加えたフェイクの lambda クライアントで再現する。
+--live を指定すると実際の Lambda（WEB_SEARCH_FUNCTION_NAME）と Tavily API を呼び出す。
+
+使い方:
+    python bench/transport_bench.py --iterations 200 --invoke-overhead-ms 30
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'src')
+sys.path[:0] = [SRC_DIR, os.path.join(SRC_DIR, 'main_agent')]
+
+from agents.invoke_client import InvokeClient  # noqa: E402
+from agents.inprocess_transport import InProcessTransport, SERVICES, load_handler  # noqa: E402
+
+PAYLOAD = {
+    'query': 'Salesforce ログイン セッションタイムアウト 対処',
+    'max_results': 5,
+    'bypass_cache': True
+}
+
+
+class FakeTavilyClient:
+    """
+    固定の検索結果を返す Tavily クライアント
+    """
+
+    def __init__(self, service_ms=0.0):
+        self.service_ms = service_ms
+
+    def search(self, query, max_results=5, **options):
+        if self.service_ms:
+            time.sleep(self.service_ms / 1000)
+        return {
+            'query': query,
+            'results': [
+                {'title': f'結果 {i}', 'url': f'https://example.com/{i}', 'content': 'x' * 400, 'score': 0.9}
+                for i in range(max_results)
+            ],
+            'response_time': self.service_ms / 1000
+        }
+
+
+class FakeLambdaClient:
+    """
+    ハンドラーを呼び出す lambda クライアント
+
+    Lambda と同様にペイロードを JSON で受け渡し、呼び出しごとに overhead_ms だけ待つ。
+    """
+
+    def __init__(self, handler, overhead_ms):
+        self.handler = handler
+        self.overhead_ms = overhead_ms
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        time.sleep(self.overhead_ms / 1000)
+        result = self.handler(json.loads(Payload), None)
+        return {'Payload': io.BytesIO(json.dumps(result, ensure_ascii=False).encode('utf-8'))}
+
+
+def measure(client, function_name, iterations, warmup):
+    for _ in range(warmup):
+        client.invoke(function_name, PAYLOAD)
+
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        client.invoke(function_name, PAYLOAD)
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    return {
+        'mean': statistics.fmean(ordered),
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--invoke-overhead-ms', type=float, default=30.0,
+                        help='フェイクの Lambda 呼び出し 1 回あたりの待ち時間')
+    parser.add_argument('--service-ms', type=float, default=0.0,
+                        help='フェイクの Tavily 検索 1 回あたりの処理時間')
+    parser.add_argument('--live', action='store_true',
+                        help='実際の Lambda と Tavily API を呼び出す')
+    args = parser.parse_args()
+
+    # ハンドラーの INFO ログが計測結果に混ざらないようにする
+    logging.disable(logging.INFO)
+    os.environ.setdefault('METRICS_ENABLED', 'false')
+
+    dir_env, default_dir, name_env = SERVICES['web_search']
+    handler = load_handler('web_search', os.environ.get(dir_env, default_dir))
+    function_name = os.environ.get(name_env, 'web_search')
+
+    if args.live:
+        lambda_client = InvokeClient()
+    else:
+        # ハンドラーのモジュールが保持する共有クライアントをフェイクに差し替える
+        handler.__globals__['_tavily_client'] = FakeTavilyClient(args.service_ms)
+        lambda_client = InvokeClient(lambda_client=FakeLambdaClient(handler, args.invoke_overhead_ms))
+
+    transports = [
+        ('lambda', lambda_client),
+        ('inprocess', InProcessTransport(handlers={'web_search': handler}))
+    ]
+
+    print(f"{'transport':<10} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}  (ms, n={args.iterations})")
+    for name, client in transports:
+        result = summarize(measure(client, function_name, args.iterations, args.warmup))
+        print(f"{name:<10} " + ' '.join(f"{result[key]:>9.2f}" for key in ('mean', 'p50', 'p95', 'p99')))
+
+
+if __name__ == '__main__':
+    main()
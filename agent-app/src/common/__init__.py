@@ -0,0 +1,3 @@
+"""
+各 Lambda 関数で共有するユーティリティ（パッケージング時に各関数へコピーされる）
+"""
@@ -0,0 +1,183 @@
+"""
+キープアライブ接続を再利用する HTTP セッション管理
+"""
+import os
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .recorder import http_hook
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+
+class PoolConfig:
+    """
+    接続プール・タイムアウト・リトライの設定
+    """
+
+    def __init__(
+        self,
+        pool_connections=4,
+        pool_maxsize=10,
+        connect_timeout=3.05,
+        read_timeout=30,
+        max_retries=2,
+        backoff_factor=0.3,
+        retry_statuses=(429, 500, 502, 503, 504),
+        retry_methods=("GET",),
+    ):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.retry_statuses = tuple(retry_statuses)
+        self.retry_methods = tuple(m.upper() for m in retry_methods)
+
+    @classmethod
+    def from_env(cls, prefix, **defaults):
+        """
+        環境変数 {prefix}_POOL_MAXSIZE などで既定値を上書きした設定を生成
+        """
+        config = cls(**defaults)
+
+        def _env(name, cast):
+            value = os.environ.get(f"{prefix}_{name}")
+            return cast(value) if value not in (None, "") else None
+
+        overrides = {
+            "pool_connections": _env("POOL_CONNECTIONS", int),
+            "pool_maxsize": _env("POOL_MAXSIZE", int),
+            "connect_timeout": _env("CONNECT_TIMEOUT", float),
+            "read_timeout": _env("READ_TIMEOUT", float),
+            "max_retries": _env("MAX_RETRIES", int),
+            "backoff_factor": _env("BACKOFF_FACTOR", float),
+        }
+        for key, value in overrides.items():
+            if value is not None:
+                setattr(config, key, value)
+
+        methods = os.environ.get(f"{prefix}_RETRY_METHODS")
+        if methods:
+            config.retry_methods = tuple(
+                m.strip().upper() for m in methods.split(",") if m.strip()
+            )
+        return config
+
+    @property
+    def timeout(self):
+        return (self.connect_timeout, self.read_timeout)
+
+
+class PooledSession(requests.Session):
+    """
+    既定タイムアウトとリトライ付きアダプタを持つ requests.Session
+    """
+
+    def __init__(self, name, config):
+        super().__init__()
+        self.name = name
+        self.config = config
+
+        retry = Retry(
+            total=config.max_retries,
+            connect=config.max_retries,
+            read=config.max_retries,
+            status=config.max_retries,
+            backoff_factor=config.backoff_factor,
+            status_forcelist=config.retry_statuses,
+            allowed_methods=frozenset(config.retry_methods),
+            # 最終的なレスポンスは呼び出し側の raise_for_status で扱う
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=config.pool_connections,
+            pool_maxsize=config.pool_maxsize,
+            max_retries=retry,
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        # トラフィックの記録中のみ、呼び出しとレスポンスを記録する（common.recorder）
+        self.hooks["response"].append(http_hook(name))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.config.timeout)
+        return super().request(method, url, **kwargs)
+
+    def connection_stats(self):
+        """
+        新規接続数と再利用された接続でのリクエスト数を集計
+        """
+        requests_count = 0
+        new_connections = 0
+
+        adapters = {id(a): a for a in self.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_count += pool.num_requests
+                new_connections += pool.num_connections
+
+        return {
+            "requests": requests_count,
+            "new_connections": new_connections,
+            "reused_connections": max(requests_count - new_connections, 0),
+        }
+
+
+# ウォームコンテナ内で再利用するセッション
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name, config=None):
+    """
+    名前ごとに共有される PooledSession を取得（初回のみ生成）
+    """
+    session = _sessions.get(name)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(name)
+            if session is None:
+                session = PooledSession(name, config or PoolConfig())
+                _sessions[name] = session
+                logger.info(
+                    "Created pooled HTTP session '%s' (pool_maxsize=%s, timeout=%s)",
+                    name, session.config.pool_maxsize, session.config.timeout
+                )
+    return session
+
+
+def retry_count(response):
+    """
+    レスポンスを得るまでにアダプタが行ったリトライの回数
+    """
+    retries = getattr(getattr(response, "raw", None), "retries", None)
+    return len(getattr(retries, "history", None) or ())
+
+
+def get_connection_stats():
+    """
+    全セッションの接続再利用状況を返す
+    """
+    with _sessions_lock:
+        sessions = dict(_sessions)
+    return {name: session.connection_stats() for name, session in sessions.items()}
+
+
+def close_sessions():
+    """
+    全セッションを閉じて破棄（テスト用）
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
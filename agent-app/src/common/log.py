@@ -0,0 +1,180 @@
+"""
+構造化ログ（JSON 出力・遅延評価・リクエスト単位のサンプリング）
+
+各 Lambda のハンドラーは configure_logging() でルートロガーを設定し、リクエストの
+開始時に bind_request() でリクエスト ID を登録する。以降のログには request_id
+（トレース中であれば trace_id も）が自動で付与される。出力されないレベルのログでは引数の整形・シリアライズを行わないよう、
+メッセージは %s 形式で渡し、重い値は lazy() / lazy_json() で包む。
+"""
+import os
+import sys
+import json
+import random
+import logging
+import contextvars
+
+from .tracing import current_trace_id
+
+DEFAULT_TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
+
+# LogRecord の標準属性（これ以外の属性は extra で渡されたフィールドとして出力する）
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'request_id', 'trace_id'}
+
+_request_id = contextvars.ContextVar('log_request_id', default='-')
+_sampled = contextvars.ContextVar('log_sampled', default=False)
+
+
+class lazy:
+    """
+    ログが出力される場合にのみ fn() を評価する値
+
+    logger.debug('event: %s', lazy(lambda: expensive())) のように引数として渡す。
+    """
+
+    __slots__ = ('fn',)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __str__(self):
+        return str(self.fn())
+
+    __repr__ = __str__
+
+
+def lazy_json(value):
+    """
+    ログが出力される場合にのみ JSON にシリアライズする値
+    """
+    return lazy(lambda: json.dumps(value, default=str, ensure_ascii=False))
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    現在のリクエスト ID とトレース ID を LogRecord に付与する
+    """
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        record.trace_id = current_trace_id()
+        return True
+
+
+def _extra_fields(record):
+    """
+    extra で渡されたフィールド（呼び出し可能な値はここで評価する）
+    """
+    return {
+        key: value() if callable(value) else value
+        for key, value in record.__dict__.items()
+        if key not in _RECORD_ATTRIBUTES and not key.startswith('_')
+    }
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    1行1件の JSON でログを出力する
+
+    extra で渡したフィールドはトップレベルのキーとして出力し、呼び出し可能な
+    値は出力時に評価する。
+    """
+
+    def format(self, record):
+        entry = {
+            'timestamp': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', _request_id.get()),
+            'message': record.getMessage()
+        }
+        trace_id = getattr(record, 'trace_id', None)
+        if trace_id:
+            entry['trace_id'] = trace_id
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    従来のテキスト形式（extra のフィールドは key=value で末尾に付ける）
+    """
+
+    def __init__(self):
+        super().__init__(DEFAULT_TEXT_FORMAT)
+
+    def formatMessage(self, record):
+        message = super().formatMessage(record)
+        fields = _extra_fields(record)
+        if fields:
+            message += ' ' + ' '.join(f'{key}={value}' for key, value in fields.items())
+        return message
+
+
+def configure_logging(level=None, log_format=None):
+    """
+    ルートロガーを設定（LOG_LEVEL / LOG_FORMAT=json|text）
+
+    Lambda ランタイムが登録済みのハンドラーがあればその出力形式を置き換える。
+    複数回呼び出しても設定は1回分のみ有効になる。
+    """
+    root = logging.getLogger()
+    root.setLevel((level or os.environ.get('LOG_LEVEL', 'INFO')).upper())
+
+    log_format = (log_format or os.environ.get('LOG_FORMAT', 'json')).lower()
+    formatter = JsonFormatter() if log_format == 'json' else TextFormatter()
+
+    if not root.handlers:
+        root.addHandler(logging.StreamHandler(sys.stdout))
+    for handler in root.handlers:
+        handler.setFormatter(formatter)
+        if not any(isinstance(f, RequestIdFilter) for f in handler.filters):
+            handler.addFilter(RequestIdFilter())
+    return root
+
+
+def bind_request(request_id, sample_rate=None):
+    """
+    現在のリクエスト ID を登録し、詳細ログを出力するリクエストかを抽選する
+
+    Lambda はコンテナごとに1リクエストずつ処理するため、呼び出しごとに上書きする。
+    LOG_SAMPLE_RATE（0〜1）の割合のリクエストでは verbose() のログを INFO で出力する。
+    """
+    if sample_rate is None:
+        sample_rate = float(os.environ.get('LOG_SAMPLE_RATE', '0'))
+    _request_id.set(request_id or '-')
+    _sampled.set(sample_rate > 0 and random.random() < sample_rate)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def is_sampled():
+    return _sampled.get()
+
+
+def verbose(logger, message, *args, **fields):
+    """
+    詳細ログ（DEBUG が有効な場合、またはサンプリング対象のリクエストでのみ出力）
+
+    どちらでもない場合は引数を評価せずに戻る。
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        level = logging.DEBUG
+    elif _sampled.get() and logger.isEnabledFor(logging.INFO):
+        level = logging.INFO
+        fields['sampled'] = True
+    else:
+        return
+    logger.log(level, message, *args, extra=fields)
+
+
+def log_event(logger, level, message, **fields):
+    """
+    フィールド付きのログ（JSON 出力ではトップレベルのキーになる）
+    """
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra=fields)
+
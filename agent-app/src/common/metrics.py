@@ -0,0 +1,219 @@
+"""
+リクエスト単位の処理時間・サイズ・件数の計測と CloudWatch Embedded Metric Format（EMF）出力
+
+各ハンドラーはリクエストの開始時に start_request() を呼び、終了時に flush() で
+計測値を EMF の1行として標準出力に書き出す。CloudWatch Logs が EMF の行から
+メトリクスを作成するため、ログを解析せずに段階ごとの p50 / p99 を集計できる。
+計測中のリクエストは contextvars で保持するため、スレッドプールで実行する処理には
+コンテキストを引き継ぐ（agents.parallel などを参照）。リクエスト外では何もしない。
+"""
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+UNIT_MILLISECONDS = 'Milliseconds'
+UNIT_BYTES = 'Bytes'
+UNIT_COUNT = 'Count'
+
+DEFAULT_NAMESPACE = 'SfSupportAssistant'
+
+# EMF の1メトリクスあたりの値の上限
+MAX_VALUES_PER_METRIC = 100
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+# EMF の出力先（None の場合は標準出力）
+_stream = None
+
+
+class RequestMetrics:
+    """
+    1リクエストの計測値
+
+    同じ名前の値は配列で保持し、EMF ではそのまま値の分布として送る。
+    """
+
+    def __init__(self, service, request_id=None):
+        self.service = service
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self._values = {}
+        self._units = {}
+        self.properties = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, value, unit=UNIT_MILLISECONDS):
+        with self._lock:
+            self._values.setdefault(name, []).append(value)
+            self._units[name] = unit
+
+    def increment(self, name, count=1):
+        with self._lock:
+            values = self._values.setdefault(name, [0])
+            values[0] += count
+            self._units[name] = UNIT_COUNT
+
+    def elapsed_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def timings(self):
+        """
+        レスポンスに含める集計（時間は回数・合計・最大、件数・サイズは合計）
+        """
+        with self._lock:
+            items = [(name, list(values), self._units[name]) for name, values in self._values.items()]
+
+        timings = {}
+        for name, values, unit in items:
+            if unit == UNIT_MILLISECONDS:
+                timings[name] = {
+                    'count': len(values),
+                    'total_ms': round(sum(values), 1),
+                    'max_ms': round(max(values), 1)
+                }
+            else:
+                timings[name] = sum(values)
+        return timings
+
+    def to_emf(self, namespace=None):
+        """
+        EMF 形式の辞書（値が多すぎるメトリクスは先頭から上限件数まで）
+        """
+        with self._lock:
+            items = [(name, list(values), self._units[name]) for name, values in self._values.items()]
+
+        entry = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': namespace or os.environ.get('METRICS_NAMESPACE', DEFAULT_NAMESPACE),
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, _, unit in items]
+                }]
+            },
+            'Service': self.service,
+            'request_id': self.request_id
+        }
+        entry.update(self.properties)
+        for name, values, unit in items:
+            values = [round(v, 3) if isinstance(v, float) else v for v in values[:MAX_VALUES_PER_METRIC]]
+            entry[name] = values[0] if len(values) == 1 else values
+        return entry
+
+
+def metrics_enabled():
+    return os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+
+def set_stream(stream):
+    """
+    EMF の出力先を差し替える（None で標準出力に戻す、ベンチマークでの集計用）
+    """
+    global _stream
+    _stream = stream
+
+
+def start_request(service, request_id=None):
+    """
+    現在のリクエストの計測を開始する（METRICS_ENABLED=false の場合は None）
+
+    Lambda はコンテナごとに1リクエストずつ処理するため、呼び出しごとに置き換える。
+    """
+    metrics = RequestMetrics(service, request_id) if metrics_enabled() else None
+    _current.set(metrics)
+    return metrics
+
+
+def current_metrics():
+    return _current.get()
+
+
+def flush(metrics=None, stream=None):
+    """
+    計測値を EMF の1行として出力し、現在のリクエストの計測を終える
+    """
+    metrics = metrics or _current.get()
+    if metrics is None:
+        return None
+    metrics.record('request', metrics.elapsed_ms())
+    entry = metrics.to_emf()
+    try:
+        (stream or _stream or sys.stdout).write(json.dumps(entry, default=str, ensure_ascii=False) + '\n')
+    except Exception as e:
+        logger.warning("Writing metrics failed: %s", e)
+    if _current.get() is metrics:
+        _current.set(None)
+    return entry
+
+
+def record(name, value, unit=UNIT_MILLISECONDS):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.record(name, value, unit)
+
+
+def increment(name, count=1):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.increment(name, count)
+
+
+def set_property(name, value):
+    """
+    メトリクスにはしない付加情報（action など）を EMF の行に含める
+    """
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.properties[name] = value
+
+
+def record_size(name, payload):
+    """
+    payload（bytes / str / JSON に変換できる値）のサイズを記録する
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    elif not isinstance(payload, (bytes, bytearray)):
+        payload = json.dumps(payload, default=str, ensure_ascii=False).encode('utf-8')
+    metrics.record(name, len(payload), UNIT_BYTES)
+
+
+@contextmanager
+def timer(name):
+    """
+    with ブロックの処理時間（ミリ秒）を name で記録する（例外で抜けた場合も記録）
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.record(name, round((time.perf_counter() - started) * 1000, 1))
+
+
+def timed(name):
+    """
+    関数の処理時間を name で記録するデコレーター
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
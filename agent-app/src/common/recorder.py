@@ -0,0 +1,416 @@
+"""
+性能の回帰確認のためのトラフィックの記録（bench/replay.py で再生する）
+
+RECORD_TRAFFIC=true の場合、record_traffic() を付けたハンドラーは受け取ったイベントと
+返したレスポンスに加え、処理中に行った下流の呼び出し（Lambda 呼び出し・Salesforce /
+Tavily への HTTP・モデル）のリクエストとレスポンス・所要時間を、1リクエスト1行の JSON
+として gzip 圧縮したファイル（RECORD_DIR 配下、関数・コンテナごと）に追記する。
+
+記録する値は個人情報をマスクする。氏名・メールアドレス・電話番号・認証情報などの
+キーの値はソルト付きのハッシュに置き換え、それ以外の文字列に含まれるメールアドレスと
+電話番号も同様に置き換える。同じ値は同じハッシュになるため、同一ケースへの連続した
+問い合わせやキャッシュのヒットといったトラフィックの形は残る。
+
+記録中のリクエストは contextvars で保持するため、スレッドプールで実行する処理には
+コンテキストを引き継ぐ（agents.parallel などを参照）。記録していないときは何もしない。
+"""
+import os
+import re
+import hmac
+import json
+import time
+import uuid
+import gzip
+import random
+import hashlib
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlsplit, parse_qsl
+
+from . import tracing
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+FILE_SUFFIX = '.ndjson.gz'
+
+KIND_INVOKE = 'invoke'
+KIND_HTTP = 'http'
+KIND_MODEL = 'model'
+
+# 値をハッシュに置き換えるキー（大文字・小文字は区別しない、RECORD_MASK_KEYS で追加できる）
+SENSITIVE_KEYS = frozenset(key.lower() for key in (
+    'Name', 'FirstName', 'LastName', 'Email', 'Phone', 'MobilePhone', 'Fax',
+    'SuppliedName', 'SuppliedEmail', 'SuppliedPhone', 'SuppliedCompany',
+    'ContactEmail', 'ContactPhone', 'ContactMobile',
+    'Authorization', 'Cookie', 'X-Api-Key', 'api_key', 'access_token', 'refresh_token',
+    'client_secret', 'client_id', 'password', 'sourceIp', 'userArn'
+))
+
+EMAIL_PATTERN = re.compile(r'[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+')
+# 国内の電話番号（区切りあり、または 0 から始まる10〜11桁）と +81 形式
+PHONE_PATTERN = re.compile(
+    r'(?<![0-9A-Za-z-])(?:\+81[-\s]?|0)\d{1,4}[-\s]\d{1,4}[-\s]\d{3,4}(?![0-9A-Za-z-])'
+    r'|(?<![0-9A-Za-z-])0\d{9,10}(?![0-9A-Za-z-])'
+)
+
+_current = contextvars.ContextVar('traffic_recording', default=None)
+
+# ソルトを指定しない場合はプロセスごとに生成する（コンテナをまたいでハッシュは一致しない）
+_default_salt = os.urandom(16).hex()
+
+
+def recording_enabled():
+    return os.environ.get('RECORD_TRAFFIC', 'false').lower() == 'true'
+
+
+def _sample():
+    rate = float(os.environ.get('RECORD_SAMPLE_RATE', '1.0'))
+    return rate >= 1.0 or random.random() < rate
+
+
+def _sensitive_keys():
+    extra = os.environ.get('RECORD_MASK_KEYS', '')
+    if not extra:
+        return SENSITIVE_KEYS
+    return SENSITIVE_KEYS | {key.strip().lower() for key in extra.split(',') if key.strip()}
+
+
+def mask_token(value):
+    """
+    値をソルト付きのハッシュ（<masked:xxxxxxxxxx>）に置き換える
+    """
+    salt = os.environ.get('RECORD_MASK_SALT') or _default_salt
+    digest = hmac.new(salt.encode('utf-8'), str(value).encode('utf-8'), hashlib.sha256).hexdigest()
+    return f'<masked:{digest[:10]}>'
+
+
+def mask_text(text):
+    """
+    文字列に含まれるメールアドレス・電話番号を置き換える
+    """
+    text = EMAIL_PATTERN.sub(lambda match: mask_token(match.group(0)), text)
+    return PHONE_PATTERN.sub(lambda match: mask_token(match.group(0)), text)
+
+
+def mask_pii(value, keys=None, force=False):
+    """
+    個人情報をマスクしたコピーを返す（force=True の場合は文字列・数値をすべて置き換える）
+    """
+    keys = _sensitive_keys() if keys is None else keys
+    if isinstance(value, dict):
+        return {
+            key: mask_pii(item, keys, force or (isinstance(key, str) and key.lower() in keys))
+            for key, item in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [mask_pii(item, keys, force) for item in value]
+    if value is None or isinstance(value, bool):
+        return value
+    if force:
+        return mask_token(value)
+    if isinstance(value, str):
+        return mask_text(value)
+    if isinstance(value, (int, float)):
+        return value
+    return mask_text(str(value))
+
+
+def decode_body(body):
+    """
+    HTTP のボディを記録用の値にする（JSON・フォーム形式はデコードする）
+    """
+    if body is None or body == b'' or body == '':
+        return None
+    if isinstance(body, bytes):
+        try:
+            body = body.decode('utf-8')
+        except UnicodeDecodeError:
+            return {'_bytes': len(body)}
+    if not isinstance(body, str):
+        return {'_stream': type(body).__name__}
+    try:
+        return json.loads(body)
+    except ValueError:
+        pass
+    if '=' in body and ' ' not in body:
+        return dict(parse_qsl(body, keep_blank_values=True))
+    return body
+
+
+def describe_http_request(request):
+    """
+    requests の PreparedRequest を、アクション名（メソッドとパス）とマスクしたリクエストにする
+
+    記録時と再生時の照合で同じ形にするため、bench/replay.py からも使う。
+    """
+    parsed = urlsplit(request.url)
+    action = f'{request.method} {parsed.path}'
+    described = {
+        'method': request.method,
+        'path': parsed.path,
+        'query': dict(parse_qsl(parsed.query, keep_blank_values=True)),
+        'body': decode_body(request.body)
+    }
+    return action, mask_pii(described)
+
+
+class Recording:
+    """
+    記録中の1リクエスト（イベント・レスポンスと下流の呼び出し）
+    """
+
+    def __init__(self, service, request_id, event):
+        self.service = service
+        self.request_id = request_id
+        self.timestamp = time.time()
+        self.started = time.perf_counter()
+        self.event = mask_pii(_strip_trace(event))
+        self.trace_id = None
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def offset_ms(self):
+        return round((time.perf_counter() - self.started) * 1000, 1)
+
+    def add(self, entry):
+        with self._lock:
+            if self.trace_id is None:
+                self.trace_id = tracing.current_trace_id()
+            self.calls.append(entry)
+
+    def to_dict(self, response=None, error=None):
+        with self._lock:
+            calls = sorted(self.calls, key=lambda entry: entry['offset_ms'])
+        return {
+            'v': FORMAT_VERSION,
+            'service': self.service,
+            'request_id': self.request_id,
+            'trace_id': self.trace_id,
+            'ts': round(self.timestamp, 3),
+            'duration_ms': self.offset_ms(),
+            'event': self.event,
+            'response': mask_pii(response),
+            'error': f'{type(error).__name__}: {error}' if error is not None else None,
+            'calls': calls
+        }
+
+
+class Call:
+    """
+    記録中の下流の呼び出し（呼び出し側で response / status を設定する）
+    """
+
+    __slots__ = ('response', 'status')
+
+    def __init__(self):
+        self.response = None
+        self.status = None
+
+
+def _strip_trace(event):
+    # トレースコンテキストは再生時に引き継がない
+    if isinstance(event, dict) and tracing.PAYLOAD_KEY in event:
+        return {key: value for key, value in event.items() if key != tracing.PAYLOAD_KEY}
+    return event
+
+
+def current_recording():
+    return _current.get()
+
+
+@contextmanager
+def call(kind, action, request=None, target=None):
+    """
+    下流の呼び出しを記録する（記録中でなければ何もしない）
+
+    with recorder.call(recorder.KIND_INVOKE, action, payload, target=function_name) as recorded:
+        recorded.response = ...
+    """
+    recording = _current.get()
+    recorded = Call()
+    if recording is None:
+        yield recorded
+        return
+
+    offset_ms = recording.offset_ms()
+    started = time.perf_counter()
+    error = None
+    try:
+        yield recorded
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        try:
+            recording.add({
+                'kind': kind,
+                'target': target,
+                'action': action,
+                'offset_ms': offset_ms,
+                'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+                'status': recorded.status,
+                'request': mask_pii(_strip_trace(request)),
+                'response': mask_pii(recorded.response),
+                'error': f'{type(error).__name__}: {error}' if error is not None else None
+            })
+        except Exception as e:
+            logger.warning("Failed to record %s call: %s", kind, e)
+
+
+def http_hook(target):
+    """
+    セッションに登録する requests のレスポンスフック（記録中のみ HTTP の呼び出しを記録）
+    """
+    def hook(response, *args, **kwargs):
+        recording = _current.get()
+        if recording is None:
+            return None
+        try:
+            duration_ms = round(response.elapsed.total_seconds() * 1000, 1)
+            action, request = describe_http_request(response.request)
+            recording.add({
+                'kind': KIND_HTTP,
+                'target': target,
+                'action': action,
+                'offset_ms': round(max(recording.offset_ms() - duration_ms, 0.0), 1),
+                'duration_ms': duration_ms,
+                'status': response.status_code,
+                'request': request,
+                'response': mask_pii(decode_body(response.content)),
+                'error': None
+            })
+        except Exception as e:
+            logger.warning("Failed to record HTTP call: %s", e)
+        return None
+    return hook
+
+
+class TrafficWriter:
+    """
+    1行1リクエストの gzip ファイルへの追記（一定件数ごとに新しいファイルにする）
+
+    行ごとに flush するため、コンテナが途中で終了してもそれまでの行は読み出せる。
+    """
+
+    def __init__(self, directory, service, max_requests=1000):
+        self.directory = directory
+        self.service = service
+        self.max_requests = max_requests
+        self.path = None
+        self._file = None
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            if self._file is None or self._count >= self.max_requests:
+                self._open()
+            self._file.write(line + '\n')
+            self._file.flush()
+            self._count += 1
+
+    def _open(self):
+        self._close()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{self.service}-{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}{FILE_SUFFIX}"
+        self.path = os.path.join(self.directory, name)
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+        self._count = 0
+        logger.info("Recording traffic to %s", self.path)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+
+# 関数ごとの出力先（同一プロセスで複数の関数を動かす場合も分ける）
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(service):
+    writer = _writers.get(service)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(service)
+            if writer is None:
+                writer = TrafficWriter(
+                    os.environ.get('RECORD_DIR', '/tmp/traffic'),
+                    service,
+                    int(os.environ.get('RECORD_MAX_REQUESTS_PER_FILE', '1000'))
+                )
+                _writers[service] = writer
+    return writer
+
+
+def close_writers():
+    """
+    全ての出力先を閉じて破棄（テスト・ベンチマーク用）
+    """
+    with _writers_lock:
+        for writer in _writers.values():
+            writer.close()
+        _writers.clear()
+
+
+def record_traffic(service):
+    """
+    ハンドラーのイベント・レスポンスと下流の呼び出しを記録するデコレーター
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if not recording_enabled() or not _sample():
+                return handler(event, context)
+
+            try:
+                recording = Recording(service, getattr(context, 'aws_request_id', None) or 'local', event)
+            except Exception as e:
+                logger.warning("Failed to start traffic recording: %s", e)
+                return handler(event, context)
+
+            token = _current.set(recording)
+            response = error = None
+            try:
+                response = handler(event, context)
+                return response
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                _current.reset(token)
+                try:
+                    get_writer(service).write(recording.to_dict(response, error))
+                except Exception as e:
+                    # 記録の失敗でリクエストを失敗させない
+                    logger.warning("Failed to write traffic record: %s", e)
+        return wrapper
+    return decorator
+
+
+def iter_records(path):
+    """
+    記録したファイルの行を順に返す（書き込み途中で終わったファイルは読めた行まで）
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Skipping incomplete record in %s", path)
+    except (EOFError, gzip.BadGzipFile, OSError) as e:
+        logger.warning("Stopped reading %s: %s", path, e)
@@ -0,0 +1,346 @@
+"""
+Lambda をまたいだトレース（スパン・親子関係・属性）の伝播と出力
+
+各ハンドラーはリクエストの開始時に start_request() で受け取ったイベントから
+親スパンを取り出してリクエストのスパンを開始し、終了時に finish_request() で
+出力する。処理中の区間は span() で子スパンとして記録する。
+Lambda 呼び出しではペイロードの '_trace' に、Salesforce / Tavily への HTTP
+リクエストでは traceparent ヘッダーに W3C Trace Context 形式で現在のスパンを渡す。
+現在のスパンは contextvars で保持するため、スレッドプールで実行する処理には
+コンテキストを引き継ぐ（agents.parallel などを参照）。
+
+出力先は TRACE_EXPORTER（stdout / memory / none）で選び、set_exporter() で
+任意のエクスポーターに差し替えられる。none の場合もトレース ID の伝播とログへの
+付与は行う。
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# Lambda 呼び出しのペイロードでトレースコンテキストを渡すキー
+PAYLOAD_KEY = '_trace'
+TRACEPARENT_HEADER = 'traceparent'
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+
+_current_span = contextvars.ContextVar('trace_span', default=None)
+
+
+def _new_id(bits):
+    return f'{random.getrandbits(bits):0{bits // 4}x}'
+
+
+class SpanContext:
+    """
+    伝播するトレースの識別子（トレース ID・スパン ID・サンプリング有無）
+    """
+
+    __slots__ = ('trace_id', 'span_id', 'sampled')
+
+    def __init__(self, trace_id, span_id, sampled=True):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    def to_traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    @classmethod
+    def from_traceparent(cls, value):
+        """
+        traceparent ヘッダーの値を解析する（形式が不正な場合は None）
+        """
+        parts = (value or '').strip().split('-')
+        if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+            return None
+        try:
+            int(parts[1], 16), int(parts[2], 16)
+            flags = int(parts[3], 16)
+        except ValueError:
+            return None
+        if parts[1] == '0' * 32 or parts[2] == '0' * 16:
+            return None
+        return cls(parts[1], parts[2], bool(flags & 1))
+
+
+class Span:
+    """
+    1つの処理区間
+
+    end() で終了時刻を確定し、サンプリング対象であればエクスポーターに渡す。
+    """
+
+    def __init__(self, name, service=None, parent=None, attributes=None, sampled=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else _new_id(128)
+        self.span_id = _new_id(64)
+        self.parent_id = parent.span_id if parent else None
+        self.sampled = parent.sampled if parent else (sampled if sampled is not None else _sample())
+        self.service = service or (getattr(parent, 'service', None) if parent else None)
+        self.attributes = dict(attributes or {})
+        self.status = STATUS_OK
+        self.error = None
+        self.start_time = time.time()
+        self.duration_ms = None
+        self._started = time.perf_counter()
+
+    @property
+    def context(self):
+        return SpanContext(self.trace_id, self.span_id, self.sampled)
+
+    @property
+    def end_time(self):
+        if self.duration_ms is None:
+            return None
+        return self.start_time + self.duration_ms / 1000
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_error(self, error):
+        self.status = STATUS_ERROR
+        self.error = str(error)
+
+    def end(self):
+        if self.duration_ms is not None:
+            return
+        self.duration_ms = round((time.perf_counter() - self._started) * 1000, 3)
+        if self.sampled:
+            try:
+                get_exporter().export(self)
+            except Exception as e:
+                logger.warning("Exporting span failed: %s", e)
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'service': self.service,
+            'start_time': round(self.start_time, 6),
+            'duration_ms': self.duration_ms,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes
+        }
+
+
+class StdoutExporter:
+    """
+    スパンを1行1件の JSON で標準出力に書き出す（CloudWatch Logs で trace_id により集約する）
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def export(self, span):
+        entry = dict(span.to_dict(), type='span')
+        (self.stream or sys.stdout).write(json.dumps(entry, default=str, ensure_ascii=False) + '\n')
+
+
+class InMemoryExporter:
+    """
+    スパンをメモリに保持する（テスト・ベンチマーク用）
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+    def find(self, name):
+        with self._lock:
+            return [span for span in self.spans if span.name == name]
+
+    def traces(self):
+        """
+        トレース ID ごとのスパンのリスト
+        """
+        with self._lock:
+            spans = list(self.spans)
+        traces = {}
+        for span in spans:
+            traces.setdefault(span.trace_id, []).append(span)
+        return traces
+
+
+class NoopExporter:
+    def export(self, span):
+        pass
+
+
+_exporter = None
+_exporter_lock = threading.Lock()
+
+
+def create_exporter(name=None):
+    """
+    TRACE_EXPORTER（stdout / memory / none）に応じたエクスポーターを生成
+    """
+    name = (name or os.environ.get('TRACE_EXPORTER', 'none')).lower()
+    if name == 'stdout':
+        return StdoutExporter()
+    if name == 'memory':
+        return InMemoryExporter()
+    if name != 'none':
+        logger.warning("Unknown TRACE_EXPORTER %s, spans will not be exported", name)
+    return NoopExporter()
+
+
+def get_exporter():
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = create_exporter()
+    return _exporter
+
+
+def set_exporter(exporter):
+    """
+    エクスポーターを差し替える（None を渡すと次回 TRACE_EXPORTER から作り直す）
+    """
+    global _exporter
+    with _exporter_lock:
+        _exporter = exporter
+
+
+def _sample():
+    return random.random() < float(os.environ.get('TRACE_SAMPLE_RATE', '1'))
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_trace_id():
+    span = _current_span.get()
+    return span.trace_id if span is not None else None
+
+
+def extract(carrier):
+    """
+    イベント（ペイロードの '_trace' または HTTP ヘッダー）から親のスパンを取り出す
+    """
+    if not isinstance(carrier, dict):
+        return None
+    trace = carrier.get(PAYLOAD_KEY)
+    if isinstance(trace, dict) and trace.get(TRACEPARENT_HEADER):
+        return SpanContext.from_traceparent(trace[TRACEPARENT_HEADER])
+    headers = carrier.get('headers')
+    if isinstance(headers, dict):
+        for key, value in headers.items():
+            if key.lower() == TRACEPARENT_HEADER:
+                return SpanContext.from_traceparent(value)
+    return None
+
+
+def inject_payload(payload):
+    """
+    現在のスパンを '_trace' に入れたペイロードのコピーを返す（スパンがなければそのまま）
+    """
+    span = _current_span.get()
+    if span is None or not isinstance(payload, dict):
+        return payload
+    return dict(payload, **{PAYLOAD_KEY: {TRACEPARENT_HEADER: span.context.to_traceparent()}})
+
+
+def inject_headers(headers):
+    """
+    現在のスパンを traceparent ヘッダーとして headers に追加する
+    """
+    span = _current_span.get()
+    if span is not None:
+        headers[TRACEPARENT_HEADER] = span.context.to_traceparent()
+    return headers
+
+
+def start_request(name, event=None, service=None, **attributes):
+    """
+    イベントから親を取り出してリクエストのスパンを開始し、現在のスパンにする
+
+    Lambda はコンテナごとに1リクエストずつ処理するため、呼び出しごとに置き換える。
+    """
+    request_span = Span(name, service=service or name, parent=extract(event), attributes=attributes)
+    _current_span.set(request_span)
+    return request_span
+
+
+def finish_request(request_span=None, error=None):
+    """
+    リクエストのスパンを終了して出力し、現在のスパンを解除する
+    """
+    request_span = request_span or _current_span.get()
+    if request_span is None:
+        return None
+    if error is not None:
+        request_span.record_error(error)
+    request_span.end()
+    if _current_span.get() is request_span:
+        _current_span.set(None)
+    return request_span
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    with ブロックを現在のスパンの子スパンとして記録する
+
+    リクエストのスパンがない場合は新しいトレースを開始する。例外は記録して再送出する。
+    """
+    child = Span(name, parent=_current_span.get(), attributes=attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except Exception as e:
+        child.record_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        child.end()
+
+
+def critical_path(spans):
+    """
+    1トレースのスパンからクリティカルパス（ルートから最後に終わる子を順にたどった列）を返す
+
+    スパンは関数をまたいで集めたもの（StdoutExporter の出力や InMemoryExporter の spans）で、
+    辞書・Span のどちらでもよい。
+    """
+    items = [s.to_dict() if isinstance(s, Span) else dict(s) for s in spans]
+    if not items:
+        return []
+    ids = {item['span_id'] for item in items}
+    children = {}
+    for item in items:
+        children.setdefault(item.get('parent_id'), []).append(item)
+
+    def end_time(item):
+        return item['start_time'] + (item.get('duration_ms') or 0) / 1000
+
+    roots = [item for item in items if item.get('parent_id') not in ids]
+    path = []
+    node = max(roots, key=lambda item: item.get('duration_ms') or 0)
+    while node is not None:
+        path.append(node)
+        candidates = children.get(node['span_id'])
+        node = max(candidates, key=end_time) if candidates else None
+    return path
@@ -0,0 +1,85 @@
+"""
+リクエスト全体の締め切りと処理段階ごとの時間予算
+"""
+import os
+import time
+import logging
+
+from common.log import verbose
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# 段階ごとの時間予算（秒）。STAGE_BUDGET_<段階名>_SECONDS で上書きできる
+DEFAULT_STAGE_BUDGETS = {
+    'case_fetch': 8.0,
+    'related': 12.0,
+    'generation': 30.0,
+}
+
+
+class Deadline:
+    """
+    Lambda の残り時間から求めた締め切り
+
+    レスポンスの組み立てとシリアライズに使う時間（reserve_seconds）を
+    差し引いた残り時間を、各段階の予算の上限として扱う。
+    """
+
+    def __init__(self, expires_at, reserve_seconds=2.0, stage_budgets=None):
+        self.expires_at = expires_at
+        self.reserve_seconds = reserve_seconds
+        self.stage_budgets = dict(DEFAULT_STAGE_BUDGETS)
+        self.stage_budgets.update(stage_budgets or {})
+
+    @classmethod
+    def from_context(cls, context=None):
+        """
+        Lambda コンテキストの残り時間から生成（ローカル実行時は REQUEST_TIMEOUT_SECONDS）
+        """
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            remaining = context.get_remaining_time_in_millis() / 1000.0
+        else:
+            remaining = float(os.environ.get('REQUEST_TIMEOUT_SECONDS', '60'))
+
+        stage_budgets = {}
+        for stage in DEFAULT_STAGE_BUDGETS:
+            value = os.environ.get(f'STAGE_BUDGET_{stage.upper()}_SECONDS')
+            if value:
+                stage_budgets[stage] = float(value)
+
+        deadline = cls(
+            time.monotonic() + remaining,
+            reserve_seconds=float(os.environ.get('DEADLINE_RESERVE_SECONDS', '2')),
+            stage_budgets=stage_budgets
+        )
+        verbose(logger, "Request deadline: %.1fs available", deadline.remaining())
+        return deadline
+
+    @classmethod
+    def unlimited(cls):
+        """
+        締め切りを設けない Deadline（バッチ処理やテスト用）
+        """
+        return cls(float('inf'), reserve_seconds=0.0)
+
+    def remaining(self):
+        """
+        予備時間を除いた残り秒数（0 未満にはならない）
+        """
+        return max(self.expires_at - time.monotonic() - self.reserve_seconds, 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def budget(self, stage):
+        """
+        段階の予算と残り時間の小さい方
+        """
+        return min(self.stage_budgets.get(stage, float('inf')), self.remaining())
+
+    def allows(self, min_seconds):
+        """
+        残り時間が min_seconds 以上あるか
+        """
+        return self.remaining() >= min_seconds
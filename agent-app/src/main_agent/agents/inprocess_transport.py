@@ -0,0 +1,146 @@
+"""
+sf_api / web_search のハンドラーを同一プロセス内で呼び出すトランスポート
+
+コンテナや単一プロセスで全機能を動かす場合に、Lambda 呼び出しの往復と
+シリアライズを省く。InvokeClient と同じ invoke(function_name, payload) の
+インターフェースとエラー分類を持ち、SERVICE_TRANSPORT=inprocess で選択する。
+"""
+import os
+import sys
+import time
+import logging
+import threading
+import contextvars
+import importlib.util
+
+from .invoke_client import FunctionError, InvokeError, LatencyHistogram
+from common.log import current_request_id
+from common import metrics as request_metrics
+from common import tracing
+from common import recorder
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+_SRC_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# サービス名 -> (ハンドラーのディレクトリを指定する環境変数, 既定のディレクトリ, 関数名の環境変数)
+SERVICES = {
+    'sf_api': ('SF_API_HANDLER_DIR', os.path.join(_SRC_DIR, 'sf_api'), 'SF_API_FUNCTION_NAME'),
+    'web_search': ('WEB_SEARCH_HANDLER_DIR', os.path.join(_SRC_DIR, 'web_search'), 'WEB_SEARCH_FUNCTION_NAME'),
+}
+
+
+def load_handler(service, directory):
+    """
+    サービスの lambda_function.py を読み込み、lambda_handler を返す
+
+    各サービスはフラットな import（from sf_client import ...）を使うため
+    ディレクトリを sys.path に追加し、lambda_function はサービスごとに別名で読み込む。
+    """
+    path = os.path.join(directory, 'lambda_function.py')
+    if not os.path.exists(path):
+        raise InvokeError(f'Handler not found for {service}: {path}', service)
+
+    if directory not in sys.path:
+        sys.path.append(directory)
+
+    spec = importlib.util.spec_from_file_location(f'{service}_lambda_function', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    logger.info("Loaded in-process handler for %s from %s", service, directory)
+    return module.lambda_handler
+
+
+class InProcessContext:
+    """
+    ハンドラーに渡す Lambda コンテキストの代わり（呼び出し元のリクエスト ID を引き継ぐ）
+    """
+
+    def __init__(self, aws_request_id):
+        self.aws_request_id = aws_request_id
+
+
+class InProcessTransport:
+    """
+    ハンドラーを直接呼び出す InvokeClient 互換のトランスポート
+
+    handlers にサービス名 -> ハンドラー関数を渡すと、ファイルからの読み込みの
+    代わりにそれを使う（テスト・ベンチマーク用）。
+    """
+
+    def __init__(self, handlers=None):
+        self._handlers = dict(handlers or {})
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def invoke(self, function_name, payload, action=None):
+        """
+        ハンドラーを呼び出し、レスポンスをそのまま返す
+
+        ハンドラー内の例外は Lambda の errorMessage と同様に FunctionError として送出する。
+        """
+        action = action or payload.get('action') or function_name
+        with tracing.span(f'invoke {action}', function_name=function_name, action=action, transport='inprocess'):
+            # トラフィックの記録中はトレースコンテキストを除いたペイロードとレスポンスを残す
+            with recorder.call(recorder.KIND_INVOKE, action, payload, target=function_name) as recorded:
+                recorded.response = self._invoke(function_name, tracing.inject_payload(payload), action)
+                return recorded.response
+
+    def _invoke(self, function_name, payload, action):
+        handler = self._handler(function_name)
+
+        started = time.monotonic()
+        try:
+            # ハンドラー内のログ設定（リクエスト ID の登録など）が呼び出し元に影響しないよう別コンテキストで実行
+            result = contextvars.copy_context().run(handler, payload, InProcessContext(current_request_id()))
+        except Exception as e:
+            self._record_latency(action, started)
+            raise FunctionError(str(e), function_name, action) from e
+
+        self._record_latency(action, started)
+        if isinstance(result, dict) and 'errorMessage' in result:
+            raise FunctionError(result['errorMessage'], function_name, action)
+        return result
+
+    def invoke_async(self, function_name, payload):
+        """
+        スレッドで実行し、結果は待たない
+        """
+        threading.Thread(
+            target=self._handler(function_name), args=(tracing.inject_payload(payload), None), daemon=True
+        ).start()
+
+    def stats(self):
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {
+            'transport': 'inprocess',
+            'latency': {name: histogram.snapshot() for name, histogram in histograms.items()}
+        }
+
+    def _service_for(self, function_name):
+        for service, (_, _, name_env) in SERVICES.items():
+            if function_name in (service, os.environ.get(name_env)):
+                return service
+        raise InvokeError(f'No in-process handler for {function_name}', function_name)
+
+    def _handler(self, function_name):
+        service = self._service_for(function_name)
+        with self._lock:
+            handler = self._handlers.get(service)
+            if handler is None:
+                dir_env, default_dir, _ = SERVICES[service]
+                handler = load_handler(service, os.environ.get(dir_env, default_dir))
+                self._handlers[service] = handler
+            return handler
+
+    def _record_latency(self, action, started):
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            histogram = self._histograms.get(action)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                self._histograms[action] = histogram
+        histogram.record(elapsed_ms)
+        request_metrics.record(f'invoke_{action}', round(elapsed_ms, 1))
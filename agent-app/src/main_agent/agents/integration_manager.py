@@ -1,6 +1,10 @@
 import json
 import os
-import boto3
+import queue
+import contextvars
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import logging
 try:
     from strands_agents import Agent
@@ -9,106 +13,679 @@ try:
 except ImportError:
     STRANDS_AVAILABLE = False
 
+try:
+    from strands_agents.models import BedrockModel
+    BEDROCK_MODEL_AVAILABLE = True
+except ImportError:
+    BEDROCK_MODEL_AVAILABLE = False
+
 from .record_analyzer import RecordAnalyzer
 from .workflow_advisor import WorkflowAdvisor
+from .parallel import run_parallel_with_timeout, SingleFlight
+from .deadline import Deadline
+from .invoke_client import create_invoke_client, get_invoke_client
+from .prompt_builder import PromptContextBuilder
+from .request_context import request_scope, current_memo, submit_in_context
+from common.ttl_cache import TTLCache
+from common.log import lazy, log_event, verbose
+from common import metrics as request_metrics
+from common import tracing
+from common import recorder
 
 # ログ設定
 logger = logging.getLogger(__name__)
 
+# 全リクエストで共通の指示（先頭を固定することでプロンプトキャッシュを効かせる）
+SUPPORT_SYSTEM_PROMPT = """
+あなたはSalesforceのカスタマーサポートエージェントです。
+各質問は新しい質問セッションです。過去の回答に依存せず、ユーザーメッセージで渡されるケース情報・類似ケース・外部検索結果のみを基に、顧客からの質問に対する新しいサポート回答を生成してください。
+
+**重要**: 質問に特化した新しい回答を生成してください。質問の内容に応じて、具体的で実行可能な解決手順を含む回答を作成してください。
+日本語で、顧客に優しく、プロフェッショナルな対応でお答えください。
+
+質問の種類に応じて以下の観点を含めてください：
+- 技術的な問題の場合：トラブルシューティング手順
+- 操作方法の場合：ステップバイステップの説明
+- 設定に関する場合：設定変更の具体的な手順
+- エラーの場合：エラーの原因と解決方法
+
+必要に応じて以下のツールを使用してください：
+- get_salesforce_case_details: 追加のケース詳細情報を取得
+- find_similar_salesforce_cases: 異なるキーワードで類似ケースを検索（説明を渡すと類似度の計算に使用）
+- search_external_knowledge: 質問に関連する外部ナレッジベースを検索
+"""
+
+class AgentRun:
+    """
+    生成用スレッドで実行中の Agent（呼び出し元が待つのをやめたかどうかを保持）
+
+    出力テキストは forward_token 経由で呼び出し元に送り、待つのをやめた後は
+    disconnect で送信先を外す（回答を返し終えたリクエストに後からトークンを送らない）。
+    """
+
+    def __init__(self, on_token=None):
+        self.future = None
+        self.done = False
+        self.orphaned = False
+        self._on_token = on_token
+        self._token_lock = threading.Lock()
+
+    def forward_token(self, text):
+        with self._token_lock:
+            if self._on_token is not None:
+                self._on_token(text)
+
+    def disconnect(self):
+        with self._token_lock:
+            self._on_token = None
+
+
 class IntegrationManager:
     """
     各エージェントを統合し、サポートリクエストを処理するメインマネージャー
     """
 
-    def __init__(self):
+    def __init__(self, lambda_client=None):
         logger.info("Initializing IntegrationManager")
         
-        # Lambda クライアント初期化
-        logger.info("Setting up Lambda client")
-        self.lambda_client = boto3.client('lambda')
+        # Lambda 呼び出しクライアント（テスト時は Lambda クライアントを外部から注入可能）
+        logger.info("Setting up invoke client")
+        self.invoke_client = create_invoke_client(lambda_client) if lambda_client is not None else get_invoke_client()
         
         # 各コンポーネントの初期化
         logger.info("Initializing RecordAnalyzer")
-        self.record_analyzer = RecordAnalyzer(self.lambda_client)
+        self.record_analyzer = RecordAnalyzer(self.invoke_client)
         
         logger.info("Initializing WorkflowAdvisor")
-        self.workflow_advisor = WorkflowAdvisor(self.lambda_client)
+        self.workflow_advisor = WorkflowAdvisor(self.invoke_client)
 
         # Lambda関数名を環境変数から取得
-        self.sf_function_name = os.environ.get('SF_API_FUNCTION_NAME')
-        self.search_function_name = os.environ.get('WEB_SEARCH_FUNCTION_NAME')
+        self.sf_function_name = os.environ.get('SF_API_FUNCTION_NAME', 'sf_api')
+        self.search_function_name = os.environ.get('WEB_SEARCH_FUNCTION_NAME', 'web_search')
         
-        logger.info(f"SF API Function: {self.sf_function_name}")
-        logger.info(f"Web Search Function: {self.search_function_name}")
+        logger.info("SF API Function: %s", self.sf_function_name)
+        logger.info("Web Search Function: %s", self.search_function_name)
+
+        # ケースごとの分析結果キャッシュ（追加質問では回答生成のみ行う）
+        cache_ttl = int(os.environ.get('CASE_ANALYSIS_CACHE_TTL_SECONDS', '900'))
+        if cache_ttl > 0:
+            self.case_cache = TTLCache(
+                max_entries=int(os.environ.get('CASE_ANALYSIS_CACHE_MAX_ENTRIES', '128')),
+                ttl_seconds=cache_ttl
+            )
+        else:
+            self.case_cache = None
+        logger.info("Case analysis cache TTL: %ss", cache_ttl)
+
+        # プロンプトに含めるコンテキストのトークン予算
+        self.prompt_builder = PromptContextBuilder()
+
+        # Strands Agent はスレッドごとに1つ生成して再利用する
+        self._agent_local = threading.local()
 
-        # Strands Agent の初期化（利用可能な場合）
+        # 回答生成は締め切りで打ち切れるよう専用スレッドで実行する
+        # （時間切れの Agent が残っていても次のリクエストは別スレッドで処理できるよう複数用意）
+        # 時間切れで待つのをやめた Agent も Bedrock の応答まではスレッドを占有するため、
+        # その分（AGENT_MAX_ORPHANS）を上乗せし、上限に達している間は新しい Agent を開始しない
+        self.agent_max_orphans = int(os.environ.get('AGENT_MAX_ORPHANS', '2'))
+        self._generation_executor = ThreadPoolExecutor(
+            max_workers=int(os.environ.get('AGENT_MAX_WORKERS', '2')) + self.agent_max_orphans,
+            thread_name_prefix='support-agent'
+        )
+        self._orphaned_runs = 0
+        self._orphan_lock = threading.Lock()
+        self.agent_min_seconds = float(os.environ.get('AGENT_MIN_SECONDS', '5'))
+
+        # hedged: シンプル版を先に用意し、Agent は AGENT_SLO_SECONDS まで待つ
+        self.generation_mode = os.environ.get('GENERATION_MODE', 'agent').lower()
+        self.agent_slo_seconds = float(os.environ.get('AGENT_SLO_SECONDS', '8'))
+        pending_ttl = int(os.environ.get('AGENT_PENDING_TTL_SECONDS', '600'))
+        self.pending_answers = TTLCache(
+            max_entries=int(os.environ.get('AGENT_PENDING_MAX_ENTRIES', '64')),
+            ttl_seconds=pending_ttl
+        ) if pending_ttl > 0 else None
+        logger.info("Generation mode: %s, agent SLO: %ss", self.generation_mode, self.agent_slo_seconds)
+
+        # バッチ処理で同時に処理するケース数
+        self.batch_max_concurrency = int(os.environ.get('BATCH_MAX_CONCURRENCY', '4'))
+
+        # Strands Agent は回答生成を実行するスレッドで初めて使うときに生成する
         if STRANDS_AVAILABLE:
-            logger.info("Strands Agents available - initializing support agent")
-            self.support_agent = self._initialize_support_agent()
+            logger.info("Strands Agents available - support agents are created per generation worker")
         else:
             logger.warning("Strands Agents not available - using simple implementation")
-            self.support_agent = None
             
         logger.info("IntegrationManager initialization completed")
 
-    def process_support_request(self, case_id, question):
+    def process_support_request(self, case_id, question, bypass_cache=False, deadline=None, progress=None, emit=None,
+                                analysis_only=False, search_memo=None):
         """
         サポートリクエストを処理し、統合された回答を生成
+
+        deadline（Deadline）の残り時間を超えそうな段階は省略・打ち切り、
+        partial と degraded_stages を付けた部分的な回答を返す。
+        progress に progress(stage, status) を渡すと各段階の開始・完了を通知する。
+        emit に emit(event, data) を渡すと途中結果を取得でき次第通知する
+        （process_support_request_stream を参照）。
+        analysis_only=True の場合は回答生成を行わず、分析結果のみを返す。
+        パイプラインが取得したデータはリクエスト内のメモに保持し、Agent のツールが
+        同じデータを要求した場合はそこから返す（request_context を参照）。
         """
-        logger.info(f"Starting support request processing for case: {case_id}")
-        logger.debug(f"Question: {question}")
+        with request_scope(), tracing.span('process_support_request', case_id=case_id, analysis_only=analysis_only):
+            return self._process_support_request(
+                case_id, question, bypass_cache=bypass_cache, deadline=deadline, progress=progress, emit=emit,
+                analysis_only=analysis_only, search_memo=search_memo
+            )
+
+    def _process_support_request(self, case_id, question, bypass_cache=False, deadline=None, progress=None,
+                                 emit=None, analysis_only=False, search_memo=None):
+        verbose(logger, "Starting support request processing for case: %s", case_id)
+        logger.debug("Question: %s", question)
+        deadline = deadline or Deadline.from_context()
+        degraded_stages = []
         
         try:
-            # 1. ケースレコードの分析
-            logger.info("Step 1: Starting case record analysis")
-            case_analysis = self.record_analyzer.analyze_case(case_id)
-            logger.info(f"Case analysis completed. Status: {'success' if not case_analysis.get('error') else 'error'}")
+            # 1-2. ケースレコードの分析と関連する外部情報の検索（キャッシュが有効なら再利用）
+            verbose(logger, "Step 1-2: Starting case record analysis and external information search")
+            self._report_progress(progress, 'case_analysis', 'running')
+            case_emitted = []
+
+            def on_case(summary):
+                case_emitted.append(True)
+                self._emit(emit, 'case', summary)
+
+            with request_metrics.timer('stage_case_analysis'), tracing.span('case_analysis') as stage_span:
+                case_analysis, search_results, cache_status = self._get_case_context(
+                    case_id, bypass_cache, deadline=deadline, degraded_stages=degraded_stages, on_case=on_case,
+                    search_memo=search_memo
+                )
+            request_metrics.increment(f'analysis_cache_{cache_status}')
+            stage_span.set_attribute('analysis_cache', cache_status)
+            verbose(logger, "Case analysis cache: %s", cache_status)
+            verbose(logger, "Case analysis completed. Status: %s", 'success' if not case_analysis.get('error') else 'error')
             if case_analysis.get('error'):
-                logger.error(f"Case analysis error: {case_analysis.get('error')}")
+                logger.error("Case analysis error: %s", case_analysis.get('error'))
+            verbose(
+                logger, "External search completed. Results count: %s",
+                lazy(lambda: len(search_results.get('results', {}).get('results', [])))
+            )
+            self._report_progress(progress, 'case_analysis', 'completed')
 
-            # 2. 関連する外部情報の検索
-            logger.info("Step 2: Starting external information search")
-            case_subject = case_analysis.get('subject', '')
-            case_description = case_analysis.get('description', '')
-            logger.debug(f"Search terms - Subject: {case_subject}, Description length: {len(case_description)}")
-            
-            search_results = self.workflow_advisor.search_external_info(case_subject, case_description)
-            logger.info(f"External search completed. Results count: {len(search_results.get('results', {}).get('results', []))}")
+            if not case_emitted:
+                self._emit(emit, 'case', self._case_summary(case_analysis))
+            self._emit(emit, 'similar_cases', case_analysis.get('similar_cases', []))
+            self._emit(emit, 'case_history', case_analysis.get('case_history', []))
+            self._emit(emit, 'external_info', search_results)
+
+            if analysis_only:
+                verbose(logger, "Analysis only - skipping response generation")
+                return {
+                    'case_analysis': case_analysis,
+                    'external_info': search_results,
+                    'recommendations': self._generate_recommendations(case_analysis, search_results),
+                    'analysis_cache': cache_status,
+                    'partial': bool(degraded_stages),
+                    'degraded_stages': degraded_stages
+                }
 
             # 3. 統合回答の生成
-            logger.info("Step 3: Starting AI response generation")
-            if STRANDS_AVAILABLE and self.support_agent:
-                logger.info("Using Strands Agent for response generation")
-                integrated_response = self._generate_strands_response(
-                    case_analysis, search_results, question
-                )
-            else:
-                logger.info("Using simple response generation (Strands not available)")
-                integrated_response = self._generate_simple_response(
-                    case_analysis, search_results, question
+            verbose(logger, "Step 3: Starting AI response generation")
+            self._report_progress(progress, 'generation', 'running')
+            generation_metrics = {}
+            streamed_tokens = []
+
+            def on_token(text):
+                streamed_tokens.append(len(text))
+                self._emit(emit, 'token', {'text': text})
+
+            with request_metrics.timer('stage_generation'), tracing.span('generation') as stage_span:
+                integrated_response, response_source = self._generate_response(
+                    case_analysis, search_results, question, deadline, generation_metrics, degraded_stages,
+                    on_token=on_token if emit is not None else None
                 )
+                stage_span.set_attribute('response_source', response_source)
+            if response_source != 'agent' or not streamed_tokens:
+                # トークンを逐次送れなかった回答（シンプル版・暫定回答など）はまとめて送る
+                self._emit(emit, 'ai_response', {'text': integrated_response, 'response_source': response_source})
             
-            logger.info(f"AI response generated. Length: {len(integrated_response)} chars")
+            verbose(logger, "AI response generated. Length: %s chars", len(integrated_response))
+            self._report_progress(progress, 'generation', 'completed')
 
             # 4. 推奨事項の生成
-            logger.info("Step 4: Generating recommendations")
-            recommendations = self._generate_recommendations(case_analysis, search_results)
-            logger.info(f"Generated {len(recommendations)} recommendations")
+            verbose(logger, "Step 4: Generating recommendations")
+            with request_metrics.timer('stage_recommendations'):
+                recommendations = self._generate_recommendations(case_analysis, search_results)
+            verbose(logger, "Generated %s recommendations", len(recommendations))
 
             final_response = {
                 'case_analysis': case_analysis,
                 'external_info': search_results,
                 'ai_response': integrated_response,
-                'recommendations': recommendations
+                'recommendations': recommendations,
+                'analysis_cache': cache_status,
+                'response_source': response_source,
+                'provisional': response_source == 'provisional',
+                'partial': bool(degraded_stages),
+                'degraded_stages': degraded_stages
             }
+            if generation_metrics:
+                final_response['generation_metrics'] = generation_metrics
+            if degraded_stages:
+                logger.warning("Returning partial response. Degraded stages: %s", degraded_stages)
+                request_metrics.increment('degraded_stages', len(degraded_stages))
             
-            logger.info("Support request processing completed successfully")
+            verbose(logger, "Support request processing completed successfully")
             return final_response
 
         except Exception as e:
-            logger.error(f"Integration error: {str(e)}", exc_info=True)
+            logger.error("Integration error: %s", e, exc_info=True)
             raise e
 
+    def process_support_request_stream(self, case_id, question, bypass_cache=False, deadline=None):
+        """
+        process_support_request をバックグラウンドで実行し、途中結果をイベントとして順に返す
+
+        イベントは {'event': 種類, 'data': 内容} の辞書で、case → similar_cases →
+        case_history → external_info → token（複数）または ai_response → done の順に届く。
+        done には process_support_request と同じ集約済みレスポンスが入る。
+        処理中に例外が発生した場合は error イベントで終わる。
+        """
+        events = queue.Queue()
+
+        def emit(event, data):
+            events.put({'event': event, 'data': data})
+
+        def run():
+            try:
+                result = self.process_support_request(
+                    case_id, question, bypass_cache=bypass_cache, deadline=deadline, emit=emit
+                )
+                emit('done', result)
+            except Exception as e:
+                emit('error', {'error': str(e)})
+            finally:
+                events.put(None)
+
+        # リクエスト ID などのコンテキストを引き継いで実行する
+        threading.Thread(target=contextvars.copy_context().run, args=(run,), name='support-stream', daemon=True).start()
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            yield item
+
+    def process_batch(self, items, analysis_only=False, max_workers=None, deadline=None, bypass_cache=False):
+        """
+        複数ケースをまとめて処理し、入力順に項目ごとの結果またはエラーを返す
+
+        ケースは最大 max_workers 件（BATCH_MAX_CONCURRENCY が上限）ずつ並列に処理し、
+        同じ検索クエリになる Web 検索はバッチ内で1回にまとめる。締め切りまでに
+        処理を始められなかったケースは skipped とする。
+
+        Args:
+            items (list): {'case_id': str, 'question': str} のリスト
+                （analysis_only の場合 question は省略可）
+            analysis_only (bool): 回答生成を省略し、分析結果のみを返す
+        """
+        deadline = deadline or Deadline.from_context()
+        workers = min(int(max_workers or self.batch_max_concurrency), self.batch_max_concurrency)
+        search_memo = SingleFlight()
+        logger.info("Starting batch of %s cases (concurrency: %s, analysis_only: %s)", len(items), workers, analysis_only)
+
+        def process_item(item):
+            case_id = item.get('case_id')
+            question = item.get('question')
+            if not case_id or (not analysis_only and not question):
+                return {'case_id': case_id, 'status': 'error', 'error': 'case_id and question are required'}
+            if deadline.expired():
+                return {'case_id': case_id, 'status': 'skipped', 'error': 'Deadline exceeded before processing'}
+            try:
+                result = self.process_support_request(
+                    case_id, question, bypass_cache=bypass_cache, deadline=deadline,
+                    analysis_only=analysis_only, search_memo=search_memo
+                )
+                return {'case_id': case_id, 'status': 'ok', 'result': result}
+            except Exception as e:
+                logger.error("Batch item %s failed: %s", case_id, e)
+                return {'case_id': case_id, 'status': 'error', 'error': str(e)}
+
+        # 項目ごとの計測・トレースがバッチのリクエストに属するよう、コンテキストを引き継いで実行する
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(items) or 1))) as executor:
+            futures = [submit_in_context(executor, process_item, item) for item in items]
+            results = [future.result() for future in futures]
+
+        summary = {
+            'total': len(results),
+            'succeeded': sum(1 for r in results if r['status'] == 'ok'),
+            'failed': sum(1 for r in results if r['status'] == 'error'),
+            'skipped': sum(1 for r in results if r['status'] == 'skipped'),
+            'deduplicated_searches': search_memo.deduplicated
+        }
+        log_event(logger, logging.INFO, "Batch completed", **summary)
+        return {'results': results, 'summary': summary}
+
+    def _emit(self, emit, event, data):
+        """
+        途中結果の通知（通知の失敗でリクエスト処理は止めない）
+        """
+        if emit is None:
+            return
+        try:
+            emit(event, data)
+        except Exception as e:
+            logger.warning("Emitting %s event failed: %s", event, e)
+
+    def _case_summary(self, case_analysis):
+        """
+        関連情報を除いたケース情報（ケース取得直後に送る内容）
+        """
+        return {
+            key: value for key, value in case_analysis.items()
+            if key not in ('similar_cases', 'case_history')
+        }
+
+    def _report_progress(self, progress, stage, status):
+        """
+        進捗の通知（通知の失敗でリクエスト処理は止めない）
+        """
+        if progress is None:
+            return
+        try:
+            progress(stage, status)
+        except Exception as e:
+            logger.warning("Progress report failed (%s: %s): %s", stage, status, e)
+
+    def _get_case_context(self, case_id, bypass_cache=False, deadline=None, degraded_stages=None, on_case=None,
+                          search_memo=None):
+        """
+        キャッシュ済みの分析結果が最新であれば再利用し、そうでなければ取得し直す
+
+        ケースの LastModifiedDate が前回と同じであれば、ケース分析と外部検索は
+        再実行しない。
+
+        Returns:
+            tuple: (case_analysis, search_results, cache_status)
+                cache_status は 'hit' / 'miss' / 'stale' / 'bypass' / 'disabled'
+        """
+        if self.case_cache is None:
+            cache_status = 'disabled'
+        elif bypass_cache:
+            cache_status = 'bypass'
+        else:
+            cached = self.case_cache.get(case_id)
+            if cached is None:
+                cache_status = 'miss'
+            else:
+                current_version = self.record_analyzer.get_case_version(case_id)
+                if current_version and current_version == cached['version']:
+                    return cached['case_analysis'], cached['external_info'], 'hit'
+                cache_status = 'stale'
+
+        stage_errors = []
+        case_analysis, search_results = self._analyze_case_and_search(
+            case_id, deadline=deadline, degraded_stages=stage_errors, on_case=on_case, search_memo=search_memo
+        )
+        if degraded_stages is not None:
+            degraded_stages.extend(stage_errors)
+
+        # 取得に失敗した結果・時間切れで欠けた結果はキャッシュしない
+        version = case_analysis.get('last_modified_date')
+        if (
+            self.case_cache is not None
+            and version
+            and not stage_errors
+            and not case_analysis.get('error')
+            and not search_results.get('error')
+        ):
+            self.case_cache.set(case_id, {
+                'version': version,
+                'case_analysis': case_analysis,
+                'external_info': search_results
+            })
+
+        return case_analysis, search_results, cache_status
+
+    def _analyze_case_and_search(self, case_id, deadline=None, degraded_stages=None, on_case=None,
+                                 search_memo=None):
+        """
+        ケース取得後、類似ケース検索・履歴取得・外部検索を並列実行する
+
+        ケースデータの取得だけが後続処理の前提となるため、それ以降の
+        3つの呼び出しは同時に実行し、結果は固定の順序でまとめる。
+        各段階は deadline の予算内で待ち、間に合わなかった段階は空の結果で
+        置き換えて degraded_stages に記録する。
+        on_case を渡すと、ケース取得直後に関連情報を除いたケース情報で呼び出す。
+        """
+        deadline = deadline or Deadline.unlimited()
+        if degraded_stages is None:
+            degraded_stages = []
+
+        try:
+            verbose(logger, "Fetching case data from Salesforce")
+            results, timed_out = run_parallel_with_timeout(
+                {'case_data': lambda: self.record_analyzer.fetch_case(case_id)},
+                deadline.budget('case_fetch')
+            )
+            case_data = results['case_data']
+        except Exception as e:
+            logger.error("Case fetch error: %s", e, exc_info=True)
+            case_data = None
+            error_message = f'ケース分析でエラーが発生しました: {str(e)}'
+        else:
+            if timed_out:
+                degraded_stages.append('case_fetch')
+                error_message = 'Case fetch timed out'
+            else:
+                error_message = 'Case not found or access denied'
+
+        if not case_data:
+            # ケースが取得できない場合も外部検索は従来どおり実行する
+            case_analysis = self.record_analyzer.build_error_analysis(case_id, error_message)
+            search_results = self._search_within_deadline('', '', deadline, degraded_stages, search_memo)
+            return case_analysis, search_results
+
+        if on_case is not None:
+            on_case(self._case_summary(self.record_analyzer.build_analysis(case_id, case_data, [], [])))
+
+        case_subject = case_data.get('Subject', '')
+        case_description = case_data.get('Description', '')
+        logger.debug("Search terms - Subject: %s, Description length: %s", case_subject, len(case_description or ''))
+
+        if not self.record_analyzer.can_search_similar(deadline):
+            degraded_stages.append('similar_cases')
+        tasks = self.record_analyzer.related_tasks(case_id, case_data, deadline=deadline)
+        tasks['external_info'] = lambda: self.workflow_advisor.search_external_info(
+            case_subject, case_description, deadline=deadline, search_memo=search_memo
+        )
+        fallbacks = self.record_analyzer.related_fallbacks()
+        fallbacks['external_info'] = self._skipped_search_results()
+
+        verbose(logger, "Running %s independent stages in parallel", len(tasks))
+        results, timed_out = run_parallel_with_timeout(tasks, deadline.budget('related'), fallbacks=fallbacks)
+        degraded_stages.extend(timed_out)
+        if results['external_info'].get('skipped') and 'external_info' not in degraded_stages:
+            degraded_stages.append('external_info')
+
+        case_analysis = self.record_analyzer.build_analysis(
+            case_id, case_data, **self.record_analyzer.collect_related(results)
+        )
+        return case_analysis, results['external_info']
+
+    def _search_within_deadline(self, subject, description, deadline, degraded_stages, search_memo=None):
+        """
+        外部検索のみを related 段階の予算内で実行
+        """
+        results, timed_out = run_parallel_with_timeout(
+            {'external_info': lambda: self.workflow_advisor.search_external_info(
+                subject, description, deadline=deadline, search_memo=search_memo
+            )},
+            deadline.budget('related'),
+            fallbacks={'external_info': self._skipped_search_results()}
+        )
+        if timed_out or results['external_info'].get('skipped'):
+            degraded_stages.append('external_info')
+        return results['external_info']
+
+    def _skipped_search_results(self):
+        return {'search_query': '', 'results': {}, 'skipped': True}
+
+    def _generate_response(self, case_analysis, search_results, question, deadline, metrics, degraded_stages,
+                           on_token=None):
+        """
+        残り時間に応じて Strands Agent かシンプル版で回答を生成
+
+        Agent が generation 段階の予算内に終わらない場合はシンプル版の回答を返す。
+        GENERATION_MODE=hedged の場合は AGENT_SLO_SECONDS を待ち時間の上限とする。
+
+        Returns:
+            tuple: (回答, 回答の生成元 'agent' / 'simple' / 'provisional')
+        """
+        if not STRANDS_AVAILABLE:
+            verbose(logger, "Using simple response generation (Strands not available)")
+            return self._generate_simple_response(case_analysis, search_results, question), 'simple'
+
+        budget = deadline.budget('generation')
+        if budget < self.agent_min_seconds:
+            logger.warning("Skipping Strands Agent: only %.1fs left", budget)
+            degraded_stages.append('generation')
+            return self._generate_simple_response(case_analysis, search_results, question), 'simple'
+
+        if self.generation_mode == 'hedged':
+            return self._generate_hedged_response(
+                case_analysis, search_results, question, budget, metrics, on_token=on_token
+            )
+
+        verbose(logger, "Using Strands Agent for response generation (budget %.1fs)", budget)
+        run = self._submit_agent(case_analysis, search_results, question, on_token)
+        if run is None:
+            degraded_stages.append('generation')
+            return self._generate_simple_response(case_analysis, search_results, question), 'simple'
+        try:
+            response, source, agent_metrics = run.future.result(timeout=budget)
+        except FutureTimeoutError:
+            # 実行中の Agent は止められないため結果を待たずにシンプル版で回答する
+            logger.warning("Strands Agent exceeded %.1fs budget - using simple response", budget)
+            self._abandon_run(run)
+            degraded_stages.append('generation')
+            return self._generate_simple_response(case_analysis, search_results, question), 'simple'
+
+        if source != 'agent':
+            degraded_stages.append('generation')
+        metrics.update(agent_metrics)
+        return response, source
+
+    def _generate_hedged_response(self, case_analysis, search_results, question, budget, metrics, on_token=None):
+        """
+        シンプル版の回答を先に用意し、Agent の回答が SLO 内に届けばそちらを返す
+
+        間に合わなかった場合はシンプル版を暫定回答として返し、実行中の Agent の
+        結果を保持しておく（同じケース・同じ質問の次のリクエストで返す）。
+        """
+        simple_response = self._generate_simple_response(case_analysis, search_results, question)
+
+        key = self._pending_answer_key(case_analysis, question)
+        run = self.pending_answers.get(key) if key else None
+        if run is not None:
+            logger.info("Waiting for agent answer started by a previous request")
+        else:
+            run = self._submit_agent(case_analysis, search_results, question, on_token)
+            if run is None:
+                return simple_response, 'simple'
+
+        wait_seconds = min(self.agent_slo_seconds, budget)
+        try:
+            response, source, agent_metrics = run.future.result(timeout=wait_seconds)
+        except FutureTimeoutError:
+            logger.warning("Strands Agent missed %.1fs SLO - returning provisional response", wait_seconds)
+            self._abandon_run(run)
+            if key:
+                self.pending_answers.set(key, run)
+            return simple_response, 'provisional'
+
+        if key:
+            self.pending_answers.delete(key)
+        if source != 'agent':
+            # Agent が失敗してシンプル版になった場合は先に用意した回答と同じ扱いにする
+            return simple_response, 'simple'
+        metrics.update(agent_metrics)
+        return response, source
+
+    def _pending_answer_key(self, case_analysis, question):
+        """
+        保留中の Agent 回答のキー（ケースが更新された場合は別のキーになる）
+        """
+        if self.pending_answers is None or case_analysis.get('error'):
+            return None
+        material = json.dumps(
+            [case_analysis.get('case_id'), case_analysis.get('last_modified_date'), ' '.join((question or '').split())],
+            ensure_ascii=False
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _submit_agent(self, case_analysis, search_results, question, on_token=None):
+        """
+        生成用スレッドで Agent を開始し AgentRun を返す
+
+        待つのをやめた Agent が上乗せ分のスレッドを使い切っている場合は、開始しても
+        待ち行列で予算を使い切るだけのため開始せず None を返す。
+        """
+        with self._orphan_lock:
+            orphaned = self._orphaned_runs
+        if orphaned >= self.agent_max_orphans:
+            logger.warning("Agent workers are held by %s abandoned runs - using simple response", orphaned)
+            request_metrics.increment('agent_workers_busy')
+            return None
+
+        run = AgentRun(on_token)
+        run.future = submit_in_context(
+            self._generation_executor, self._run_tracked, run, case_analysis, search_results, question,
+            run.forward_token if on_token is not None else None
+        )
+        return run
+
+    def _run_tracked(self, run, case_analysis, search_results, question, on_token=None):
+        try:
+            return self._run_agent(case_analysis, search_results, question, on_token)
+        finally:
+            with self._orphan_lock:
+                run.done = True
+                if run.orphaned:
+                    self._orphaned_runs -= 1
+
+    def _abandon_run(self, run):
+        """
+        待つのをやめた Agent を記録する（終了するまで新しい Agent の開始を制限する）
+        """
+        run.disconnect()
+        with self._orphan_lock:
+            if not run.done and not run.orphaned:
+                run.orphaned = True
+                self._orphaned_runs += 1
+
+    def _run_agent(self, case_analysis, search_results, question, on_token=None):
+        """
+        Agent で回答を生成し、(回答, 生成元, 生成メトリクス) を返す（生成用スレッドで実行）
+
+        on_token を渡すと、モデルが出力したテキストを逐次通知する。
+        """
+        agent_metrics = {}
+        token_sink = self._get_token_sink()
+        token_sink['sink'] = on_token
+        try:
+            with request_metrics.timer('agent'), tracing.span('agent'):
+                response, source = self._generate_strands_response(
+                    case_analysis, search_results, question, metrics=agent_metrics
+                )
+        finally:
+            token_sink['sink'] = None
+
+        # ツール呼び出しのうちパイプラインの取得結果で済んだ件数
+        memo = current_memo()
+        if memo is not None:
+            agent_metrics['request_memo'] = memo.stats()
+            request_metrics.increment('tool_calls_deduplicated', agent_metrics['request_memo']['tool_deduplicated'])
+        return response, source, agent_metrics
+
     def _generate_simple_response(self, case_analysis, search_results, question):
         """
         シンプルな統合回答を生成（質問に応じた動的な回答）
@@ -250,12 +827,15 @@ class IntegrationManager:
             return "\n".join(response)
 
         except Exception as e:
-            logger.error(f"Simple response generation error: {str(e)}")
+            logger.error("Simple response generation error: %s", e)
             return f"申し訳ございませんが、回答生成でエラーが発生しました。時刻: {time.strftime('%H:%M:%S')}。手動でのサポートをご提供いたします。"
 
-    def _initialize_support_agent(self):
+    def _initialize_support_agent(self, token_sink=None):
         """
         Strands Agent を初期化
+
+        token_sink（{'sink': 関数}）を渡すと、出力テキストをその関数に送る
+        コールバックを設定する。
         """
         try:
             from .strands_tools import get_salesforce_case_details, find_similar_salesforce_cases, search_external_knowledge
@@ -270,71 +850,158 @@ class IntegrationManager:
                 python_repl
             ]
 
-            return Agent(tools=tools)
+            options = {
+                'system_prompt': SUPPORT_SYSTEM_PROMPT,
+                'tools': tools,
+                'callback_handler': self._make_callback_handler(token_sink or {})
+            }
+            model = self._create_model()
+            if model is not None:
+                options['model'] = model
+            return Agent(**options)
         except Exception as e:
-            print(f"Failed to initialize Strands Agent: {str(e)}")
+            logger.error("Failed to initialize Strands Agent: %s", e)
             return None
 
-    def _generate_strands_response(self, case_analysis, search_results, question):
+    def _create_model(self):
         """
-        Strands Agent を使用して回答を生成
+        Bedrock モデルを生成（システムプロンプトとツール定義の後ろにキャッシュポイントを置く）
+
+        BEDROCK_MODEL_ID が未指定の場合は Strands の既定モデルを使用する。
         """
-        try:
-            import time
-            import uuid
-            
-            # 一意なセッションIDを生成して過去のコンテキストを分離
-            session_id = str(uuid.uuid4())[:8]
-            timestamp = int(time.time())
-            
-            # プロンプトの構築（毎回新しいコンテキストとして構築）
-            context_prompt = f"""
-[セッション ID: {session_id}, タイムスタンプ: {timestamp}]
+        if not BEDROCK_MODEL_AVAILABLE:
+            return None
 
-あなたはSalesforceのカスタマーサポートエージェントです。
-これは新しい質問セッションです。過去の回答に依存せず、以下の情報のみを基に、顧客からの質問に対する新しいサポート回答を生成してください。
+        model_id = os.environ.get('BEDROCK_MODEL_ID')
+        prompt_cache = os.environ.get('BEDROCK_PROMPT_CACHE', 'true').lower() == 'true'
+        if not model_id and not prompt_cache:
+            return None
 
-## 現在のケース情報:
-- ケースID: {case_analysis.get('case_id', 'N/A')}
-- 件名: {case_analysis.get('subject', 'N/A')}
-- 説明: {case_analysis.get('description', 'N/A')}
-- 優先度: {case_analysis.get('priority', 'N/A')}
-- ステータス: {case_analysis.get('status', 'N/A')}
-- 顧客: {case_analysis.get('account_name', 'N/A')}
+        config = {}
+        if model_id:
+            config['model_id'] = model_id
+        if prompt_cache:
+            config['cache_prompt'] = 'default'
+            config['cache_tools'] = 'default'
+        logger.info("Bedrock model: %s, prompt cache: %s", model_id or 'default', prompt_cache)
+        return BedrockModel(**config)
 
-## 現在の類似ケース:
-{json.dumps(case_analysis.get('similar_cases', []), ensure_ascii=False, indent=2)}
+    def _extract_model_usage(self, result):
+        """
+        Agent の実行結果からキャッシュ済み・未キャッシュの入力トークン数を取り出す
 
-## 現在の外部検索結果:
-{json.dumps(search_results, ensure_ascii=False, indent=2)}
+        Bedrock の inputTokens にはキャッシュから読み込んだ分・書き込んだ分は含まれない。
+        """
+        metrics = getattr(result, 'metrics', None)
+        usage = getattr(metrics, 'accumulated_usage', None) or {}
 
-## 顧客からの現在の質問:
-{question}
+        input_tokens = usage.get('inputTokens', 0)
+        cache_read = usage.get('cacheReadInputTokens', 0)
+        cache_write = usage.get('cacheWriteInputTokens', 0)
+        total_input = input_tokens + cache_read + cache_write
 
-**重要**: この質問に特化した新しい回答を生成してください。質問の内容に応じて、具体的で実行可能な解決手順を含む回答を作成してください。
-日本語で、顧客に優しく、プロフェッショナルな対応でお答えください。
+        model_usage = {
+            'input_tokens': total_input,
+            'cached_input_tokens': cache_read,
+            'cache_write_input_tokens': cache_write,
+            'uncached_input_tokens': input_tokens + cache_write,
+            'output_tokens': usage.get('outputTokens', 0),
+            'cache_hit_ratio': round(cache_read / total_input, 4) if total_input else 0.0
+        }
+        logger.info("Model usage: %s", model_usage)
+        return model_usage
 
-質問の種類に応じて以下の観点を含めてください：
-- 技術的な問題の場合：トラブルシューティング手順
-- 操作方法の場合：ステップバイステップの説明
-- 設定に関する場合：設定変更の具体的な手順
-- エラーの場合：エラーの原因と解決方法
+    def _make_callback_handler(self, token_sink):
+        """
+        モデルの出力テキスト（data）を token_sink['sink'] に送る Agent コールバック
+        """
+        def handle(**kwargs):
+            sink = token_sink.get('sink')
+            text = kwargs.get('data')
+            if sink is not None and isinstance(text, str) and text:
+                sink(text)
+        return handle
 
-必要に応じて以下のツールを使用してください：
-- get_salesforce_case_details: 追加のケース詳細情報を取得
-- find_similar_salesforce_cases: 異なるキーワードで類似ケースを検索
-- search_external_knowledge: 質問に関連する外部ナレッジベースを検索
+    def _get_token_sink(self):
+        """
+        現在のスレッドの Agent が出力テキストを送る先
+        """
+        token_sink = getattr(self._agent_local, 'token_sink', None)
+        if token_sink is None:
+            token_sink = {'sink': None}
+            self._agent_local.token_sink = token_sink
+        return token_sink
+
+    def _get_support_agent(self):
+        """
+        現在のスレッド用の Strands Agent を取得（未生成の場合のみ初期化）
+        """
+        agent = getattr(self._agent_local, 'agent', None)
+        if agent is None:
+            agent = self._initialize_support_agent(self._get_token_sink())
+            self._agent_local.agent = agent
+        return agent
+
+    def _reset_conversation(self, agent):
+        """
+        再利用する Agent から前回リクエストの会話履歴を取り除く
+        """
+        messages = getattr(agent, 'messages', None)
+        if messages is not None:
+            messages.clear()
+
+    def _generate_strands_response(self, case_analysis, search_results, question, metrics=None):
+        """
+        Strands Agent を使用して回答を生成
+
+        metrics に辞書を渡すと、プロンプトのセクション別トークン使用量を格納する
+
+        Returns:
+            tuple: (回答, 回答の生成元 'agent'、Agent を使えずシンプル版にした場合は 'simple')
+        """
+        try:
+            # コンテキストをトークン予算内に収める（不要な項目の除外・切り詰め）
+            context = self.prompt_builder.build(case_analysis, search_results, question)
+            if metrics is not None:
+                metrics['prompt_usage'] = context.usage
+
+            # 毎回変わるのはケース情報と質問のみ（指示文は SUPPORT_SYSTEM_PROMPT に固定）
+            context_prompt = f"""## 現在のケース情報:
+{context.sections['case']}
+
+## 現在の類似ケース（類似度順、1行1件）:
+{context.sections['similar_cases']}
+
+## 現在の外部検索結果（関連度順、1行1件）:
+{context.sections['external_info']}
+
+## 顧客からの現在の質問:
+{context.sections['question']}
 """
 
-            # Strands Agent で回答生成
-            response = self.support_agent(context_prompt)
+            # Strands Agent で回答生成（会話履歴はリクエスト間で共有しない）
+            agent = self._get_support_agent()
+            if agent is None:
+                return self._generate_simple_response(case_analysis, search_results, question), 'simple'
+            self._reset_conversation(agent)
+            # 記録中は回答と使用量を残す（プロンプトは記録から再構成できるため長さのみ）
+            with recorder.call(recorder.KIND_MODEL, 'agent', {'prompt_chars': len(context_prompt)}) as recorded:
+                response = agent(context_prompt)
+                recorded.response = {
+                    'text': str(response),
+                    'usage': getattr(getattr(response, 'metrics', None), 'accumulated_usage', None)
+                }
+
+            if metrics is not None:
+                metrics['model_usage'] = self._extract_model_usage(response)
 
-            return response
+            return str(response), 'agent'
 
         except Exception as e:
-            logger.error(f"Strands Agent response generation error: {str(e)}")
+            logger.error("Strands Agent response generation error: %s", e)
+            request_metrics.increment('agent_errors')
             # フォールバックとしてシンプル版を使用
-            return self._generate_simple_response(case_analysis, search_results, question)
+            return self._generate_simple_response(case_analysis, search_results, question), 'simple'
 
 
     def _generate_recommendations(self, case_analysis, search_results):
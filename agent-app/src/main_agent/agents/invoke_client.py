@@ -0,0 +1,411 @@
+"""
+Lambda 間呼び出しの共通クライアント
+
+呼び出し先ごとのタイムアウト、スロットリング時のジッター付きリトライ、
+呼び出し先ごとのサーキットブレーカー、レスポンスサイズの上限、
+アクションごとのレイテンシヒストグラムをまとめて扱う。
+"""
+import os
+import json
+import time
+import random
+import logging
+import threading
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, ReadTimeoutError
+
+from common import metrics as request_metrics
+from common import tracing
+from common import recorder
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+THROTTLE_ERROR_CODES = ('TooManyRequestsException', 'ThrottlingException', 'Throttling', 'RequestLimitExceeded')
+
+# ヒストグラムのバケット上限（ミリ秒）
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, float('inf'))
+
+
+class InvokeError(Exception):
+    """
+    Lambda 呼び出しの失敗（呼び出し先と action を保持）
+    """
+
+    def __init__(self, message, function_name=None, action=None):
+        super().__init__(message)
+        self.function_name = function_name
+        self.action = action
+
+
+class InvokeTimeoutError(InvokeError):
+    """
+    呼び出し先のタイムアウト（Lambda 側・クライアント側のどちらも）
+    """
+
+
+class InvokeThrottledError(InvokeError):
+    """
+    リトライしてもスロットリングが解消しなかった
+    """
+
+
+class FunctionError(InvokeError):
+    """
+    呼び出し先の関数内で発生したエラー（errorMessage を返した）
+    """
+
+
+class CircuitOpenError(InvokeError):
+    """
+    サーキットブレーカーが開いているため呼び出しを行わなかった
+    """
+
+
+class ResponseTooLargeError(InvokeError):
+    """
+    レスポンスが上限サイズを超えた
+    """
+
+
+class CircuitBreaker:
+    """
+    連続失敗が閾値に達したら一定時間呼び出しを止める
+
+    reset_seconds 経過後は1件だけ試行（half-open）し、成功すれば再開する。
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                # half-open の試行が失敗した場合も再度開く
+                self.opened_at = time.monotonic()
+
+
+class LatencyHistogram:
+    """
+    固定バケットのレイテンシヒストグラム（パーセンタイルはバケット上限で近似）
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, elapsed_ms):
+        with self._lock:
+            for i, upper in enumerate(self.buckets):
+                if elapsed_ms <= upper:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        threshold = self.count * p / 100.0
+        cumulative = 0
+        for upper, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return self.max_ms if upper == float('inf') else min(upper, self.max_ms)
+        return self.max_ms
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'count': self.count,
+                'avg_ms': round(self.total_ms / self.count, 1) if self.count else 0.0,
+                'p50_ms': round(self.percentile(50), 1),
+                'p95_ms': round(self.percentile(95), 1),
+                'p99_ms': round(self.percentile(99), 1),
+                'max_ms': round(self.max_ms, 1)
+            }
+
+
+class InvokeClient:
+    """
+    RequestResponse 呼び出しの共通処理
+
+    呼び出し先ごとに読み取りタイムアウトを変えた boto3 クライアントを使い分ける。
+    lambda_client を渡した場合（テスト用）は、すべての呼び出し先でそのクライアントを使う。
+    """
+
+    def __init__(self, lambda_client=None, timeouts=None, default_timeout=None, max_retries=None,
+                 max_response_bytes=None, failure_threshold=None, reset_seconds=None):
+        self.lambda_client = lambda_client
+        self.timeouts = dict(timeouts or {})
+        self.default_timeout = default_timeout or float(os.environ.get('INVOKE_TIMEOUT_SECONDS', '25'))
+        self.connect_timeout = float(os.environ.get('INVOKE_CONNECT_TIMEOUT_SECONDS', '3'))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get('INVOKE_MAX_RETRIES', '2'))
+        self.backoff_base = float(os.environ.get('INVOKE_BACKOFF_BASE_SECONDS', '0.2'))
+        self.backoff_max = float(os.environ.get('INVOKE_BACKOFF_MAX_SECONDS', '2'))
+        self.max_response_bytes = max_response_bytes or int(os.environ.get('INVOKE_MAX_RESPONSE_BYTES', str(5 * 1024 * 1024)))
+        self.failure_threshold = failure_threshold or int(os.environ.get('INVOKE_CIRCUIT_FAILURE_THRESHOLD', '5'))
+        self.reset_seconds = reset_seconds or float(os.environ.get('INVOKE_CIRCUIT_RESET_SECONDS', '30'))
+        self.max_pool_connections = int(os.environ.get('INVOKE_MAX_POOL_CONNECTIONS', '20'))
+
+        self._clients = {}
+        self._breakers = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def set_timeout(self, function_name, timeout):
+        """
+        呼び出し先ごとの読み取りタイムアウト（秒）を設定
+        """
+        if function_name:
+            self.timeouts[function_name] = timeout
+
+    def invoke(self, function_name, payload, action=None):
+        """
+        関数を同期呼び出しし、JSON をデコードしたレスポンスを返す
+
+        Raises:
+            CircuitOpenError / InvokeTimeoutError / InvokeThrottledError /
+            ResponseTooLargeError / FunctionError / InvokeError
+        """
+        action = action or payload.get('action') or function_name
+        # 呼び出し先のハンドラーが親スパンを取り出せるよう、ペイロードにトレースコンテキストを入れる
+        with tracing.span(f'invoke {action}', function_name=function_name, action=action):
+            # トラフィックの記録中はトレースコンテキストを除いたペイロードとレスポンスを残す
+            with recorder.call(recorder.KIND_INVOKE, action, payload, target=function_name) as recorded:
+                recorded.response = self._invoke(function_name, tracing.inject_payload(payload), action)
+                return recorded.response
+
+    def _invoke(self, function_name, payload, action):
+        breaker = self._breaker(function_name)
+        if not breaker.allow():
+            raise CircuitOpenError(f'Circuit open for {function_name}', function_name, action)
+
+        started = time.monotonic()
+        try:
+            result = self._invoke_with_retries(function_name, payload, action)
+        except (FunctionError, ResponseTooLargeError) as e:
+            # 関数自体は応答している（業務エラー・過大なレスポンス）ためサーキットは開かない
+            breaker.record_success()
+            self._record_latency(action, started, 'error')
+            raise e
+        except InvokeError as e:
+            breaker.record_failure()
+            self._record_latency(action, started, 'error')
+            raise e
+        except Exception as e:
+            breaker.record_failure()
+            self._record_latency(action, started, 'error')
+            raise InvokeError(f"Invoke failed: {str(e)}", function_name, action) from e
+
+        breaker.record_success()
+        self._record_latency(action, started, 'ok')
+        return result
+
+    def invoke_async(self, function_name, payload):
+        """
+        InvocationType='Event' で非同期に呼び出す（レスポンスは待たない）
+        """
+        self._client(function_name).invoke(
+            FunctionName=function_name,
+            InvocationType='Event',
+            Payload=json.dumps(tracing.inject_payload(payload), ensure_ascii=False)
+        )
+
+    def stats(self):
+        """
+        アクションごとのレイテンシと呼び出し先ごとのサーキット状態
+        """
+        with self._lock:
+            histograms = dict(self._histograms)
+            breakers = dict(self._breakers)
+        return {
+            'latency': {name: histogram.snapshot() for name, histogram in histograms.items()},
+            'circuits': {
+                name: {'state': breaker.state, 'failures': breaker.failures}
+                for name, breaker in breakers.items()
+            }
+        }
+
+    def _invoke_with_retries(self, function_name, payload, action):
+        body = json.dumps(payload, ensure_ascii=False)
+        request_metrics.record_size('invoke_request_bytes', body)
+        attempt = 0
+        while True:
+            try:
+                return self._invoke_once(function_name, body, action)
+            except InvokeThrottledError as e:
+                if attempt >= self.max_retries:
+                    raise e
+                # フルジッター付きの指数バックオフ
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+                attempt += 1
+                request_metrics.increment('invoke_retries')
+                logger.warning("Invoke throttled (%s), retry %s/%s in %.2fs", action, attempt, self.max_retries, delay)
+                time.sleep(delay)
+
+    def _invoke_once(self, function_name, body, action):
+        try:
+            response = self._client(function_name).invoke(
+                FunctionName=function_name,
+                InvocationType='RequestResponse',
+                Payload=body
+            )
+        except ClientError as e:
+            error = e.response.get('Error', {})
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if error.get('Code') in THROTTLE_ERROR_CODES or status == 429:
+                raise InvokeThrottledError(f"Throttled: {error.get('Message', '')}", function_name, action)
+            raise InvokeError(f"Invoke failed: {str(e)}", function_name, action)
+        except ReadTimeoutError as e:
+            raise InvokeTimeoutError(f"Invoke timed out: {str(e)}", function_name, action)
+        except BotoConnectionError as e:
+            raise InvokeError(f"Connection error: {str(e)}", function_name, action)
+
+        raw = response['Payload'].read(self.max_response_bytes + 1)
+        request_metrics.record_size('invoke_response_bytes', raw)
+        if len(raw) > self.max_response_bytes:
+            raise ResponseTooLargeError(
+                f'Response exceeds {self.max_response_bytes} bytes', function_name, action
+            )
+
+        try:
+            result = json.loads(raw) if raw else {}
+        except ValueError as e:
+            raise InvokeError(f"Invalid JSON response: {str(e)}", function_name, action)
+
+        if isinstance(result, dict) and 'errorMessage' in result:
+            message = result['errorMessage']
+            if 'Task timed out' in message:
+                raise InvokeTimeoutError(message, function_name, action)
+            raise FunctionError(message, function_name, action)
+        if response.get('FunctionError'):
+            raise FunctionError(f"Function error: {response['FunctionError']}", function_name, action)
+        return result
+
+    def _client(self, function_name):
+        if self.lambda_client is not None:
+            return self.lambda_client
+
+        timeout = self.timeouts.get(function_name, self.default_timeout)
+        with self._lock:
+            client = self._clients.get(timeout)
+            if client is None:
+                # リトライはこのクラスで制御するため、boto3 側のリトライは無効にする
+                client = boto3.client('lambda', config=Config(
+                    connect_timeout=self.connect_timeout,
+                    read_timeout=timeout,
+                    retries={'total_max_attempts': 1},
+                    max_pool_connections=self.max_pool_connections
+                ))
+                self._clients[timeout] = client
+            return client
+
+    def _breaker(self, function_name):
+        with self._lock:
+            breaker = self._breakers.get(function_name)
+            if breaker is None:
+                breaker = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+                self._breakers[function_name] = breaker
+            return breaker
+
+    def _record_latency(self, action, started, outcome):
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._lock:
+            histogram = self._histograms.get(action)
+            if histogram is None:
+                histogram = LatencyHistogram()
+                self._histograms[action] = histogram
+        histogram.record(elapsed_ms)
+        request_metrics.record(f'invoke_{action}', round(elapsed_ms, 1))
+        logger.debug("Invoke %s %s in %.0fms", action, outcome, elapsed_ms)
+
+
+def create_invoke_client(lambda_client=None):
+    """
+    環境変数の設定に従って InvokeClient を生成
+
+    SERVICE_TRANSPORT=inprocess の場合は、Lambda を経由せずハンドラーを直接呼び出す
+    InProcessTransport を返す（lambda_client を渡した場合は常に Lambda 経由）。
+    SF_API_INVOKE_TIMEOUT_SECONDS / WEB_SEARCH_INVOKE_TIMEOUT_SECONDS で
+    呼び出し先ごとの読み取りタイムアウトを指定できる。
+    """
+    transport = os.environ.get('SERVICE_TRANSPORT', 'lambda').lower()
+    if transport == 'inprocess' and lambda_client is None:
+        from .inprocess_transport import InProcessTransport
+        logger.info("Using in-process service transport")
+        return InProcessTransport()
+
+    client = InvokeClient(lambda_client=lambda_client)
+    client.set_timeout(
+        os.environ.get('SF_API_FUNCTION_NAME', 'sf_api'),
+        float(os.environ.get('SF_API_INVOKE_TIMEOUT_SECONDS', '20'))
+    )
+    client.set_timeout(
+        os.environ.get('WEB_SEARCH_FUNCTION_NAME', 'web_search'),
+        float(os.environ.get('WEB_SEARCH_INVOKE_TIMEOUT_SECONDS', '15'))
+    )
+    return client
+
+
+_invoke_client = None
+_invoke_client_lock = threading.Lock()
+
+
+def get_invoke_client():
+    """
+    コンテナ単位で共有する InvokeClient を取得（遅延初期化）
+    """
+    global _invoke_client
+    if _invoke_client is None:
+        with _invoke_client_lock:
+            if _invoke_client is None:
+                _invoke_client = create_invoke_client()
+    return _invoke_client
+
+
+def set_invoke_client(client):
+    """
+    共有 InvokeClient を差し替える（None で破棄、テスト用）
+    """
+    global _invoke_client
+    with _invoke_client_lock:
+        _invoke_client = client
@@ -0,0 +1,343 @@
+"""
+非同期ジョブ（submit / poll）の状態を保存するストア
+"""
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from decimal import Decimal
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+DEFAULT_SQLITE_PATH = '/tmp/support_jobs.sqlite3'
+
+# DynamoDB の項目サイズ上限（400KB）から request・stages などの分を除いた結果の上限
+DEFAULT_RESULT_MAX_BYTES = 350 * 1024
+
+# 結果が上限を超えた場合に省略する項目（先頭から順に、回答本体は省略しない）
+RESULT_OMIT_ORDER = (
+    ('external_info',),
+    ('case_analysis', 'case_history'),
+    ('case_analysis', 'similar_cases'),
+    ('generation_metrics',),
+)
+
+
+class JobResultTooLargeError(ValueError):
+    """
+    省略できる項目を除いてもジョブの結果が保存先の上限を超える
+    """
+    pass
+
+
+def new_job(request, ttl_seconds=3600):
+    """
+    受付直後のジョブレコードを生成
+    """
+    now = int(time.time())
+    return {
+        'job_id': uuid.uuid4().hex,
+        'status': JOB_QUEUED,
+        'request': request,
+        'stages': {},
+        'created_at': now,
+        'updated_at': now,
+        'expires_at': now + ttl_seconds
+    }
+
+
+class JobStore(ABC):
+    """
+    ジョブ保存先のインターフェース
+
+    ジョブは new_job() が返す辞書で扱い、expires_at（epoch秒）を過ぎたものは
+    存在しないものとして扱う。
+    """
+
+    @abstractmethod
+    def create(self, job):
+        pass
+
+    @abstractmethod
+    def get(self, job_id):
+        pass
+
+    @abstractmethod
+    def update(self, job_id, **fields):
+        pass
+
+    def update_stage(self, job_id, stage, status):
+        """
+        処理段階ごとの進捗を記録
+        """
+        job = self.get(job_id)
+        if job is None:
+            return
+        stages = job.get('stages') or {}
+        stages[stage] = {'status': status, 'updated_at': int(time.time())}
+        self.update(job_id, stages=stages)
+
+    def purge_expired(self):
+        """
+        期限切れのジョブを削除し、削除件数を返す
+        """
+        return 0
+
+
+class MemoryJobStore(JobStore):
+    """
+    プロセス内の辞書に保存（ローカル実行・テスト用）
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        with self._lock:
+            self._jobs[job['job_id']] = json.loads(json.dumps(job))
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['expires_at'] <= time.time():
+                del self._jobs[job_id]
+                return None
+            return json.loads(json.dumps(job))
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            job.update(json.loads(json.dumps(fields)))
+            job['updated_at'] = int(time.time())
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items() if job['expires_at'] <= now]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return len(expired)
+
+
+class SQLiteJobStore(JobStore):
+    """
+    SQLite に保存（同一コンテナ内の別プロセスからも参照できる）
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.environ.get('JOB_SQLITE_PATH', DEFAULT_SQLITE_PATH)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'job_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at INTEGER NOT NULL)'
+        )
+        self._conn.commit()
+
+    def create(self, job):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO jobs (job_id, data, expires_at) VALUES (?, ?, ?)',
+                (job['job_id'], json.dumps(job, ensure_ascii=False), job['expires_at'])
+            )
+            self._conn.commit()
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT data FROM jobs WHERE job_id = ? AND expires_at > ?',
+                (job_id, time.time())
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM jobs WHERE job_id = ?', (job_id,)).fetchone()
+            if row is None:
+                return
+            job = json.loads(row[0])
+            job.update(fields)
+            job['updated_at'] = int(time.time())
+            self._conn.execute(
+                'UPDATE jobs SET data = ? WHERE job_id = ?',
+                (json.dumps(job, ensure_ascii=False), job_id)
+            )
+            self._conn.commit()
+
+    def purge_expired(self):
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM jobs WHERE expires_at <= ?', (time.time(),))
+            self._conn.commit()
+        return cursor.rowcount
+
+
+class DynamoDBJobStore(JobStore):
+    """
+    DynamoDB に保存（Lambda のコンテナ間で共有する本番用）
+
+    テーブルはパーティションキー job_id（文字列）を持ち、expires_at を
+    TTL 属性に設定する。TTL による削除は遅れることがあるため、読み込み時にも
+    期限を確認する。結果はサイズと型の制約を避けるため JSON 文字列で保存し、
+    JOB_RESULT_MAX_BYTES を超える場合は RESULT_OMIT_ORDER の項目を省略する。
+    """
+
+    def __init__(self, table_name=None, dynamodb=None, result_max_bytes=None):
+        import boto3
+
+        self.table_name = table_name or os.environ.get('JOB_TABLE_NAME')
+        self.table = (dynamodb or boto3.resource('dynamodb')).Table(self.table_name)
+        self.result_max_bytes = result_max_bytes or int(
+            os.environ.get('JOB_RESULT_MAX_BYTES', str(DEFAULT_RESULT_MAX_BYTES))
+        )
+
+    def create(self, job):
+        item = dict(job)
+        item['request'] = json.dumps(job.get('request'), ensure_ascii=False)
+        self.table.put_item(Item=item)
+        return job
+
+    def get(self, job_id):
+        item = self.table.get_item(Key={'job_id': job_id}, ConsistentRead=True).get('Item')
+        if item is None:
+            return None
+        job = _from_dynamodb(item)
+        if job['expires_at'] <= time.time():
+            return None
+        for key in ('request', 'result'):
+            if isinstance(job.get(key), str):
+                job[key] = json.loads(job[key])
+        return job
+
+    def update(self, job_id, **fields):
+        fields = dict(fields)
+        if 'result' in fields:
+            fields['result'] = _serialize_result(fields['result'], self.result_max_bytes)
+        fields['updated_at'] = int(time.time())
+
+        names = {f'#f{i}': name for i, name in enumerate(fields)}
+        values = {f':v{i}': value for i, value in enumerate(fields.values())}
+        expression = 'SET ' + ', '.join(f'#f{i} = :v{i}' for i in range(len(fields)))
+        self.table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression=expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values
+        )
+
+    def update_stage(self, job_id, stage, status):
+        # 他の段階の進捗を上書きしないよう、該当段階のみ更新する
+        self.table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET #stages.#stage = :stage, #updated = :now',
+            ExpressionAttributeNames={'#stages': 'stages', '#stage': stage, '#updated': 'updated_at'},
+            ExpressionAttributeValues={
+                ':stage': {'status': status, 'updated_at': int(time.time())},
+                ':now': int(time.time())
+            }
+        )
+
+
+def _serialize_result(result, max_bytes):
+    """
+    結果を JSON 文字列にする（max_bytes を超える場合は省略できる項目を順に除く）
+
+    省略した項目は omitted_fields に記録する。回答本体だけでも上限を超える場合は
+    JobResultTooLargeError を送出する（ジョブは failed として記録される）。
+    """
+    serialized = json.dumps(result, ensure_ascii=False)
+    size = len(serialized.encode('utf-8'))
+    if size <= max_bytes:
+        return serialized
+    if not isinstance(result, dict):
+        raise JobResultTooLargeError(f'Job result is {size} bytes, exceeding the {max_bytes} byte limit')
+
+    original_size = size
+    result = json.loads(serialized)
+    omitted = []
+    for path in RESULT_OMIT_ORDER:
+        parent = result
+        for key in path[:-1]:
+            parent = parent.get(key) if isinstance(parent, dict) else None
+        if not isinstance(parent, dict) or path[-1] not in parent:
+            continue
+        del parent[path[-1]]
+        omitted.append('.'.join(path))
+        result['omitted_fields'] = omitted
+        serialized = json.dumps(result, ensure_ascii=False)
+        size = len(serialized.encode('utf-8'))
+        if size <= max_bytes:
+            logger.warning("Job result shrunk from %s to %s bytes by omitting %s", original_size, size, omitted)
+            return serialized
+
+    raise JobResultTooLargeError(
+        f'Job result is {size} bytes after omitting {", ".join(omitted) or "nothing"}, '
+        f'exceeding the {max_bytes} byte limit'
+    )
+
+
+def _from_dynamodb(value):
+    """
+    DynamoDB の Decimal を int / float に戻す
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {k: _from_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_from_dynamodb(v) for v in value]
+    return value
+
+
+def create_job_store():
+    """
+    JOB_STORE（memory / sqlite / dynamodb）に従ってストアを生成
+    """
+    backend = os.environ.get('JOB_STORE', 'memory').lower()
+    if backend == 'dynamodb':
+        return DynamoDBJobStore()
+    if backend == 'sqlite':
+        return SQLiteJobStore()
+    return MemoryJobStore()
+
+
+_job_store = None
+_job_store_lock = threading.Lock()
+
+
+def get_job_store():
+    """
+    コンテナ単位で共有するジョブストアを取得（遅延初期化）
+    """
+    global _job_store
+    if _job_store is None:
+        with _job_store_lock:
+            if _job_store is None:
+                _job_store = create_job_store()
+                logger.info("Job store: %s", type(_job_store).__name__)
+    return _job_store
+
+
+def set_job_store(store):
+    """
+    共有ジョブストアを差し替える（None で破棄、テスト用）
+    """
+    global _job_store
+    with _job_store_lock:
+        _job_store = store
@@ -0,0 +1,112 @@
+"""
+独立した処理を並列実行するためのヘルパー
+"""
+import logging
+import threading
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+
+def run_parallel(tasks, max_workers=None):
+    """
+    名前付きタスクを並列実行し、登録順に結果を返す
+
+    Args:
+        tasks (dict): タスク名 -> 引数なしの呼び出し可能オブジェクト
+        max_workers (int): 最大スレッド数（省略時はタスク数）
+
+    Returns:
+        dict: タスク名 -> 実行結果（tasks と同じ順序）
+    """
+    if not tasks:
+        return {}
+
+    workers = max_workers or len(tasks)
+    logger.debug("Running %s tasks in parallel: %s", len(tasks), list(tasks.keys()))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: _submit(executor, task) for name, task in tasks.items()}
+        # 完了順ではなく登録順で結果をまとめ、出力を決定的にする
+        return {name: future.result() for name, future in futures.items()}
+
+
+def run_parallel_with_timeout(tasks, timeout, fallbacks=None, max_workers=None):
+    """
+    run_parallel の時間制限付き版
+
+    timeout 秒以内に終わらなかったタスクは結果を待たずに fallbacks の値で
+    置き換える（実行中のスレッドは止められないため、待たずに切り離す）。
+
+    Args:
+        tasks (dict): タスク名 -> 引数なしの呼び出し可能オブジェクト
+        timeout (float): 全タスク共通の待ち時間（秒）
+        fallbacks (dict): タスク名 -> 時間切れ時に使う値
+        max_workers (int): 最大スレッド数（省略時はタスク数）
+
+    Returns:
+        tuple: (タスク名 -> 実行結果, 時間切れになったタスク名のリスト)
+    """
+    if not tasks:
+        return {}, []
+
+    fallbacks = fallbacks or {}
+    executor = ThreadPoolExecutor(max_workers=max_workers or len(tasks))
+    try:
+        futures = {name: _submit(executor, task) for name, task in tasks.items()}
+        wait(futures.values(), timeout=max(timeout, 0))
+
+        results = {}
+        timed_out = []
+        for name, future in futures.items():
+            if future.done():
+                results[name] = future.result()
+            else:
+                future.cancel()
+                timed_out.append(name)
+                results[name] = fallbacks.get(name)
+
+        if timed_out:
+            logger.warning("Tasks exceeded %.1fs budget: %s", timeout, timed_out)
+        return results, timed_out
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _submit(executor, task):
+    # リクエスト単位のコンテキスト（request_context のメモなど）をタスクに引き継ぐ
+    return executor.submit(contextvars.copy_context().run, task)
+
+
+class SingleFlight:
+    """
+    同じキーの処理を1回だけ実行し、結果を共有する
+
+    実行中・実行済みのキーに対する呼び出しは、新たに実行せず同じ結果
+    （例外を含む）を受け取る。バッチ処理など、1つのスコープ内で重複する
+    呼び出しをまとめるために使う。
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.deduplicated = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._futures[key] = future
+            else:
+                self.deduplicated += 1
+
+        if owner:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
@@ -0,0 +1,198 @@
+"""
+トークン予算に収まるようにプロンプトのコンテキスト部分を組み立てる
+"""
+import os
+import json
+import math
+import logging
+
+from common.log import verbose, lazy_json
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+TRUNCATION_MARK = "…"
+
+
+def estimate_tokens(text):
+    """
+    トークン数の概算（日本語などの非 ASCII 文字は1文字1トークン、ASCII は4文字1トークン）
+    """
+    if not text:
+        return 0
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    ascii_chars = len(text) - non_ascii
+    return non_ascii + math.ceil(ascii_chars / 4)
+
+
+def truncate_to_tokens(text, max_tokens):
+    """
+    概算トークン数が max_tokens 以下になるよう末尾を切り詰める
+    """
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text or ""
+    if max_tokens <= 0:
+        return ""
+
+    budget = max_tokens - 1  # 省略記号の分
+    used = 0.0
+    for i, ch in enumerate(text):
+        used += 1.0 if ord(ch) > 127 else 0.25
+        if used > budget:
+            return text[:i] + TRUNCATION_MARK
+    return text
+
+
+def compact_json(value):
+    """
+    インデントや空白を省いた JSON 文字列
+    """
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class PromptContext:
+    """
+    組み立てたセクションとセクションごとのトークン使用量
+    """
+
+    def __init__(self, sections, usage):
+        self.sections = sections
+        self.usage = usage
+
+
+class PromptContextBuilder:
+    """
+    ケース情報・類似ケース・外部検索結果をトークン予算内に収める
+    """
+
+    def __init__(
+        self,
+        token_budget=None,
+        max_similar_cases=5,
+        max_search_results=3,
+        description_tokens=600,
+        similar_description_tokens=120,
+        snippet_tokens=200,
+        answer_tokens=200,
+        question_tokens=500,
+    ):
+        self.token_budget = token_budget or int(os.environ.get("PROMPT_TOKEN_BUDGET", "3000"))
+        self.max_similar_cases = max_similar_cases
+        self.max_search_results = max_search_results
+        self.description_tokens = description_tokens
+        self.similar_description_tokens = similar_description_tokens
+        self.snippet_tokens = snippet_tokens
+        self.answer_tokens = answer_tokens
+        self.question_tokens = question_tokens
+
+    def build(self, case_analysis, search_results, question):
+        """
+        予算内に収めた各セクションを返す
+
+        質問とケース情報を優先して確保し、残りを類似ケースと外部検索結果で分け合う
+        （片方が使い切らなかった分はもう片方に回す）。
+        """
+        question_text = truncate_to_tokens(question or "", self.question_tokens)
+        case_text = self._build_case_section(case_analysis)
+
+        remaining = max(self.token_budget - estimate_tokens(question_text) - estimate_tokens(case_text), 0)
+
+        similar_candidates = self._similar_case_items(case_analysis.get("similar_cases", []))
+        search_candidates = self._search_items(search_results)
+
+        similar_lines = self._fill(similar_candidates, remaining // 2)
+        search_lines = self._fill(search_candidates, remaining - self._tokens(similar_lines))
+        if len(similar_lines) < len(similar_candidates):
+            # 外部検索が使い切らなかった予算で類似ケースを追加
+            similar_lines = self._fill(similar_candidates, remaining - self._tokens(search_lines))
+
+        sections = {
+            "case": case_text,
+            "similar_cases": "\n".join(similar_lines) or "なし",
+            "external_info": "\n".join(search_lines) or "なし",
+            "question": question_text,
+        }
+        usage = {name: estimate_tokens(text) for name, text in sections.items()}
+        usage["total"] = sum(usage.values())
+        usage["budget"] = self.token_budget
+        usage["similar_cases_included"] = len(similar_lines)
+        usage["similar_cases_available"] = len(similar_candidates)
+        usage["search_results_included"] = len(search_lines)
+        usage["search_results_available"] = len(search_candidates)
+
+        verbose(logger, "Prompt context usage: %s", lazy_json(usage))
+        return PromptContext(sections, usage)
+
+    def _tokens(self, lines):
+        return sum(estimate_tokens(line) for line in lines)
+
+    def _fill(self, items, budget):
+        """
+        優先度順の項目を予算に収まるだけ採用
+        """
+        lines = []
+        used = 0
+        for item in items:
+            cost = estimate_tokens(item)
+            if used + cost > budget:
+                break
+            lines.append(item)
+            used += cost
+        return lines
+
+    def _build_case_section(self, case_analysis):
+        lines = [
+            f"- ケースID: {case_analysis.get('case_id', 'N/A')}",
+            f"- 件名: {case_analysis.get('subject') or 'N/A'}",
+            f"- 説明: {truncate_to_tokens(case_analysis.get('description') or 'N/A', self.description_tokens)}",
+            f"- 優先度: {case_analysis.get('priority') or 'N/A'}",
+            f"- ステータス: {case_analysis.get('status') or 'N/A'}",
+            f"- 顧客: {case_analysis.get('account_name') or 'N/A'}",
+        ]
+        return "\n".join(lines)
+
+    def _similar_case_items(self, similar_cases):
+        """
+        類似度の高い順に、回答に必要な項目だけを1行ずつの JSON にする
+        """
+        ranked = sorted(
+            (case for case in similar_cases if isinstance(case, dict) and not case.get("error")),
+            key=lambda case: case.get("similarity") or 0,
+            reverse=True,
+        )
+        items = []
+        for case in ranked[: self.max_similar_cases]:
+            items.append(compact_json({
+                "number": case.get("CaseNumber"),
+                "subject": case.get("Subject"),
+                "status": case.get("Status"),
+                "similarity": case.get("similarity"),
+                "description": truncate_to_tokens(case.get("Description") or "", self.similar_description_tokens),
+            }))
+        return items
+
+    def _search_items(self, search_results):
+        """
+        検索結果の要約とスコアの高い記事を採用（画像などの不要な項目は除外）
+        """
+        payload = (search_results or {}).get("results") or {}
+        if not isinstance(payload, dict):
+            return []
+
+        items = []
+        answer = payload.get("answer")
+        if answer:
+            items.append(compact_json({"summary": truncate_to_tokens(answer, self.answer_tokens)}))
+
+        ranked = sorted(
+            (r for r in payload.get("results", []) if isinstance(r, dict)),
+            key=lambda r: r.get("score") or 0,
+            reverse=True,
+        )
+        for result in ranked[: self.max_search_results]:
+            items.append(compact_json({
+                "title": result.get("title"),
+                "url": result.get("url"),
+                "content": truncate_to_tokens(result.get("content") or "", self.snippet_tokens),
+            }))
+        return items
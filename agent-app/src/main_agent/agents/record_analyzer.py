@@ -1,7 +1,10 @@
-import json
 import os
 import logging
 
+from .request_context import memoize, remember, case_key, similar_cases_key
+from common.log import verbose
+from common.metrics import timed
+
 # ログ設定
 logger = logging.getLogger(__name__)
 
@@ -10,89 +13,183 @@ class RecordAnalyzer:
     Salesforceレコードを分析するエージェント
     """
 
-    def __init__(self, lambda_client):
+    def __init__(self, invoke_client):
         logger.info("Initializing RecordAnalyzer")
-        self.lambda_client = lambda_client
-        self.sf_function_name = os.environ.get('SF_API_FUNCTION_NAME')
-        logger.info(f"SF Function Name: {self.sf_function_name}")
+        self.invoke_client = invoke_client
+        self.sf_function_name = os.environ.get('SF_API_FUNCTION_NAME', 'sf_api')
+        logger.info("SF Function Name: %s", self.sf_function_name)
+
+        # 類似ケースと履歴を analyze_case_bundle アクションで1回の呼び出しにまとめるか
+        self.use_case_bundle = os.environ.get('SF_API_USE_CASE_BUNDLE', 'true').lower() == 'true'
+        logger.info("Use case bundle: %s", self.use_case_bundle)
 
-    def analyze_case(self, case_id):
+        # 残り時間がこれを下回る場合は類似ケース検索を省略する
+        self.similar_cases_min_seconds = float(os.environ.get('SIMILAR_CASES_MIN_SECONDS', '3'))
+
+    @timed('case_fetch')
+    def fetch_case(self, case_id):
         """
-        ケースレコードを分析し、関連情報を取得
+        ケースデータのみを取得（後続処理の起点）
+        """
+        return self._get_case_data(case_id)
+
+    def related_tasks(self, case_id, case_data, deadline=None):
+        """
+        ケースデータ取得後に並列実行できる関連情報取得タスクを返す
+
+        deadline の残り時間が少ない場合は類似ケース検索を省き、履歴のみ取得する。
+        """
+        include_similar = self.can_search_similar(deadline)
+        if not include_similar:
+            logger.warning("Skipping similar case search: not enough time left")
+
+        if self.use_case_bundle:
+            # 類似ケースと履歴は sf_api 側で並列取得させ、呼び出しを1回にまとめる
+            return {
+                'related_records': lambda: self._get_related_bundle(case_id, case_data, include_similar)
+            }
+        tasks = {'case_history': lambda: self._get_case_history(case_id)}
+        if include_similar:
+            tasks['similar_cases'] = lambda: self._find_similar_cases(case_data)
+        return tasks
+
+    def can_search_similar(self, deadline=None):
+        """
+        類似ケース検索に使える時間が残っているか
+        """
+        return deadline is None or deadline.allows(self.similar_cases_min_seconds)
+
+    def related_fallbacks(self):
+        """
+        related_tasks が時間切れになった場合に使う空の結果
+        """
+        if self.use_case_bundle:
+            return {'related_records': {'similar_cases': [], 'case_history': []}}
+        return {'similar_cases': [], 'case_history': []}
+
+    def collect_related(self, results):
+        """
+        related_tasks（またはバンドル）の結果から類似ケースと履歴を取り出す
+        """
+        related = results.get('related_records', results)
+        return {
+            'similar_cases': related.get('similar_cases', []),
+            'case_history': related.get('case_history', [])
+        }
+
+    def build_analysis(self, case_id, case_data, similar_cases, case_history):
+        """
+        取得済みのデータから分析結果をまとめる
+        """
+        verbose(logger, "Assembling case analysis results")
+        analysis = {
+            'case_id': case_id,
+            'subject': case_data.get('Subject', ''),
+            'description': case_data.get('Description', ''),
+            'priority': case_data.get('Priority', ''),
+            'status': case_data.get('Status', ''),
+            'account_name': (case_data.get('Account') or {}).get('Name', ''),
+            'contact_name': (case_data.get('Contact') or {}).get('Name', ''),
+            'product': case_data.get('Product__c', ''),
+            'last_modified_date': case_data.get('LastModifiedDate', ''),
+            'similar_cases': similar_cases,
+            'case_history': case_history
+        }
+
+        verbose(logger, "Case analysis completed successfully")
+        return analysis
+
+    def build_error_analysis(self, case_id, message):
+        """
+        分析失敗時の結果を生成
+        """
+        return {
+            'case_id': case_id,
+            'error': message
+        }
+
+    @timed('case_version')
+    def get_case_version(self, case_id):
+        """
+        ケースの最終更新日時を取得（キャッシュ再検証用）
         """
-        logger.info(f"Starting case analysis for case ID: {case_id}")
-        
         try:
-            # Salesforce API Lambda を呼び出してケース情報を取得
-            logger.info("Fetching case data from Salesforce")
-            case_data = self._get_case_data(case_id)
-            
-            if not case_data:
-                logger.error("No case data received from Salesforce API")
-                return {'case_id': case_id, 'error': 'Case not found or access denied'}
-            
-            logger.info(f"Case data retrieved successfully. Subject: {case_data.get('Subject', 'N/A')}")
-
-            # 関連ケースの検索
-            logger.info("Searching for similar cases")
-            similar_cases = self._find_similar_cases(case_data)
-            logger.info(f"Found {len(similar_cases)} similar cases")
-
-            # 分析結果をまとめる
-            logger.info("Assembling case analysis results")
-            analysis = {
-                'case_id': case_id,
-                'subject': case_data.get('Subject', ''),
-                'description': case_data.get('Description', ''),
-                'priority': case_data.get('Priority', ''),
-                'status': case_data.get('Status', ''),
-                'account_name': case_data.get('Account', {}).get('Name', ''),
-                'contact_name': case_data.get('Contact', {}).get('Name', ''),
-                'product': case_data.get('Product__c', ''),
-                'similar_cases': similar_cases,
-                'case_history': self._get_case_history(case_id)
+            payload = {
+                'action': 'get_case_version',
+                'case_id': case_id
             }
 
-            logger.info("Case analysis completed successfully")
-            return analysis
+            result = self.invoke_client.invoke(self.sf_function_name, payload)
+
+            return result.get('last_modified_date')
 
         except Exception as e:
-            logger.error(f"Case analysis error: {str(e)}", exc_info=True)
-            return {
-                'case_id': case_id,
-                'error': f'ケース分析でエラーが発生しました: {str(e)}'
-            }
+            logger.warning("Error getting case version: %s", e)
+            return None
 
     def _get_case_data(self, case_id):
         """
         Salesforce API Lambdaを呼び出してケースデータを取得
         """
-        logger.debug(f"Getting case data for case ID: {case_id}")
+        logger.debug("Getting case data for case ID: %s", case_id)
         
         try:
             payload = {
                 'action': 'get_case',
                 'case_id': case_id
             }
-            logger.debug(f"Calling SF API Lambda with payload: {payload}")
+            logger.debug("Calling SF API Lambda with payload: %s", payload)
 
-            response = self.lambda_client.invoke(
-                FunctionName=self.sf_function_name,
-                InvocationType='RequestResponse',
-                Payload=json.dumps(payload)
+            # 同じリクエスト内で Agent のツールが同じケースを取得した場合はこの結果を返す
+            case_data = memoize(
+                case_key(case_id),
+                lambda: self.invoke_client.invoke(self.sf_function_name, payload).get('case_data', {})
             )
             logger.debug("SF API Lambda call completed")
 
-            result = json.loads(response['Payload'].read())
-            if 'errorMessage' in result:
-                raise Exception(result['errorMessage'])
-
-            return result.get('case_data', {})
+            return case_data
 
         except Exception as e:
-            print(f"Error getting case data: {str(e)}")
+            logger.error("Error getting case data: %s", e)
             raise e
 
+    @timed('related_records')
+    def _get_related_bundle(self, case_id, case_data, include_similar_cases=True):
+        """
+        取得済みケースに対する類似ケースと履歴を1回の呼び出しで取得
+        """
+        try:
+            payload = {
+                'action': 'analyze_case_bundle',
+                'case_id': case_id,
+                'include_case': False,
+                'include_similar_cases': include_similar_cases,
+                'subject': case_data.get('Subject') or '',
+                'description': case_data.get('Description') or ''
+            }
+
+            result = self.invoke_client.invoke(self.sf_function_name, payload)
+            if include_similar_cases and 'similar_cases' not in result.get('errors', {}):
+                self._remember_similar_cases(case_data, result.get('similar_cases', []))
+
+            return {
+                'similar_cases': result.get('similar_cases', []),
+                'case_history': result.get('case_history', [])
+            }
+
+        except Exception as e:
+            logger.warning("Error getting related records: %s", e)
+            return {'similar_cases': [], 'case_history': []}
+
+    def _remember_similar_cases(self, case_data, similar_cases):
+        """
+        ケースの類似ケースを件名・説明のキーと件名のみのキーでリクエストのメモに登録
+        """
+        subject = case_data.get('Subject')
+        remember(similar_cases_key(subject, case_data.get('Description')), similar_cases)
+        remember(similar_cases_key(subject), similar_cases)
+
+    @timed('similar_cases')
     def _find_similar_cases(self, case_data):
         """
         類似ケースを検索
@@ -101,23 +198,23 @@ class RecordAnalyzer:
             payload = {
                 'action': 'find_similar_cases',
                 'subject': case_data.get('Subject', ''),
+                'description': case_data.get('Description') or '',
                 'product': case_data.get('Product__c', ''),
                 'account_id': case_data.get('AccountId', '')
             }
 
-            response = self.lambda_client.invoke(
-                FunctionName=self.sf_function_name,
-                InvocationType='RequestResponse',
-                Payload=json.dumps(payload)
+            similar_cases = memoize(
+                similar_cases_key(payload['subject'], payload['description']),
+                lambda: self.invoke_client.invoke(self.sf_function_name, payload).get('similar_cases', [])
             )
-
-            result = json.loads(response['Payload'].read())
-            return result.get('similar_cases', [])
+            self._remember_similar_cases(case_data, similar_cases)
+            return similar_cases
 
         except Exception as e:
-            print(f"Error finding similar cases: {str(e)}")
+            logger.warning("Error finding similar cases: %s", e)
             return []
 
+    @timed('case_history')
     def _get_case_history(self, case_id):
         """
         ケースの履歴を取得
@@ -128,15 +225,9 @@ class RecordAnalyzer:
                 'case_id': case_id
             }
 
-            response = self.lambda_client.invoke(
-                FunctionName=self.sf_function_name,
-                InvocationType='RequestResponse',
-                Payload=json.dumps(payload)
-            )
-
-            result = json.loads(response['Payload'].read())
+            result = self.invoke_client.invoke(self.sf_function_name, payload)
             return result.get('case_history', [])
 
         except Exception as e:
-            print(f"Error getting case history: {str(e)}")
+            logger.warning("Error getting case history: %s", e)
             return []
\ No newline at end of file
@@ -0,0 +1,171 @@
+"""
+リクエスト単位で取得済みデータを共有するためのコンテキスト
+
+パイプライン（RecordAnalyzer / WorkflowAdvisor）が取得したケース情報・類似ケース・
+Web 検索結果を引数をキーに保持し、同じリクエスト内の Strands ツール呼び出しで
+同じデータが必要になった場合は呼び出しを行わずに返す。
+現在のリクエストは contextvars で保持するため、スレッドプールで実行する処理には
+submit_in_context などでコンテキストを引き継ぐ。
+"""
+import os
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+from common.log import lazy, verbose
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+SOURCE_PIPELINE = 'pipeline'
+SOURCE_TOOL = 'tool'
+
+_current_memo = contextvars.ContextVar('request_memo', default=None)
+
+
+class RequestMemo:
+    """
+    1リクエスト内の取得結果を引数をキーに保持する
+
+    同じキーの取得が実行中であれば完了を待って結果を共有する（SingleFlight と同様）。
+    失敗した取得は保持せず、次の呼び出しで再取得する。
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._counts = {
+            SOURCE_PIPELINE: {'calls': 0, 'deduplicated': 0},
+            SOURCE_TOOL: {'calls': 0, 'deduplicated': 0}
+        }
+
+    def do(self, key, fn, source=SOURCE_PIPELINE):
+        """
+        key の結果が保持されていればそれを返し、なければ fn() を実行して保持する
+        """
+        with self._lock:
+            counts = self._counts.setdefault(source, {'calls': 0, 'deduplicated': 0})
+            counts['calls'] += 1
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._futures[key] = future
+            else:
+                counts['deduplicated'] += 1
+
+        if owner:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                with self._lock:
+                    self._futures.pop(key, None)
+                future.set_exception(e)
+        elif source == SOURCE_TOOL:
+            logger.info("Tool call served from request memo: %s", key[0])
+        return future.result()
+
+    def put(self, key, value):
+        """
+        別の呼び出しでまとめて取得した結果を key で保持する（保持済みの場合は何もしない）
+        """
+        with self._lock:
+            if key in self._futures:
+                return
+            future = Future()
+            future.set_result(value)
+            self._futures[key] = future
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._futures),
+                'pipeline_calls': self._counts[SOURCE_PIPELINE]['calls'],
+                'pipeline_deduplicated': self._counts[SOURCE_PIPELINE]['deduplicated'],
+                'tool_calls': self._counts[SOURCE_TOOL]['calls'],
+                'tool_deduplicated': self._counts[SOURCE_TOOL]['deduplicated']
+            }
+
+
+def memo_enabled():
+    return os.environ.get('REQUEST_MEMO_ENABLED', 'true').lower() == 'true'
+
+
+@contextmanager
+def request_scope():
+    """
+    リクエスト単位のメモを有効にする
+
+    すでに有効なスコープ内で呼ばれた場合は、外側のメモをそのまま使う。
+    REQUEST_MEMO_ENABLED=false の場合は None を返し、メモは使わない。
+    """
+    memo = _current_memo.get()
+    if memo is not None or not memo_enabled():
+        yield memo
+        return
+
+    memo = RequestMemo()
+    token = _current_memo.set(memo)
+    try:
+        yield memo
+    finally:
+        _current_memo.reset(token)
+        verbose(logger, "Request memo stats: %s", lazy(memo.stats))
+
+
+def current_memo():
+    """
+    現在のリクエストのメモ（スコープ外では None）
+    """
+    return _current_memo.get()
+
+
+def memoize(key, fn, source=SOURCE_PIPELINE):
+    """
+    現在のリクエストのメモを通して fn() を実行する（スコープ外ではそのまま実行）
+    """
+    memo = _current_memo.get()
+    if memo is None:
+        return fn()
+    return memo.do(key, fn, source)
+
+
+def remember(key, value):
+    """
+    現在のリクエストのメモに取得済みの結果を登録する
+    """
+    memo = _current_memo.get()
+    if memo is not None:
+        memo.put(key, value)
+
+
+def submit_in_context(executor, fn, *args, **kwargs):
+    """
+    現在のコンテキスト（リクエストのメモを含む）を引き継いで executor で実行する
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def _normalize(text):
+    return ' '.join((text or '').split()).lower()
+
+
+def case_key(case_id):
+    return ('case', case_id)
+
+
+def similar_cases_key(subject, description=''):
+    """
+    類似ケースのキー
+
+    sf_api の類似ケース検索は製品・取引先では絞り込まないが、説明も重み付けして
+    並べ替えるため、件名と説明をキーにする。分析段階の結果は件名のみのキーにも
+    登録し、説明を渡さないツールの呼び出しにも同じ結果を返す。
+    """
+    return ('similar_cases', _normalize(subject), _normalize(description))
+
+
+def search_key(query, max_results=5):
+    return ('web_search', _normalize(query), int(max_results))
@@ -1,13 +1,13 @@
 """
 Strands Agents用のカスタムツール定義
+
+パイプラインが同じリクエスト内で取得済みのデータは、request_context のメモから返す。
 """
-import json
 import os
-import boto3
 from typing import Dict, Any, List
 
-# Lambda クライアントをグローバルに初期化
-lambda_client = boto3.client('lambda')
+from .invoke_client import get_invoke_client
+from .request_context import memoize, case_key, similar_cases_key, search_key, SOURCE_TOOL
 
 def get_salesforce_case_details(case_id: str) -> Dict[str, Any]:
     """
@@ -20,30 +20,29 @@ def get_salesforce_case_details(case_id: str) -> Dict[str, Any]:
         Dict[str, Any]: ケースの詳細情報
     """
     try:
-        sf_function_name = os.environ.get('SF_API_FUNCTION_NAME')
+        sf_function_name = os.environ.get('SF_API_FUNCTION_NAME', 'sf_api')
         payload = {
             'action': 'get_case',
             'case_id': case_id
         }
 
-        response = lambda_client.invoke(
-            FunctionName=sf_function_name,
-            InvocationType='RequestResponse',
-            Payload=json.dumps(payload)
+        return memoize(
+            case_key(case_id),
+            lambda: get_invoke_client().invoke(sf_function_name, payload).get('case_data', {}),
+            source=SOURCE_TOOL
         )
 
-        result = json.loads(response['Payload'].read())
-        return result.get('case_data', {})
-
     except Exception as e:
         return {'error': f'ケースデータの取得に失敗しました: {str(e)}'}
 
-def find_similar_salesforce_cases(subject: str, product: str = '', account_id: str = '') -> List[Dict]:
+def find_similar_salesforce_cases(subject: str, description: str = '', product: str = '',
+                                  account_id: str = '') -> List[Dict]:
     """
     類似ケースを検索
     
     Args:
         subject (str): ケースの件名
+        description (str): ケースの説明（オプション、類似度の計算に使用）
         product (str): 製品名（オプション）
         account_id (str): アカウントID（オプション）
         
@@ -51,23 +50,21 @@ def find_similar_salesforce_cases(subject: str, product: str = '', account_id: s
         List[Dict]: 類似ケースのリスト
     """
     try:
-        sf_function_name = os.environ.get('SF_API_FUNCTION_NAME')
+        sf_function_name = os.environ.get('SF_API_FUNCTION_NAME', 'sf_api')
         payload = {
             'action': 'find_similar_cases',
             'subject': subject,
+            'description': description,
             'product': product,
             'account_id': account_id
         }
 
-        response = lambda_client.invoke(
-            FunctionName=sf_function_name,
-            InvocationType='RequestResponse',
-            Payload=json.dumps(payload)
+        return memoize(
+            similar_cases_key(subject, description),
+            lambda: get_invoke_client().invoke(sf_function_name, payload).get('similar_cases', []),
+            source=SOURCE_TOOL
         )
 
-        result = json.loads(response['Payload'].read())
-        return result.get('similar_cases', [])
-
     except Exception as e:
         return [{'error': f'類似ケースの検索に失敗しました: {str(e)}'}]
 
@@ -83,20 +80,19 @@ def search_external_knowledge(query: str, max_results: int = 5) -> Dict[str, Any
         Dict[str, Any]: 検索結果
     """
     try:
-        search_function_name = os.environ.get('WEB_SEARCH_FUNCTION_NAME')
+        search_function_name = os.environ.get('WEB_SEARCH_FUNCTION_NAME', 'web_search')
         payload = {
             'query': query,
             'max_results': max_results
         }
 
-        response = lambda_client.invoke(
-            FunctionName=search_function_name,
-            InvocationType='RequestResponse',
-            Payload=json.dumps(payload)
+        return memoize(
+            search_key(query, max_results),
+            lambda: get_invoke_client().invoke(
+                search_function_name, payload, action='web_search'
+            ).get('search_results', {}),
+            source=SOURCE_TOOL
         )
 
-        result = json.loads(response['Payload'].read())
-        return result.get('search_results', {})
-
     except Exception as e:
         return {'error': f'外部検索に失敗しました: {str(e)}'}
\ No newline at end of file
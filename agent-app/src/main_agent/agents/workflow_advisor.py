@@ -1,7 +1,9 @@
-import json
 import os
 import logging
 
+from .request_context import memoize, search_key
+from common.metrics import timed
+
 # ログ設定
 logger = logging.getLogger(__name__)
 
@@ -10,22 +12,40 @@ class WorkflowAdvisor:
     ワークフローの提案と外部情報検索を行うエージェント
     """
 
-    def __init__(self, lambda_client):
+    def __init__(self, invoke_client):
         logger.info("Initializing WorkflowAdvisor")
-        self.lambda_client = lambda_client
-        self.search_function_name = os.environ.get('WEB_SEARCH_FUNCTION_NAME')
-        logger.info(f"Web Search Function Name: {self.search_function_name}")
+        self.invoke_client = invoke_client
+        self.search_function_name = os.environ.get('WEB_SEARCH_FUNCTION_NAME', 'web_search')
+        logger.info("Web Search Function Name: %s", self.search_function_name)
+
+        # 残り時間がこれを下回る場合は外部検索を省略する
+        self.search_min_seconds = float(os.environ.get('EXTERNAL_SEARCH_MIN_SECONDS', '2'))
 
-    def search_external_info(self, subject, description):
+    @timed('external_search')
+    def search_external_info(self, subject, description, deadline=None, search_memo=None):
         """
         外部情報を検索してサポートに役立つ情報を取得
+
+        deadline の残り時間が少ない場合は検索せず、skipped を付けて返す。
+        search_memo（SingleFlight）を渡すと、同じ検索クエリの Web 検索を1回にまとめる。
         """
+        if deadline is not None and not deadline.allows(self.search_min_seconds):
+            logger.warning("Skipping external search: not enough time left")
+            return {
+                'search_query': '',
+                'results': {},
+                'skipped': True
+            }
+
         try:
             # 検索クエリの生成
             search_query = self._generate_search_query(subject, description)
 
             # Web検索の実行
-            search_results = self._perform_web_search(search_query)
+            if search_memo is not None:
+                search_results = search_memo.do(search_query, lambda: self._perform_web_search(search_query))
+            else:
+                search_results = self._perform_web_search(search_query)
 
             return {
                 'search_query': search_query,
@@ -33,7 +53,7 @@ class WorkflowAdvisor:
             }
 
         except Exception as e:
-            print(f"External info search error: {str(e)}")
+            logger.warning("External info search error: %s", e)
             return {
                 'error': f'外部情報検索でエラーが発生しました: {str(e)}'
             }
@@ -72,20 +92,15 @@ class WorkflowAdvisor:
                 'max_results': 5
             }
 
-            response = self.lambda_client.invoke(
-                FunctionName=self.search_function_name,
-                InvocationType='RequestResponse',
-                Payload=json.dumps(payload)
+            return memoize(
+                search_key(query, payload['max_results']),
+                lambda: self.invoke_client.invoke(
+                    self.search_function_name, payload, action='web_search'
+                ).get('search_results', [])
             )
 
-            result = json.loads(response['Payload'].read())
-            if 'errorMessage' in result:
-                raise Exception(result['errorMessage'])
-
-            return result.get('search_results', [])
-
         except Exception as e:
-            print(f"Error performing web search: {str(e)}")
+            logger.warning("Error performing web search: %s", e)
             return []
 
     def generate_workflow_recommendations(self, case_analysis, search_results):
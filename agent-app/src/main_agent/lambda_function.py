@@ -1,31 +1,240 @@
 import json
 import os
+import threading
 import boto3
 import logging
 from agents.integration_manager import IntegrationManager
+from agents.deadline import Deadline
+from agents.invoke_client import get_invoke_client
+from agents.job_store import (
+    get_job_store, new_job, JOB_RUNNING, JOB_SUCCEEDED, JOB_FAILED
+)
+from common.log import configure_logging, bind_request, lazy_json, log_event, verbose
+from common import metrics, tracing
+from common.recorder import record_traffic
 
-# ログ設定
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# ログ設定（JSON 形式、request_id はログ側で付与）
+configure_logging()
+logger = logging.getLogger(__name__)
 
-# ログフォーマット設定
-log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-if len(logger.handlers) == 0:
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(log_format))
-    logger.addHandler(handler)
+# ウォームコンテナ内で再利用する統合マネージャー（初回リクエスト時に生成）
+_integration_manager = None
+_integration_manager_lock = threading.Lock()
 
+
+def get_integration_manager():
+    """
+    コンテナ単位で共有する IntegrationManager を取得（遅延初期化）
+    """
+    global _integration_manager
+    if _integration_manager is None:
+        with _integration_manager_lock:
+            if _integration_manager is None:
+                logger.info("Creating IntegrationManager for this container")
+                _integration_manager = IntegrationManager()
+    return _integration_manager
+
+
+def reset_integration_manager(manager=None):
+    """
+    共有 IntegrationManager を破棄または差し替える（テスト用）
+    """
+    global _integration_manager
+    with _integration_manager_lock:
+        _integration_manager = manager
+
+
+def _response_timings_enabled():
+    return os.environ.get('RESPONSE_TIMINGS', 'false').lower() == 'true'
+
+
+def submit_job(request, context, request_id):
+    """
+    ジョブを登録してバックグラウンド処理を開始し、ジョブレコードを返す
+
+    Lambda 上では自身を InvocationType='Event' で呼び出して処理する（コンテナ間で
+    ジョブを共有できる JOB_STORE=dynamodb が必要）。ローカル実行時はスレッドで処理する。
+    """
+    store = get_job_store()
+    store.purge_expired()
+    job = store.create(new_job(request, ttl_seconds=int(os.environ.get('JOB_TTL_SECONDS', '3600'))))
+    worker_event = {'job_action': 'run', 'job_id': job['job_id'], 'request': request}
+
+    default_dispatch = 'lambda' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else 'thread'
+    dispatch = os.environ.get('JOB_DISPATCH', default_dispatch).lower()
+    if dispatch == 'lambda':
+        function_name = getattr(context, 'invoked_function_arn', None) or os.environ['AWS_LAMBDA_FUNCTION_NAME']
+        get_invoke_client().invoke_async(function_name, worker_event)
+    else:
+        threading.Thread(target=run_job, args=(worker_event, None), daemon=True).start()
+
+    logger.info("Submitted job %s via %s", job['job_id'], dispatch)
+    return job
+
+
+def run_job(event, context):
+    """
+    非同期ジョブの実行（submit_job から呼び出される）
+    """
+    job_id = event['job_id']
+    request = event['request']
+    store = get_job_store()
+    logger.info("Running job %s", job_id)
+    store.update(job_id, status=JOB_RUNNING)
+
+    try:
+        result = get_integration_manager().process_support_request(
+            request['case_id'],
+            request['question'],
+            bypass_cache=bool(request.get('bypass_cache', False)),
+            deadline=Deadline.from_context(context),
+            progress=lambda stage, status: store.update_stage(job_id, stage, status)
+        )
+        store.update(job_id, status=JOB_SUCCEEDED, result=result)
+        logger.info("Job %s succeeded", job_id)
+        return {'job_id': job_id, 'status': JOB_SUCCEEDED}
+
+    except Exception as e:
+        # 非同期呼び出しの自動リトライで同じジョブを再実行しないよう、例外は送出しない
+        logger.error("Job %s failed: %s", job_id, e, exc_info=True)
+        try:
+            store.update(job_id, status=JOB_FAILED, error=str(e))
+        except Exception as update_error:
+            logger.error("Failed to record failure of job %s: %s", job_id, update_error)
+        return {'job_id': job_id, 'status': JOB_FAILED}
+
+
+def iter_stream_events(event, context):
+    """
+    ストリーミングモードのイベントを NDJSON の1行ずつ（bytes）返す
+
+    Lambda のレスポンスストリーミングはマネージド Python ランタイムでは
+    直接使えないため、Lambda Web Adapter の背後で動く stream_server から
+    この関数の出力を順に書き出す。
+    """
+    request_id = context.aws_request_id if context else 'local'
+    bind_request(request_id)
+    try:
+        raw_body = event.get('body', event)
+        body = json.loads(raw_body) if isinstance(raw_body, str) else raw_body
+    except json.JSONDecodeError:
+        body = None
+
+    if not isinstance(body, dict) or not body.get('case_id') or not body.get('question'):
+        logger.error("Invalid streaming request")
+        yield _ndjson_line({'event': 'error', 'data': {'error': 'case_id and question are required', 'request_id': request_id}})
+        return
+
+    logger.info("Streaming support request for case: %s", body['case_id'])
+    stream = get_integration_manager().process_support_request_stream(
+        body['case_id'],
+        body['question'],
+        bypass_cache=bool(body.get('bypass_cache', False)),
+        deadline=Deadline.from_context(context)
+    )
+    for item in stream:
+        yield _ndjson_line(item)
+
+
+def _ndjson_line(item):
+    return (json.dumps(item, ensure_ascii=False) + '\n').encode('utf-8')
+
+
+def _batch_error(headers, request_id, message):
+    """
+    一括処理リクエストの入力エラー（400）
+    """
+    logger.error("Invalid batch request: %s", message)
+    return {
+        'statusCode': 400,
+        'headers': headers,
+        'body': json.dumps({'error': message, 'request_id': request_id})
+    }
+
+
+def _handle_batch(body, headers, deadline, request_id):
+    """
+    case_ids を受け取り、ケースごとの結果をまとめて返す
+
+    質問はケースごとの questions（case_id -> 質問）、なければ共通の question を使う。
+    """
+    case_ids = body.get('case_ids')
+    max_cases = int(os.environ.get('BATCH_MAX_CASES', '50'))
+    if (not isinstance(case_ids, list) or not case_ids or len(case_ids) > max_cases
+            or not all(isinstance(case_id, str) and case_id for case_id in case_ids)):
+        return _batch_error(headers, request_id, f'case_ids must be a non-empty list of at most {max_cases} case IDs')
+
+    questions = body.get('questions') or {}
+    if not isinstance(questions, dict) or not all(
+        isinstance(case_id, str) and isinstance(question, str) for case_id, question in questions.items()
+    ):
+        return _batch_error(headers, request_id, 'questions must be an object mapping case_id to question')
+
+    integration_manager = get_integration_manager()
+    max_concurrency = body.get('max_concurrency')
+    max_allowed = integration_manager.batch_max_concurrency
+    if max_concurrency is not None and (
+        not isinstance(max_concurrency, int) or isinstance(max_concurrency, bool)
+        or not 1 <= max_concurrency <= max_allowed
+    ):
+        return _batch_error(headers, request_id, f'max_concurrency must be an integer between 1 and {max_allowed}')
+
+    items = [
+        {'case_id': case_id, 'question': questions.get(case_id, body.get('question'))}
+        for case_id in case_ids
+    ]
+    logger.info("Processing batch of %s cases", len(items))
+
+    response = integration_manager.process_batch(
+        items,
+        analysis_only=bool(body.get('analysis_only', False)),
+        max_workers=max_concurrency,
+        deadline=deadline,
+        bypass_cache=bool(body.get('bypass_cache', False))
+    )
+    response['request_id'] = request_id
+    return {
+        'statusCode': 200,
+        'headers': headers,
+        'body': json.dumps(response, ensure_ascii=False)
+    }
+
+
+@record_traffic('main_agent')
 def lambda_handler(event, context):
     """
     メインエージェントのエントリーポイント
     """
     request_id = context.aws_request_id if context else 'local'
-    logger.info(f"[{request_id}] Lambda function started")
+    bind_request(request_id)
+    metrics.start_request('main_agent', request_id)
+    # traceparent ヘッダー（または非同期ジョブのペイロード）があればそのトレースを引き継ぐ
+    request_span = tracing.start_request('main_agent', event, request_id=request_id)
+    try:
+        return _handle_request(event, context, request_id)
+    except Exception as e:
+        request_span.record_error(e)
+        raise
+    finally:
+        # 段階ごとの処理時間・サイズ・件数を EMF で出力
+        metrics.flush()
+        tracing.finish_request(request_span)
+
+
+def _handle_request(event, context, request_id):
+    """
+    lambda_handler の本体（計測の開始・出力は lambda_handler で行う）
+    """
+    # 非同期ジョブの実行（API Gateway を経由しない自身からの呼び出し）
+    if event.get('job_action') == 'run':
+        return run_job(event, context)
+
+    # Lambda の残り時間を各処理段階の予算に割り振る
+    deadline = Deadline.from_context(context)
     
     try:
-        # イベント詳細をログ出力
-        logger.info(f"[{request_id}] Received event keys: {list(event.keys())}")
-        logger.debug(f"[{request_id}] Full event: {json.dumps(event, default=str)}")
+        # イベントの詳細は詳細ログでのみ出力する（INFO ではリクエストごとの結果を1行出力）
+        verbose(logger, "Lambda function started. Event: %s", lazy_json(event))
         
         # CORS ヘッダー
         headers = {
@@ -34,40 +243,57 @@ def lambda_handler(event, context):
             'Access-Control-Allow-Methods': 'POST, OPTIONS',
             'Access-Control-Allow-Headers': 'Content-Type'
         }
-        logger.info(f"[{request_id}] CORS headers configured")
 
         # リクエストボディの解析
         if 'body' not in event:
-            logger.error(f"[{request_id}] No body found in event")
+            logger.error("No body found in event")
             return {
                 'statusCode': 400,
                 'headers': headers,
                 'body': json.dumps({'error': 'No body provided', 'request_id': request_id})
             }
 
-        logger.info(f"[{request_id}] Body type: {type(event['body'])}")
-        logger.debug(f"[{request_id}] Raw body content: {event['body']}")
+        verbose(logger, "Raw body (%s): %s", type(event['body']).__name__, event['body'])
         
         # JSONパース処理
         try:
             body = json.loads(event['body']) if isinstance(event['body'], str) else event['body']
-            logger.info(f"[{request_id}] Successfully parsed body with keys: {list(body.keys())}")
-            logger.debug(f"[{request_id}] Parsed body: {body}")
+            verbose(logger, "Successfully parsed body with keys: %s", list(body.keys()))
         except json.JSONDecodeError as e:
-            logger.error(f"[{request_id}] JSON decode error: {str(e)}")
+            logger.error("JSON decode error: %s", e)
             return {
                 'statusCode': 400,
                 'headers': headers,
                 'body': json.dumps({'error': 'Invalid JSON format', 'request_id': request_id})
             }
 
+        # ジョブの状態・結果の取得
+        if body.get('action') == 'get_job':
+            job = get_job_store().get(body.get('job_id') or '')
+            if job is None:
+                logger.info("Job not found: %s", body.get('job_id'))
+                return {
+                    'statusCode': 404,
+                    'headers': headers,
+                    'body': json.dumps({'error': 'Job not found or expired', 'request_id': request_id})
+                }
+            return {
+                'statusCode': 200,
+                'headers': headers,
+                'body': json.dumps(job, ensure_ascii=False)
+            }
+
+        # 複数ケースの一括処理
+        if 'case_ids' in body:
+            return _handle_batch(body, headers, deadline, request_id)
+
         # 必須パラメータのチェック
         required_params = ['case_id', 'question']
         missing_params = [param for param in required_params if param not in body]
         
         if missing_params:
-            logger.error(f"[{request_id}] Missing required parameters: {missing_params}")
-            logger.info(f"[{request_id}] Available parameters: {list(body.keys())}")
+            logger.error("Missing required parameters: %s", missing_params)
+            logger.info("Available parameters: %s", list(body.keys()))
             return {
                 'statusCode': 400,
                 'headers': headers,
@@ -81,34 +307,64 @@ def lambda_handler(event, context):
 
         case_id = body['case_id']
         question = body['question']
-        logger.info(f"[{request_id}] Processing request - Case ID: {case_id}, Question length: {len(question)} chars")
-        logger.debug(f"[{request_id}] Question content: {question}")
+        verbose(logger, "Processing request - Case ID: %s, Question: %s", case_id, question)
 
-        # 統合マネージャーの初期化
-        logger.info(f"[{request_id}] Initializing IntegrationManager")
-        integration_manager = IntegrationManager()
-        logger.info(f"[{request_id}] IntegrationManager initialized successfully")
+        # 非同期モード: ジョブ ID を即座に返し、結果は get_job で取得する
+        if body.get('mode') == 'async':
+            job = submit_job({
+                'case_id': case_id,
+                'question': question,
+                'bypass_cache': bool(body.get('bypass_cache', False))
+            }, context, request_id)
+            return {
+                'statusCode': 202,
+                'headers': headers,
+                'body': json.dumps({
+                    'job_id': job['job_id'],
+                    'status': job['status'],
+                    'request_id': request_id
+                })
+            }
+
+        # 統合マネージャーの取得（ウォームコンテナでは前回のインスタンスを再利用）
+        integration_manager = get_integration_manager()
 
         # AIエージェントによる回答生成
-        logger.info(f"[{request_id}] Starting support request processing")
-        response = integration_manager.process_support_request(case_id, question)
-        logger.info(f"[{request_id}] Support request processing completed")
+        bypass_cache = bool(body.get('bypass_cache', False))
+        response = integration_manager.process_support_request(
+            case_id, question, bypass_cache=bypass_cache, deadline=deadline
+        )
         
         # レスポンス概要をログ出力
-        response_keys = list(response.keys()) if isinstance(response, dict) else []
-        logger.info(f"[{request_id}] Response generated with keys: {response_keys}")
+        verbose(logger, "Response generated with keys: %s", list(response.keys()))
+
+        # 段階ごとの処理時間をレスポンスに含める（include_timings または RESPONSE_TIMINGS=true）
+        request_metrics = metrics.current_metrics()
+        if request_metrics is not None and (body.get('include_timings') or _response_timings_enabled()):
+            response['timings'] = dict(request_metrics.timings(), total_ms=request_metrics.elapsed_ms())
 
+        response_body = json.dumps(response, ensure_ascii=False)
+        metrics.record_size('response_bytes', response_body)
         final_response = {
             'statusCode': 200,
             'headers': headers,
-            'body': json.dumps(response, ensure_ascii=False)
+            'body': response_body
         }
         
-        logger.info(f"[{request_id}] Lambda function completed successfully")
+        log_event(
+            logger, logging.INFO, "Lambda function completed successfully",
+            case_id=case_id,
+            question_chars=len(question),
+            response_source=response.get('response_source'),
+            partial=response.get('partial'),
+            invoke=get_invoke_client().stats
+        )
         return final_response
 
     except Exception as e:
-        logger.error(f"[{request_id}] Unhandled error: {str(e)}", exc_info=True)
+        logger.error("Unhandled error: %s", e, exc_info=True)
+        metrics.increment('errors')
+        tracing.current_span().record_error(e)
         return {
             'statusCode': 500,
             'headers': {
@@ -0,0 +1,3 @@
+#!/bin/sh
+# Lambda Web Adapter から起動するストリーミング用サーバー
+exec python3 stream_server.py
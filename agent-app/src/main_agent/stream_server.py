@@ -0,0 +1,95 @@
+"""
+ストリーミング用の HTTP サーバー（Lambda Web Adapter から起動）
+
+マネージド Python ランタイムはレスポンスストリーミングに対応していないため、
+Lambda Web Adapter（AWS_LWA_INVOKE_MODE=response_stream）の背後でこのサーバーを
+起動し、Function URL（RESPONSE_STREAM）へのリクエストに NDJSON のイベントを
+チャンク転送で1行ずつ返す。ケース情報などはケース取得直後にクライアントへ届く。
+"""
+import os
+import json
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lambda_function import iter_stream_events
+from common import metrics, tracing
+
+# ログ設定（configure_logging は lambda_function の読み込み時に実行済み）
+logger = logging.getLogger(__name__)
+
+
+class AdapterContext:
+    """
+    Lambda Web Adapter が渡す x-amzn-lambda-context ヘッダーから作る Lambda コンテキスト相当
+    """
+
+    def __init__(self, header):
+        try:
+            data = json.loads(header) if header else {}
+        except json.JSONDecodeError:
+            data = {}
+        self.aws_request_id = data.get('request_id') or 'local'
+        self._deadline_ms = data.get('deadline')
+
+    def get_remaining_time_in_millis(self):
+        if not self._deadline_ms:
+            return int(float(os.environ.get('REQUEST_TIMEOUT_SECONDS', '60')) * 1000)
+        return max(0, int(self._deadline_ms - time.time() * 1000))
+
+
+class StreamRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # Lambda Web Adapter の起動確認（AWS_LWA_READINESS_CHECK_PATH）
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        event = {
+            'headers': {name.lower(): value for name, value in self.headers.items()},
+            'body': self.rfile.read(length).decode('utf-8')
+        }
+        context = AdapterContext(self.headers.get('x-amzn-lambda-context'))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        metrics.start_request('main_agent', context.aws_request_id)
+        request_span = tracing.start_request('main_agent', event, request_id=context.aws_request_id)
+        try:
+            for line in iter_stream_events(event, context):
+                self._write_chunk(line)
+            self._write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning("Stream client disconnected")
+        except Exception as e:
+            request_span.record_error(e)
+            logger.error("Streaming request failed: %s", e, exc_info=True)
+        finally:
+            metrics.flush()
+            tracing.finish_request(request_span)
+
+    def _write_chunk(self, data):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        # アクセスログはアプリケーションのログに含めない
+        pass
+
+
+def main():
+    port = int(os.environ.get('PORT', '8080'))
+    server = ThreadingHTTPServer(('127.0.0.1', port), StreamRequestHandler)
+    logger.info("Stream server listening on port %s", port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,498 @@
+"""
+類似ケース検索用のローカルインデックス
+
+ケースの件名・説明の文字 n-gram をハッシュ化したベクトル（CSR 形式）と
+n-gram -> ケースの転置インデックスをディスクに保存し、読み込み時はメモリマップする。
+Case オブジェクトの LastModifiedDate の差分で増分同期し、変更分はデルタとして
+保持したうえで一定件数を超えたら全体を再構築（コンパクション）する。
+同期はスケジュール実行の sync_case_index アクションでのみ行い、検索する側は
+保存済みのインデックスを読み込むだけにする（case_index_store で S3 と共有）。
+"""
+import os
+import json
+import time
+import zlib
+import shutil
+import logging
+import tempfile
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+from similarity import char_ngrams, normalize_text
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+DEFAULT_INDEX_DIR = "/tmp/similar_case_index"
+STATE_FILE = "state.json"
+
+# インデックスに保存し、類似ケースとして返すフィールド
+RECORD_FIELDS = ("Id", "CaseNumber", "Subject", "Status", "Priority", "CreatedDate", "Description")
+
+_ARRAY_NAMES = ("vec_indptr", "vec_indices", "vec_data", "terms", "post_indptr", "post_docs")
+
+
+def _to_soql_datetime(value):
+    """
+    Salesforce の日時文字列（例: 2024-01-01T00:00:00.000+0000）を SOQL の日時リテラルに変換
+    """
+    parsed = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z")
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class CaseIndex:
+    """
+    メモリマップされたベースセグメントとメモリ上のデルタからなる類似ケースインデックス
+    """
+
+    def __init__(
+        self,
+        directory,
+        ngram_range=(2, 3),
+        hash_bits=20,
+        description_weight=0.5,
+        max_description_chars=2000,
+        compact_threshold=500,
+    ):
+        self.directory = directory
+        self.ngram_range = ngram_range
+        self.hash_mask = (1 << hash_bits) - 1
+        self.description_weight = description_weight
+        self.max_description_chars = max_description_chars
+        self.compact_threshold = compact_threshold
+
+        self.lock = threading.RLock()
+        # 同期（Salesforce からの取得を含む）を1つずつ行うためのロック（検索は止めない）
+        self.sync_lock = threading.Lock()
+        self._reset_state()
+
+    def reset(self):
+        """
+        メモリ上のインデックスを空にする（ディスク上の世代は rebuild で置き換える）
+        """
+        with self.lock:
+            self._reset_state()
+
+    def _reset_state(self):
+        self.generation = None
+        self.watermark = None
+        self.synced_at = 0.0
+        self.state_mtime = None
+
+        # ベースセグメント（メモリマップ）
+        self.records = []
+        self.base_rows = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.arrays = {}
+
+        # デルタ（ベース作成後に追加・更新されたケース）と削除済み ID
+        self.delta = {}
+        self.deleted_ids = set()
+
+    # ------------------------------------------------------------------
+    # 状態
+    # ------------------------------------------------------------------
+
+    @property
+    def ready(self):
+        return self.watermark is not None and (bool(self.records) or bool(self.delta))
+
+    @property
+    def size(self):
+        return int(self.alive.sum()) + len(self.delta)
+
+    @property
+    def age_seconds(self):
+        return time.time() - self.synced_at
+
+    def _state_path(self):
+        return os.path.join(self.directory, STATE_FILE)
+
+    # ------------------------------------------------------------------
+    # ベクトル化
+    # ------------------------------------------------------------------
+
+    def _clean_record(self, record):
+        cleaned = {field: record.get(field) for field in RECORD_FIELDS}
+        if cleaned["Description"]:
+            cleaned["Description"] = cleaned["Description"][: self.max_description_chars]
+        return cleaned
+
+    def _vectorize(self, subject, description):
+        """
+        件名・説明をハッシュ化した n-gram の (昇順の語彙, L2 正規化済み重み) に変換
+        """
+        counts = Counter()
+        for gram in char_ngrams(normalize_text(subject), self.ngram_range):
+            counts[zlib.crc32(gram.encode("utf-8")) & self.hash_mask] += 1.0
+        if description:
+            text = normalize_text(description)[: self.max_description_chars]
+            for gram in char_ngrams(text, self.ngram_range):
+                counts[zlib.crc32(gram.encode("utf-8")) & self.hash_mask] += self.description_weight
+
+        if not counts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        terms = np.fromiter(sorted(counts), dtype=np.int64, count=len(counts))
+        weights = np.log1p(np.array([counts[t] for t in terms.tolist()], dtype=np.float64))
+        weights /= np.linalg.norm(weights)
+        return terms, weights.astype(np.float32)
+
+    # ------------------------------------------------------------------
+    # 検索
+    # ------------------------------------------------------------------
+
+    def search(self, subject, description="", limit=100, candidate_pool=500, max_df_ratio=0.2):
+        """
+        件名・説明に近いケースをスコア順に最大 limit 件返す
+        """
+        with self.lock:
+            q_terms, q_weights = self._vectorize(subject or "", description or "")
+            if len(q_terms) == 0:
+                return []
+
+            scored = self._search_base(q_terms, q_weights, candidate_pool, max_df_ratio)
+            scored.extend(self._search_delta(q_terms, q_weights))
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [dict(record) for _, record in scored[:limit]]
+
+    def _gather(self, indptr, rows):
+        """
+        CSR の指定行に含まれる要素位置と、それぞれが属する行番号を返す
+        """
+        starts = np.asarray(indptr[rows], dtype=np.int64)
+        lengths = np.asarray(indptr[rows + 1], dtype=np.int64) - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+        owners = np.repeat(np.arange(len(rows)), lengths)
+        return offsets, owners
+
+    def _search_base(self, q_terms, q_weights, candidate_pool, max_df_ratio):
+        if not self.records:
+            return []
+
+        terms = self.arrays["terms"]
+        post_indptr = self.arrays["post_indptr"]
+
+        # 転置インデックスで候補を絞り込む（ほぼ全件に出現する n-gram は除外）
+        pos = np.searchsorted(terms, q_terms)
+        in_range = pos < len(terms)
+        matched = np.zeros(len(q_terms), dtype=bool)
+        matched[in_range] = terms[pos[in_range]] == q_terms[in_range]
+        term_rows = pos[matched]
+        if len(term_rows) == 0:
+            return []
+
+        df = np.asarray(post_indptr[term_rows + 1]) - np.asarray(post_indptr[term_rows])
+        selective = df <= max(1, int(len(self.records) * max_df_ratio))
+        if selective.any():
+            term_rows = term_rows[selective]
+
+        offsets, _ = self._gather(post_indptr, term_rows)
+        rows, overlaps = np.unique(np.asarray(self.arrays["post_docs"][offsets]), return_counts=True)
+        keep = self.alive[rows]
+        rows, overlaps = rows[keep], overlaps[keep]
+        if len(rows) > candidate_pool:
+            top = np.argsort(-overlaps, kind="stable")[:candidate_pool]
+            rows = rows[top]
+        if len(rows) == 0:
+            return []
+
+        # 候補のみコサイン類似度を正確に計算
+        offsets, owners = self._gather(self.arrays["vec_indptr"], rows)
+        doc_terms = np.asarray(self.arrays["vec_indices"][offsets], dtype=np.int64)
+        doc_weights = np.asarray(self.arrays["vec_data"][offsets], dtype=np.float64)
+        q_pos = np.minimum(np.searchsorted(q_terms, doc_terms), len(q_terms) - 1)
+        hit = q_terms[q_pos] == doc_terms
+        contrib = np.where(hit, doc_weights * q_weights[q_pos], 0.0)
+        scores = np.bincount(owners, weights=contrib, minlength=len(rows))
+
+        return [(float(score), self.records[row]) for row, score in zip(rows.tolist(), scores.tolist()) if score > 0]
+
+    def _search_delta(self, q_terms, q_weights):
+        scored = []
+        for record, terms, weights in self.delta.values():
+            if len(terms) == 0:
+                continue
+            common, q_idx, d_idx = np.intersect1d(q_terms, terms, assume_unique=True, return_indices=True)
+            if len(common):
+                score = float(np.dot(q_weights[q_idx], weights[d_idx]))
+                if score > 0:
+                    scored.append((score, record))
+        return scored
+
+    # ------------------------------------------------------------------
+    # 更新
+    # ------------------------------------------------------------------
+
+    def apply_changes(self, records):
+        """
+        変更・削除されたケースをデルタに反映し、最新の LastModifiedDate を返す
+        """
+        latest = self.watermark
+        with self.lock:
+            for record in records:
+                case_id = record.get("Id")
+                if not case_id:
+                    continue
+
+                if case_id in self.base_rows:
+                    self.alive[self.base_rows[case_id]] = False
+                    self.deleted_ids.add(case_id)
+
+                if record.get("IsDeleted"):
+                    self.delta.pop(case_id, None)
+                else:
+                    cleaned = self._clean_record(record)
+                    terms, weights = self._vectorize(cleaned["Subject"] or "", cleaned["Description"] or "")
+                    self.delta[case_id] = (cleaned, terms, weights)
+
+                modified = record.get("LastModifiedDate")
+                if modified and (latest is None or modified > latest):
+                    latest = modified
+        return latest
+
+    def sync(self, client, max_records=2000):
+        """
+        前回同期以降に変更されたケースを取得してインデックスに反映
+
+        Returns:
+            dict: 取得件数と、上限に達して未同期分が残っているか
+        """
+        since = _to_soql_datetime(self.watermark) if self.watermark else None
+        records = client.get_changed_cases(since, max_records)
+        logger.info("Case index sync fetched %s changed cases (since=%s)", len(records), since)
+
+        with self.lock:
+            latest = self.apply_changes(records)
+            self.watermark = latest or self.watermark or datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000+0000")
+            self.synced_at = time.time()
+
+            if len(self.delta) + len(self.deleted_ids) >= self.compact_threshold:
+                self.compact()
+            else:
+                self._write_state()
+
+        return {"fetched": len(records), "pending": len(records) >= max_records, "size": self.size}
+
+    def sync_batches(self, client, max_records=2000, max_batches=10):
+        """
+        未同期分が無くなるか max_batches 回に達するまで sync を繰り返す
+        """
+        total = 0
+        result = {"pending": False}
+        for _ in range(max_batches):
+            result = self.sync(client, max_records=max_records)
+            total += result["fetched"]
+            if not result["pending"]:
+                break
+        return {"fetched": total, "pending": result["pending"], "size": self.size, "watermark": self.watermark}
+
+    def rebuild(self, client, max_records=2000, max_batches=10):
+        """
+        空の状態から全件を取得して新しい世代を作成し、以前の世代を削除する
+        """
+        with self.sync_lock:
+            previous_generation = self.generation
+            self.reset()
+            result = self.sync_batches(client, max_records, max_batches)
+
+            with self.lock:
+                # 同期中にコンパクションされていなければ（件数が少ない・0件の場合も）ここで世代を書き出す
+                if self.generation is None or self.delta or self.deleted_ids:
+                    self.compact()
+            if previous_generation and previous_generation != self.generation:
+                shutil.rmtree(os.path.join(self.directory, previous_generation), ignore_errors=True)
+
+            result["size"] = self.size
+            return result
+
+    def compact(self):
+        """
+        ベースの有効行とデルタを統合して新しい世代のセグメントを作成
+        """
+        with self.lock:
+            records, terms_list, weights_list = [], [], []
+
+            if self.records:
+                indptr = self.arrays["vec_indptr"]
+                for row in np.flatnonzero(self.alive).tolist():
+                    start, end = int(indptr[row]), int(indptr[row + 1])
+                    records.append(self.records[row])
+                    terms_list.append(np.asarray(self.arrays["vec_indices"][start:end], dtype=np.int64))
+                    weights_list.append(np.asarray(self.arrays["vec_data"][start:end], dtype=np.float32))
+
+            for record, terms, weights in self.delta.values():
+                records.append(record)
+                terms_list.append(terms)
+                weights_list.append(weights)
+
+            lengths = np.array([len(t) for t in terms_list], dtype=np.int64)
+            vec_indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            vec_indices = np.concatenate(terms_list) if terms_list else np.zeros(0, dtype=np.int64)
+            vec_data = np.concatenate(weights_list) if weights_list else np.zeros(0, dtype=np.float32)
+
+            # 転置インデックス: n-gram ごとの出現ケース行
+            owners = np.repeat(np.arange(len(records), dtype=np.int32), lengths)
+            order = np.argsort(vec_indices, kind="stable")
+            sorted_terms = vec_indices[order]
+            terms, starts = np.unique(sorted_terms, return_index=True)
+            post_indptr = np.concatenate([starts, [len(sorted_terms)]]).astype(np.int64)
+            post_docs = owners[order]
+
+            generation = f"gen-{int(time.time() * 1000)}"
+            arrays = {
+                "vec_indptr": vec_indptr,
+                "vec_indices": vec_indices.astype(np.int64),
+                "vec_data": vec_data.astype(np.float32),
+                "terms": terms.astype(np.int64),
+                "post_indptr": post_indptr,
+                "post_docs": post_docs.astype(np.int32),
+            }
+            self._write_generation(generation, records, arrays)
+
+            previous = self.generation
+            self.generation = generation
+            self.delta = {}
+            self.deleted_ids = set()
+            self._write_state()
+            self._load_generation(generation)
+
+            if previous and previous != generation:
+                shutil.rmtree(os.path.join(self.directory, previous), ignore_errors=True)
+
+            logger.info("Case index compacted into %s with %s cases", generation, len(records))
+
+    # ------------------------------------------------------------------
+    # 永続化
+    # ------------------------------------------------------------------
+
+    def _write_generation(self, generation, records, arrays):
+        path = os.path.join(self.directory, generation)
+        os.makedirs(path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, f"{name}.npy"), array)
+        with open(os.path.join(path, "records.json"), "w", encoding="utf-8") as f:
+            json.dump(records, f, ensure_ascii=False)
+
+    def _write_state(self):
+        """
+        世代・ウォーターマーク・デルタを1ファイルにまとめて原子的に書き込む
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        state = {
+            "version": INDEX_VERSION,
+            "generation": self.generation,
+            "watermark": self.watermark,
+            "synced_at": self.synced_at,
+            "delta": [record for record, _, _ in self.delta.values()],
+            "deleted_ids": sorted(self.deleted_ids),
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, self._state_path())
+        self.state_mtime = os.stat(self._state_path()).st_mtime_ns
+
+    def _load_generation(self, generation):
+        path = os.path.join(self.directory, generation)
+        self.arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in _ARRAY_NAMES
+        }
+        with open(os.path.join(path, "records.json"), "r", encoding="utf-8") as f:
+            self.records = json.load(f)
+        self.base_rows = {record["Id"]: row for row, record in enumerate(self.records)}
+        self.alive = np.ones(len(self.records), dtype=bool)
+
+    def load(self):
+        """
+        ディスク上の状態を読み込む（インデックスが無い場合は False）
+        """
+        with self.lock:
+            try:
+                with open(self._state_path(), "r", encoding="utf-8") as f:
+                    state = json.load(f)
+                mtime = os.stat(self._state_path()).st_mtime_ns
+            except FileNotFoundError:
+                return False
+
+            if state.get("version") != INDEX_VERSION:
+                logger.warning("Ignoring case index with unsupported version: %s", state.get('version'))
+                return False
+
+            self._reset_state()
+            if state.get("generation"):
+                self._load_generation(state["generation"])
+            self.generation = state.get("generation")
+            self.watermark = state.get("watermark")
+            self.synced_at = state.get("synced_at", 0.0)
+            self.state_mtime = mtime
+
+            for case_id in state.get("deleted_ids", []):
+                self.deleted_ids.add(case_id)
+                if case_id in self.base_rows:
+                    self.alive[self.base_rows[case_id]] = False
+            for record in state.get("delta", []):
+                terms, weights = self._vectorize(record.get("Subject") or "", record.get("Description") or "")
+                self.delta[record["Id"]] = (record, terms, weights)
+
+            logger.info(
+                "Loaded case index (generation=%s, size=%s, watermark=%s)",
+                self.generation, self.size, self.watermark
+            )
+            return True
+
+    def reload_if_changed(self):
+        """
+        他プロセス（共有ディレクトリ利用時）が更新していれば読み直す
+        """
+        try:
+            mtime = os.stat(self._state_path()).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime != self.state_mtime:
+            return self.load()
+        return False
+
+
+_case_index = None
+_case_index_lock = threading.Lock()
+
+
+def get_case_index():
+    """
+    コンテナ内で共有する CaseIndex を取得（NumPy が無い・無効化時は None）
+    """
+    global _case_index
+    if not NUMPY_AVAILABLE:
+        return None
+    if os.environ.get("SIMILAR_CASE_INDEX_ENABLED", "false").lower() != "true":
+        return None
+
+    if _case_index is None:
+        with _case_index_lock:
+            if _case_index is None:
+                index = CaseIndex(os.environ.get("SIMILAR_CASE_INDEX_DIR", DEFAULT_INDEX_DIR))
+                index.load()
+                _case_index = index
+    return _case_index
+
+
+def reset_case_index():
+    """
+    共有 CaseIndex を破棄（テスト用）
+    """
+    global _case_index
+    with _case_index_lock:
+        _case_index = None
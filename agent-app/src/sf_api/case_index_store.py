@@ -0,0 +1,179 @@
+"""
+類似ケースインデックスの共有先（S3）
+
+インデックスはスケジュール実行の sync_case_index アクションだけが Salesforce から
+同期し、作成した世代と状態ファイルを S3 に置く。検索するコンテナは同期を行わず、
+一定間隔で S3 の状態ファイルを確認して新しい世代があればダウンロードして読み込む。
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+from case_index import STATE_FILE
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFIX = "similar_case_index/"
+
+# S3 に残す世代数（ダウンロード中のコンテナのため、1つ前の世代も残す）
+KEEP_GENERATIONS = 2
+
+
+def _error_code(error):
+    return str(getattr(error, "response", {}).get("Error", {}).get("Code", ""))
+
+
+class S3IndexStore:
+    """
+    CaseIndex のディレクトリを S3 と同期する
+    """
+
+    def __init__(self, bucket, prefix=DEFAULT_PREFIX, check_interval=300, s3_client=None):
+        self.bucket = bucket
+        self.prefix = prefix if prefix.endswith("/") else prefix + "/"
+        self.check_interval = check_interval
+        self._s3 = s3_client
+        self._etag = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _client(self):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client("s3")
+        return self._s3
+
+    def _key(self, *parts):
+        return self.prefix + "/".join(parts)
+
+    def pull(self, index, force=False):
+        """
+        S3 の状態ファイルが更新されていれば世代をダウンロードしてインデックスを読み直す
+
+        確認は check_interval 秒に1回（force=True の場合は常に確認）。
+        読み直した場合は True を返す。
+        """
+        now = time.time()
+        with self._lock:
+            if not force and self._checked_at is not None and now - self._checked_at < self.check_interval:
+                return False
+            self._checked_at = now
+
+            params = {"Bucket": self.bucket, "Key": self._key(STATE_FILE)}
+            if self._etag and not force:
+                params["IfNoneMatch"] = self._etag
+            try:
+                response = self._client().get_object(**params)
+            except Exception as e:
+                code = _error_code(e)
+                if code in ("304", "NotModified"):
+                    return False
+                if code in ("404", "NoSuchKey"):
+                    logger.info("Similar case index has not been published to s3://%s/%s yet", self.bucket, self.prefix)
+                    return False
+                raise
+
+            state = json.loads(response["Body"].read())
+            generation = state.get("generation")
+            if generation:
+                self._download_generation(index.directory, generation)
+            self._write_local_state(index.directory, state)
+            self._etag = response.get("ETag")
+            return index.load()
+
+    def _download_generation(self, directory, generation):
+        path = os.path.join(directory, generation)
+        if os.path.isdir(path):
+            return
+
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=directory, prefix=".download-")
+        try:
+            paginator = self._client().get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(generation, "")):
+                for item in page.get("Contents", []):
+                    name = item["Key"].rsplit("/", 1)[-1]
+                    self._client().download_file(self.bucket, item["Key"], os.path.join(tmp_path, name))
+            os.replace(tmp_path, path)
+            logger.info("Downloaded similar case index %s", generation)
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        # 読み込まなくなった古い世代を削除
+        for name in os.listdir(directory):
+            if name.startswith("gen-") and name != generation:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    def _write_local_state(self, directory, state):
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(directory, STATE_FILE))
+
+    def push(self, index):
+        """
+        ローカルの世代（未アップロードの場合）と状態ファイルを S3 に置き、古い世代を削除する
+
+        状態ファイルは世代のアップロード後に置くため、読み込む側が未完成の世代を参照することはない。
+        """
+        client = self._client()
+        with index.lock:
+            generation = index.generation
+            if generation:
+                path = os.path.join(index.directory, generation)
+                existing = client.list_objects_v2(Bucket=self.bucket, Prefix=self._key(generation, ""), MaxKeys=1)
+                if not existing.get("KeyCount"):
+                    for name in sorted(os.listdir(path)):
+                        client.upload_file(os.path.join(path, name), self.bucket, self._key(generation, name))
+                    logger.info("Uploaded similar case index %s", generation)
+            client.upload_file(os.path.join(index.directory, STATE_FILE), self.bucket, self._key(STATE_FILE))
+
+        self._delete_old_generations(generation)
+
+    def _delete_old_generations(self, current):
+        client = self._client()
+        listing = client.list_objects_v2(Bucket=self.bucket, Prefix=self.prefix, Delimiter="/")
+        generations = sorted(
+            item["Prefix"][len(self.prefix):].rstrip("/")
+            for item in listing.get("CommonPrefixes", [])
+            if item["Prefix"][len(self.prefix):].startswith("gen-")
+        )
+        keep = set(generations[-KEEP_GENERATIONS:]) | ({current} if current else set())
+        for generation in generations:
+            if generation in keep:
+                continue
+            paginator = client.get_paginator("list_objects_v2")
+            for page in paginator.paginate(Bucket=self.bucket, Prefix=self._key(generation, "")):
+                keys = [{"Key": item["Key"]} for item in page.get("Contents", [])]
+                if keys:
+                    client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys})
+            logger.info("Deleted old similar case index %s", generation)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_case_index_store():
+    """
+    SIMILAR_CASE_INDEX_BUCKET が設定されていれば共有の S3IndexStore を返す（未設定時は None）
+    """
+    global _store
+    bucket = os.environ.get("SIMILAR_CASE_INDEX_BUCKET")
+    if not bucket:
+        return None
+
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = S3IndexStore(
+                    bucket,
+                    prefix=os.environ.get("SIMILAR_CASE_INDEX_PREFIX", DEFAULT_PREFIX),
+                    check_interval=int(os.environ.get("SIMILAR_CASE_INDEX_CHECK_INTERVAL", "300")),
+                )
+    return _store
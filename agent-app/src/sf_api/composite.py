@@ -0,0 +1,167 @@
+"""
+Salesforce Composite API（/composite, /composite/batch）のリクエスト組み立てと結果分割
+"""
+from urllib.parse import quote
+
+# Composite API で1回に送信できるサブリクエスト数の上限
+MAX_SUBREQUESTS = 25
+
+# 参照式 @{ref.path} をクエリ文字列内に残すため、エンコードしない文字
+_SAFE_QUERY_CHARS = "@{}[]()'=,.*:_-<>!"
+
+
+def reference(reference_id, path):
+    """
+    前段のサブリクエスト結果を参照する式を生成（例: @{refCase.records[0].Id}）
+    """
+    return f"@{{{reference_id}.{path}}}"
+
+
+class CompositeResult:
+    """
+    サブリクエスト1件分の結果
+    """
+
+    def __init__(self, reference_id, status_code, body):
+        self.reference_id = reference_id
+        self.status_code = status_code
+        self.body = body
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    @property
+    def errors(self):
+        """
+        エラー時のメッセージ一覧（Salesforce のエラーボディは [{errorCode, message}] 形式）
+        """
+        if self.ok:
+            return []
+        if isinstance(self.body, list):
+            return [
+                f"{item.get('errorCode', 'ERROR')}: {item.get('message', '')}"
+                for item in self.body
+                if isinstance(item, dict)
+            ]
+        return [str(self.body)]
+
+    def result(self):
+        """
+        成功時はボディを返し、失敗時は例外を送出
+        """
+        if not self.ok:
+            raise Exception(
+                f"Composite sub-request '{self.reference_id}' failed "
+                f"({self.status_code}): {'; '.join(self.errors)}"
+            )
+        return self.body
+
+
+class CompositeRequest:
+    """
+    /composite 用のリクエストビルダー（参照による連鎖が可能）
+    """
+
+    def __init__(self, api_version, all_or_none=False):
+        self.api_version = api_version
+        self.all_or_none = all_or_none
+        self.subrequests = []
+
+    def __len__(self):
+        return len(self.subrequests)
+
+    def _add(self, reference_id, method, path, body=None):
+        if len(self.subrequests) >= MAX_SUBREQUESTS:
+            raise ValueError(
+                f"Composite request supports at most {MAX_SUBREQUESTS} sub-requests"
+            )
+        if any(r["referenceId"] == reference_id for r in self.subrequests):
+            raise ValueError(f"Duplicate referenceId: {reference_id}")
+
+        subrequest = {
+            "method": method,
+            "url": f"/services/data/{self.api_version}{path}",
+            "referenceId": reference_id,
+        }
+        if body is not None:
+            subrequest["body"] = body
+        self.subrequests.append(subrequest)
+        return self
+
+    def add_query(self, reference_id, soql):
+        return self._add(
+            reference_id, "GET", f"/query?q={quote(soql, safe=_SAFE_QUERY_CHARS)}"
+        )
+
+    def add_sobject(self, reference_id, method, sobject, record_id=None, body=None):
+        path = f"/sobjects/{sobject}"
+        if record_id:
+            path += f"/{record_id}"
+        return self._add(reference_id, method, path, body)
+
+    def to_payload(self):
+        return {"allOrNone": self.all_or_none, "compositeRequest": self.subrequests}
+
+    def parse(self, data):
+        """
+        compositeResponse を referenceId ごとの CompositeResult に分割
+        """
+        results = {}
+        for item in data.get("compositeResponse", []):
+            ref = item.get("referenceId")
+            results[ref] = CompositeResult(
+                ref, item.get("httpStatusCode", 500), item.get("body")
+            )
+        return results
+
+
+class BatchRequest:
+    """
+    /composite/batch 用のリクエストビルダー（SOSL 検索を含められるが参照は不可）
+    """
+
+    def __init__(self, api_version, halt_on_error=False):
+        self.api_version = api_version
+        self.halt_on_error = halt_on_error
+        self.reference_ids = []
+        self.subrequests = []
+
+    def __len__(self):
+        return len(self.subrequests)
+
+    def _add(self, reference_id, method, path, body=None):
+        if len(self.subrequests) >= MAX_SUBREQUESTS:
+            raise ValueError(
+                f"Batch request supports at most {MAX_SUBREQUESTS} sub-requests"
+            )
+        subrequest = {"method": method, "url": f"{self.api_version}{path}"}
+        if body is not None:
+            subrequest["richInput"] = body
+        self.reference_ids.append(reference_id)
+        self.subrequests.append(subrequest)
+        return self
+
+    def add_query(self, reference_id, soql):
+        return self._add(
+            reference_id, "GET", f"/query?q={quote(soql, safe=_SAFE_QUERY_CHARS)}"
+        )
+
+    def add_search(self, reference_id, sosl):
+        return self._add(
+            reference_id, "GET", f"/search?q={quote(sosl, safe=_SAFE_QUERY_CHARS)}"
+        )
+
+    def to_payload(self):
+        return {"haltOnError": self.halt_on_error, "batchRequests": self.subrequests}
+
+    def parse(self, data):
+        """
+        batch の results を追加順の referenceId に対応付けて分割
+        """
+        results = {}
+        for ref, item in zip(self.reference_ids, data.get("results", [])):
+            results[ref] = CompositeResult(
+                ref, item.get("statusCode", 500), item.get("result")
+            )
+        return results
@@ -1,84 +1,149 @@
-import json
 import logging
 from sf_client import SalesforceClient
+from common.http_session import get_connection_stats
+from common.log import configure_logging, bind_request, lazy, lazy_json, log_event, verbose
+from common import metrics, tracing
+from common.recorder import record_traffic
 
-# ログ設定
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# ログ設定（JSON 形式、request_id はログ側で付与）
+configure_logging()
+logger = logging.getLogger(__name__)
 
-# ログフォーマット設定
-log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-if len(logger.handlers) == 0:
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(log_format))
-    logger.addHandler(handler)
 
+def _log_connection_stats():
+    """
+    接続の再利用状況をログ出力（ハンドシェイク削減の確認用）
+    """
+    verbose(logger, "HTTP connection stats: %s", lazy(get_connection_stats))
 
+
+@record_traffic("sf_api")
 def lambda_handler(event, context):
     """
     Salesforce API アクセス用のLambda関数
     """
     request_id = context.aws_request_id if context else "local"
-    logger.info(f"[{request_id}] SF API Lambda function started")
+    bind_request(request_id)
+    metrics.start_request("sf_api", request_id)
+    # 呼び出し元（Main Agent）のスパンを親としてリクエストのスパンを開始
+    request_span = tracing.start_request("sf_api", event, request_id=request_id)
 
     try:
-        # イベントの詳細をログ出力
-        logger.info(f"[{request_id}] Received event keys: {list(event.keys())}")
-        logger.debug(f"[{request_id}] Full event: {json.dumps(event, default=str)}")
+        # イベントの詳細は詳細ログでのみ出力する（INFO ではアクションごとの結果を1行出力）
+        verbose(logger, "SF API Lambda function started. Event: %s", lazy_json(event))
 
         # Salesforceクライアントの初期化
-        logger.info(f"[{request_id}] Initializing Salesforce client")
         sf_client = SalesforceClient()
-        logger.info(f"[{request_id}] Salesforce client initialized successfully")
 
         # アクションに応じて処理を分岐
         action = event.get("action")
-        logger.info(f"[{request_id}] Processing action: {action}")
+        metrics.set_property("action", action)
+        request_span.set_attribute("action", action)
 
         if action == "get_case":
             case_id = event.get("case_id")
-            logger.info(f"[{request_id}] Get case action - Case ID: {case_id}")
 
             if not case_id:
-                logger.error(f"[{request_id}] Missing case_id parameter")
+                logger.error("Missing case_id parameter")
                 raise ValueError("case_id is required")
 
-            logger.info(f"[{request_id}] Calling Salesforce API to get case data")
             case_data = sf_client.get_case(case_id)
-            logger.info(
-                f"[{request_id}] Case data retrieved successfully. Subject: {case_data.get('Subject', 'N/A')}"
-            )
+            logger.info("Case data retrieved - Case ID: %s", case_id)
 
+            _log_connection_stats()
             return {"statusCode": 200, "case_data": case_data}
 
+        elif action == "get_case_version":
+            case_id = event.get("case_id")
+
+            if not case_id:
+                logger.error("Missing case_id parameter")
+                raise ValueError("case_id is required")
+
+            last_modified_date = sf_client.get_case_last_modified(case_id)
+            logger.info("Case version - Case ID: %s, Last modified: %s", case_id, last_modified_date)
+
+            return {
+                "statusCode": 200,
+                "case_id": case_id,
+                "last_modified_date": last_modified_date,
+            }
+
         elif action == "find_similar_cases":
             subject = event.get("subject", "")
-            logger.info(f"[{request_id}] Find similar cases - Subject: {subject}")
-
-            logger.info(f"[{request_id}] Calling Salesforce API to find similar cases")
-            similar_cases = sf_client.find_similar_cases(subject)
-            logger.info(f"[{request_id}] Found {len(similar_cases)} similar cases")
+            similar_cases = sf_client.find_similar_cases(
+                subject, event.get("description", "")
+            )
+            logger.info("Found %s similar cases", len(similar_cases))
 
+            _log_connection_stats()
             return {"statusCode": 200, "similar_cases": similar_cases}
 
         elif action == "get_case_history":
             case_id = event.get("case_id")
-            logger.info(f"[{request_id}] Get case history - Case ID: {case_id}")
 
             if not case_id:
-                logger.error(f"[{request_id}] Missing case_id parameter")
+                logger.error("Missing case_id parameter")
                 raise ValueError("case_id is required")
 
-            logger.info(f"[{request_id}] Calling Salesforce API to get case history")
             case_history = sf_client.get_case_history(case_id)
-            logger.info(f"[{request_id}] Retrieved {len(case_history)} history records")
+            logger.info("Retrieved %s history records - Case ID: %s", len(case_history), case_id)
 
+            _log_connection_stats()
             return {"statusCode": 200, "case_history": case_history}
 
+        elif action == "analyze_case_bundle":
+            case_id = event.get("case_id")
+
+            if not case_id:
+                logger.error("Missing case_id parameter")
+                raise ValueError("case_id is required")
+
+            bundle = sf_client.get_case_bundle(
+                case_id,
+                include_case=event.get("include_case", True),
+                include_history=event.get("include_history", True),
+                include_similar_cases=event.get("include_similar_cases", True),
+                subject=event.get("subject"),
+                description=event.get("description"),
+            )
+            log_event(
+                logger,
+                logging.INFO,
+                "Case bundle retrieved",
+                case_id=case_id,
+                similar_case_count=len(bundle["similar_cases"]),
+                history_count=len(bundle["case_history"]),
+                errors=list(bundle["errors"].keys()),
+            )
+
+            _log_connection_stats()
+            return {"statusCode": 200, **bundle}
+
+        elif action == "sync_case_index":
+            full = bool(event.get("full", False))
+            logger.info("Sync similar case index - Full rebuild: %s", full)
+
+            sync_result = sf_client.sync_case_index(
+                full=full,
+                max_records=int(event.get("max_records", 2000)),
+                max_batches=int(event.get("max_batches", 10)),
+            )
+            logger.info("Similar case index synced: %s", sync_result)
+
+            return {"statusCode": 200, "index": sync_result}
+
         else:
-            logger.error(f"[{request_id}] Unknown action: {action}")
+            logger.error("Unknown action: %s", action)
             raise ValueError(f"Unknown action: {action}")
 
     except Exception as e:
-        logger.error(f"[{request_id}] SF API Error: {str(e)}", exc_info=True)
+        logger.error("SF API Error: %s", e, exc_info=True)
+        metrics.increment("errors")
+        request_span.record_error(e)
         return {"statusCode": 500, "errorMessage": str(e)}
+
+    finally:
+        # 処理時間・Salesforce API の呼び出し状況を EMF で出力
+        metrics.flush()
+        tracing.finish_request(request_span)
@@ -1,8 +1,18 @@
 import os
 import json
+import time
 import requests
 import logging
-from datetime import datetime, timedelta
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+from token_store import get_token_cache
+from composite import BatchRequest, CompositeRequest, reference
+from similarity import SimilarCaseRanker
+from case_index import get_case_index
+from case_index_store import get_case_index_store
+from common.http_session import PoolConfig, get_session, retry_count
+from common import metrics, tracing
 
 # ログ設定
 logger = logging.getLogger(__name__)
@@ -20,33 +30,52 @@ class SalesforceClient:
         self.client_id = os.environ.get("SALESFORCE_CLIENT_ID")
         self.client_secret = os.environ.get("SALESFORCE_CLIENT_SECRET")
 
-        logger.info(f"Instance URL: {self.instance_url}")
-        logger.info(
-            f"Client ID: {self.client_id[:10]}..."
-            if self.client_id
-            else "Client ID: None"
-        )
+        logger.info("Instance URL: %s", self.instance_url)
+        logger.info("Client ID: %s...", self.client_id[:10] if self.client_id else None)
 
-        # Token management
-        self.access_token = None
-        self.token_expiry = None
+        # Token management（トークンはインスタンスをまたいで共有キャッシュに保存）
+        self.token_cache = get_token_cache()
+        self.token_key = f"{self.instance_url}|{self.client_id}"
+        self.token_ttl_seconds = int(
+            os.environ.get("SALESFORCE_TOKEN_TTL_SECONDS", str(110 * 60))
+        )
 
         # API version
         self.api_version = "v63.0"
-        logger.info(f"API Version: {self.api_version}")
+        logger.info("API Version: %s", self.api_version)
 
-    def _get_access_token(self):
+        # ウォームコンテナ内で共有されるキープアライブ接続
+        self.session = get_session(
+            "salesforce", PoolConfig.from_env("SALESFORCE_HTTP")
+        )
+
+        # 類似ケースの並べ替え（文字 n-gram の TF-IDF コサイン類似度）
+        self.similar_case_ranker = SimilarCaseRanker()
+
+        # 複数のクエリを Composite API で1往復にまとめるか
+        self.use_composite = (
+            os.environ.get("SALESFORCE_USE_COMPOSITE", "true").lower() == "true"
+        )
+
+        # 類似ケースインデックスとして許容する最終同期からの経過時間（秒）
+        self.index_max_staleness = int(
+            os.environ.get("SIMILAR_CASE_INDEX_MAX_STALENESS", "3600")
+        )
+
+    def _get_access_token(self, rejected_token=None):
         """
         OAuth 2.0 Client Credentials Flowを使用してアクセストークンを取得
+        有効なトークンが共有キャッシュにあれば再利用する
         """
-        # トークンが有効な場合は再利用
-        if (
-            self.access_token
-            and self.token_expiry
-            and datetime.now() < self.token_expiry
-        ):
-            return self.access_token
+        token = self.token_cache.get_token(
+            self.token_key, self._request_access_token, rejected_token
+        )
+        return token["access_token"]
 
+    def _request_access_token(self):
+        """
+        トークンエンドポイントから新しいアクセストークンを取得
+        """
         # OAuth endpoint
         token_url = f"{self.instance_url}/services/oauth2/token"
 
@@ -58,16 +87,16 @@ class SalesforceClient:
         }
 
         try:
-            response = requests.post(token_url, data=payload)
+            response = self.session.post(token_url, data=payload)
             response.raise_for_status()
 
             token_data = response.json()
-            self.access_token = token_data["access_token"]
 
             # トークンの有効期限を設定（デフォルトは2時間、安全のため1時間50分で設定）
-            self.token_expiry = datetime.now() + timedelta(hours=1, minutes=50)
-
-            return self.access_token
+            return {
+                "access_token": token_data["access_token"],
+                "expires_at": time.time() + self.token_ttl_seconds,
+            }
 
         except requests.exceptions.RequestException as e:
             raise Exception(f"Failed to obtain access token: {str(e)}")
@@ -86,93 +115,161 @@ class SalesforceClient:
 
         url = f"{self.instance_url}/services/data/{self.api_version}{endpoint}"
 
+        if method not in ("GET", "POST", "PATCH"):
+            raise ValueError(f"Unsupported HTTP method: {method}")
+
         try:
-            if method == "GET":
-                response = requests.get(url, headers=headers, params=params)
-            elif method == "POST":
-                response = requests.post(url, headers=headers, json=data)
-            elif method == "PATCH":
-                response = requests.patch(url, headers=headers, json=data)
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
-
-            # 401の場合はトークンをリフレッシュして再試行
-            if response.status_code == 401:
-                self.access_token = None
-                self.token_expiry = None
-                access_token = self._get_access_token()
-                headers["Authorization"] = f"Bearer {access_token}"
-
-                if method == "GET":
-                    response = requests.get(url, headers=headers, params=params)
-                elif method == "POST":
-                    response = requests.post(url, headers=headers, json=data)
-                elif method == "PATCH":
-                    response = requests.patch(url, headers=headers, json=data)
+            with metrics.timer("salesforce_api"), tracing.span(
+                f"salesforce {method} {endpoint.split('?')[0]}", method=method
+            ) as http_span:
+                response = self.session.request(
+                    method, url, headers=tracing.inject_headers(headers), params=params, json=data
+                )
+                metrics.increment("salesforce_api_retries", retry_count(response))
+
+                # 401の場合はトークンをリフレッシュして再試行
+                if response.status_code == 401:
+                    metrics.increment("salesforce_token_refreshes")
+                    access_token = self._get_access_token(rejected_token=access_token)
+                    headers["Authorization"] = f"Bearer {access_token}"
 
+                    response = self.session.request(
+                        method, url, headers=headers, params=params, json=data
+                    )
+                    metrics.increment("salesforce_api_retries", retry_count(response))
+                http_span.set_attribute("http.status_code", response.status_code)
+
+            metrics.record_size("salesforce_response_bytes", response.content)
             response.raise_for_status()
             return response.json() if response.content else {}
 
         except requests.exceptions.RequestException as e:
             raise Exception(f"API request failed: {str(e)}")
 
-    def get_case(self, case_id):
+    def composite(self, request):
         """
-        ケース情報を取得
+        /composite にサブリクエストをまとめて送信し、referenceId ごとの結果を返す
         """
-        logger.info(f"Getting case data for case ID: {case_id}")
+        logger.info("Sending composite request with %s sub-requests", len(request))
+        data = self._make_api_request("POST", "/composite", data=request.to_payload())
+        return request.parse(data)
 
-        query = f"SELECT Id, CaseNumber, Subject, Description, Status, Priority, Account.Name, Contact.Name, CreatedDate, LastModifiedDate, Owner.Name FROM Case WHERE Id = '{case_id}'"
-        logger.debug(f"SOQL Query: {query}")
+    def composite_batch(self, request):
+        """
+        /composite/batch にサブリクエストをまとめて送信し、referenceId ごとの結果を返す
+        """
+        logger.info("Sending batch request with %s sub-requests", len(request))
+        data = self._make_api_request(
+            "POST", "/composite/batch", data=request.to_payload()
+        )
+        return request.parse(data)
 
-        result = self._make_api_request("GET", "/query", params={"q": query})
-        logger.info(f"Query result: totalSize={result.get('totalSize', 0)}")
+    def _case_query(self, case_id):
+        return f"SELECT Id, CaseNumber, Subject, Description, Status, Priority, Account.Name, Contact.Name, CreatedDate, LastModifiedDate, Owner.Name FROM Case WHERE Id = '{case_id}'"
+
+    def _case_history_query(self, case_id):
+        return f"SELECT Id, Field, OldValue, NewValue, CreatedDate, CreatedBy.Name FROM CaseHistory WHERE CaseId = '{case_id}' ORDER BY CreatedDate DESC LIMIT 20"
+
+    def _extract_case(self, case_id, result):
+        logger.info("Query result: totalSize=%s", result.get('totalSize', 0))
 
         if result["totalSize"] > 0:
             case_data = result["records"][0]
-            logger.info(f"Case found - Subject: {case_data.get('Subject', 'N/A')}")
+            logger.info("Case found - Subject: %s", case_data.get('Subject', 'N/A'))
             return case_data
         else:
-            logger.error(f"Case not found: {case_id}")
+            logger.error("Case not found: %s", case_id)
             raise Exception(f"Case not found: {case_id}")
 
-    def find_similar_cases(self, subject):
+    def get_case(self, case_id):
         """
-        類似ケースを検索（広範囲検索）
-        取引先IDによる絞り込みを削除し、より広範囲な検索を実行
+        ケース情報を取得
         """
-        logger.info(f"Finding similar cases for subject: {subject}")
+        logger.info("Getting case data for case ID: %s", case_id)
 
-        # SOSLクエリで類似ケースを検索
-        # subjectから重要なキーワードを抽出して検索
-        search_terms = self._extract_search_keywords(subject)
+        query = self._case_query(case_id)
+        logger.debug("SOQL Query: %s", query)
 
-        # 複数のキーワードを使った検索
-        similar_cases = []
+        result = self._make_api_request("GET", "/query", params={"q": query})
+        return self._extract_case(case_id, result)
 
-        for search_term in search_terms:
-            escaped_term = search_term.replace("'", "\\'")
-            sosl_query = f"FIND {{{escaped_term}}} IN ALL FIELDS RETURNING Case(Id, CaseNumber, Subject, Status, Priority, CreatedDate, Description)"
+    def get_case_last_modified(self, case_id):
+        """
+        ケースの最終更新日時のみを取得（キャッシュの再検証用の軽量クエリ）
+        """
+        query = f"SELECT Id, LastModifiedDate FROM Case WHERE Id = '{case_id}'"
+        result = self._make_api_request("GET", "/query", params={"q": query})
+        return self._extract_case(case_id, result).get("LastModifiedDate")
 
-            # 基本的な絞り込み条件（クローズしたケースも含める）
-            where_clauses = ["Id != NULL"]  # 基本的な有効性チェック
+    def get_case_with_history(self, case_id):
+        """
+        ケース情報と履歴を Composite API の1往復で取得
+        履歴クエリは取得したケースの Id を参照して連鎖させる
+        """
+        logger.info("Getting case data and history via composite for case ID: %s", case_id)
 
-            where_clause = " WHERE " + " AND ".join(where_clauses)
-            sosl_query = sosl_query.replace(
-                ")", f"{where_clause} ORDER BY CreatedDate DESC LIMIT 15)"
-            )
+        request = CompositeRequest(self.api_version)
+        request.add_query("refCase", self._case_query(case_id))
+        request.add_query(
+            "refHistory",
+            self._case_history_query(reference("refCase", "records[0].Id")),
+        )
+        results = self.composite(request)
 
-            logger.debug(f"SOSL Query: {sosl_query}")
+        case_data = self._extract_case(case_id, results["refCase"].result())
 
-            try:
-                result = self._make_api_request(
-                    "GET", "/search", params={"q": sosl_query}
-                )
+        history_result = results.get("refHistory")
+        if history_result is None or not history_result.ok:
+            errors = history_result.errors if history_result else ["missing result"]
+            raise Exception(f"Case history query failed: {'; '.join(errors)}")
 
-                # 検索結果からケース情報を抽出
-                for record in result.get("searchRecords", []):
-                    if record["attributes"]["type"] == "Case":
-                        case_data = {
+        return case_data, self._format_case_history(history_result.body)
+
+    def find_similar_cases(self, subject, description=""):
+        """
+        類似ケースを検索（広範囲検索）
+        取引先IDによる絞り込みを削除し、より広範囲な検索を実行
+        """
+        logger.info("Finding similar cases for subject: %s", subject)
+
+        # ローカルインデックスが利用できればそちらを優先（SOSL はフォールバック）
+        indexed_cases = self._find_similar_cases_from_index(subject, description)
+        if indexed_cases is not None:
+            return indexed_cases
+
+        # SOSLクエリで類似ケースを検索
+        # subjectから重要なキーワードを抽出して検索
+        search_terms = self._extract_search_keywords(subject)
+
+        search_results = None
+        if self.use_composite and len(search_terms) > 1:
+            # 全キーワードの SOSL を1往復で送信
+            try:
+                search_results = self._search_terms_batch(search_terms)
+            except Exception as e:
+                logger.warning("Batch search failed, falling back to sequential search: %s", e)
+
+        if search_results is None:
+            search_results = []
+            for search_term in search_terms:
+                try:
+                    search_results.append(
+                        self._make_api_request(
+                            "GET",
+                            "/search",
+                            params={"q": self._similar_cases_sosl(search_term)},
+                        )
+                    )
+                except Exception as e:
+                    logger.warning("Search failed for term '%s': %s", search_term, e)
+
+        # 検索結果からケース情報を抽出
+        candidates = []
+        for result in search_results:
+            for record in result.get("searchRecords", []):
+                if record["attributes"]["type"] == "Case":
+                    candidates.append(
+                        {
                             "Id": record["Id"],
                             "CaseNumber": record.get("CaseNumber"),
                             "Subject": record.get("Subject"),
@@ -181,29 +278,138 @@ class SalesforceClient:
                             "CreatedDate": record.get("CreatedDate"),
                             "Description": record.get("Description"),
                         }
+                    )
+
+        # Id で重複を除き、類似度でソートして上位10件を返す
+        result_cases = self.similar_case_ranker.rank(
+            subject, candidates, description=description, limit=10
+        )
 
-                        # 重複を避けるため、IDでチェック
-                        if not any(
-                            case["Id"] == case_data["Id"] for case in similar_cases
-                        ):
-                            # 類似度を計算（簡単な文字列マッチング）
-                            similarity = self._calculate_similarity(
-                                subject, case_data["Subject"] or ""
-                            )
-                            case_data["similarity"] = similarity
-                            similar_cases.append(case_data)
+        logger.info("Found %s similar cases from %s candidates", len(result_cases), len(candidates))
+        return result_cases
 
-            except Exception as e:
-                logger.warning(f"Search failed for term '{search_term}': {str(e)}")
-                continue
+    def _find_similar_cases_from_index(self, subject, description):
+        """
+        ローカルインデックスから類似ケースを検索
+        インデックスが無い・古すぎる場合は None を返し、SOSL 検索に任せる
+        """
+        index = get_case_index()
+        if index is None:
+            return None
+
+        # 同期はスケジュール実行の sync_case_index で行い、ここでは保存済みのインデックスを読み込むだけにする
+        try:
+            store = get_case_index_store()
+            if store is not None:
+                store.pull(index)
+            else:
+                index.reload_if_changed()
+        except Exception as e:
+            logger.warning("Similar case index reload failed: %s", e)
 
-        # 類似度でソートして上位10件を返す
-        similar_cases.sort(key=lambda x: x.get("similarity", 0), reverse=True)
-        result_cases = similar_cases[:10]
+        if not index.ready:
+            logger.info("Similar case index not built yet - using SOSL")
+            return None
 
-        logger.info(f"Found {len(result_cases)} similar cases")
+        if index.age_seconds > self.index_max_staleness:
+            logger.info("Similar case index is stale - using SOSL")
+            return None
+
+        candidates = index.search(subject, description)
+        result_cases = self.similar_case_ranker.rank(
+            subject, candidates, description=description, limit=10
+        )
+        logger.info(
+            "Found %s similar cases from local index (%s candidates, index size %s)",
+            len(result_cases), len(candidates), index.size
+        )
         return result_cases
 
+    def sync_case_index(self, full=False, max_records=2000, max_batches=10):
+        """
+        ローカル類似ケースインデックスを増分同期（full=True の場合は作り直す）
+
+        スケジュール実行から呼び出す。共有先（S3）が設定されていれば、同期前に最新の
+        インデックスを取得し、同期後に検索する側のコンテナが読み込めるよう書き出す。
+        """
+        index = get_case_index()
+        if index is None:
+            raise Exception("Similar case index is disabled or NumPy is not available")
+
+        store = get_case_index_store()
+        if store is not None and not full:
+            store.pull(index, force=True)
+
+        if full:
+            result = index.rebuild(self, max_records=max_records, max_batches=max_batches)
+        else:
+            with index.sync_lock:
+                result = index.sync_batches(self, max_records=max_records, max_batches=max_batches)
+
+        if store is not None:
+            store.push(index)
+        return result
+
+    def get_changed_cases(self, since=None, limit=2000):
+        """
+        指定日時以降に変更（削除を含む）されたケースを LastModifiedDate の昇順で取得
+        """
+        fields = "Id, CaseNumber, Subject, Status, Priority, CreatedDate, Description, LastModifiedDate, IsDeleted"
+        if since:
+            where_clause = f"WHERE LastModifiedDate >= {since}"
+        else:
+            where_clause = "WHERE IsDeleted = false"
+        query = f"SELECT {fields} FROM Case {where_clause} ORDER BY LastModifiedDate ASC LIMIT {int(limit)}"
+        logger.debug("SOQL Query: %s", query)
+
+        result = self._make_api_request("GET", "/queryAll", params={"q": query})
+        records = list(result.get("records", []))
+
+        # 2000件を超える場合は nextRecordsUrl で続きを取得
+        prefix = f"/services/data/{self.api_version}"
+        while result.get("nextRecordsUrl") and len(records) < limit:
+            result = self._make_api_request(
+                "GET", result["nextRecordsUrl"].replace(prefix, "", 1)
+            )
+            records.extend(result.get("records", []))
+
+        return records[:limit]
+
+    def _similar_cases_sosl(self, search_term):
+        """
+        キーワードから類似ケース検索用の SOSL を生成
+        """
+        escaped_term = search_term.replace("'", "\\'")
+        sosl_query = f"FIND {{{escaped_term}}} IN ALL FIELDS RETURNING Case(Id, CaseNumber, Subject, Status, Priority, CreatedDate, Description)"
+
+        # 基本的な絞り込み条件（クローズしたケースも含める）
+        where_clauses = ["Id != NULL"]  # 基本的な有効性チェック
+
+        where_clause = " WHERE " + " AND ".join(where_clauses)
+        sosl_query = sosl_query.replace(
+            ")", f"{where_clause} ORDER BY CreatedDate DESC LIMIT 15)"
+        )
+
+        logger.debug("SOSL Query: %s", sosl_query)
+        return sosl_query
+
+    def _search_terms_batch(self, search_terms):
+        """
+        複数キーワードの SOSL を /composite/batch でまとめて実行
+        失敗したサブリクエストはスキップし、成功分の結果のみ返す
+        """
+        request = BatchRequest(self.api_version)
+        for i, search_term in enumerate(search_terms):
+            request.add_search(f"search{i}", self._similar_cases_sosl(search_term))
+
+        results = []
+        for search_term, item in zip(search_terms, self.composite_batch(request).values()):
+            if item.ok:
+                results.append(item.body or {})
+            else:
+                logger.warning("Search failed for term '%s': %s", search_term, '; '.join(item.errors))
+        return results
+
     def _extract_search_keywords(self, subject):
         """
         件名から検索用キーワードを抽出
@@ -253,46 +459,19 @@ class SalesforceClient:
             # 重要そうなキーワードを優先
             keywords.extend(words[:3])
 
-        logger.debug(f"Extracted keywords: {keywords}")
+        logger.debug("Extracted keywords: %s", keywords)
         return keywords[:3]  # 最大3つのキーワードで検索
 
-    def _calculate_similarity(self, text1, text2):
-        """
-        簡単な類似度計算（文字列の共通部分を基準）
-        """
-        if not text1 or not text2:
-            return 0
-
-        # 文字列を正規化
-        text1 = text1.lower().replace(" ", "")
-        text2 = text2.lower().replace(" ", "")
-
-        # 共通文字数をカウント
-        common_chars = 0
-        text1_chars = list(text1)
-        text2_chars = list(text2)
-
-        for char in text1_chars:
-            if char in text2_chars:
-                common_chars += 1
-                text2_chars.remove(char)  # 重複カウントを避ける
-
-        # 類似度を計算（0-1の範囲）
-        max_length = max(len(text1), len(text2))
-        if max_length == 0:
-            return 0
-
-        similarity = common_chars / max_length
-        return similarity
-
     def get_case_history(self, case_id):
         """
         ケースの履歴を取得
         """
-        query = f"SELECT Id, Field, OldValue, NewValue, CreatedDate, CreatedBy.Name FROM CaseHistory WHERE CaseId = '{case_id}' ORDER BY CreatedDate DESC LIMIT 20"
+        query = self._case_history_query(case_id)
 
         result = self._make_api_request("GET", "/query", params={"q": query})
+        return self._format_case_history(result)
 
+    def _format_case_history(self, result):
         history = []
         for record in result.get("records", []):
             history.append(
@@ -301,12 +480,85 @@ class SalesforceClient:
                     "OldValue": record.get("OldValue"),
                     "NewValue": record.get("NewValue"),
                     "CreatedDate": record.get("CreatedDate"),
-                    "CreatedBy": record.get("CreatedBy", {}).get("Name"),
+                    "CreatedBy": (record.get("CreatedBy") or {}).get("Name"),
                 }
             )
 
         return history
 
+    def get_case_bundle(
+        self,
+        case_id,
+        include_case=True,
+        include_history=True,
+        include_similar_cases=True,
+        subject=None,
+        description=None,
+    ):
+        """
+        ケース情報・履歴・類似ケースをまとめて取得
+        履歴取得はケース取得と並行し、類似ケース検索はケースの件名が判明した時点で開始する
+        """
+        logger.info(
+            "Getting case bundle for case ID: %s (case=%s, history=%s, similar=%s)",
+            case_id, include_case, include_history, include_similar_cases
+        )
+
+        bundle = {"case_data": None, "case_history": [], "similar_cases": [], "errors": {}}
+
+        if self.use_composite and include_case and include_history:
+            # ケースと履歴を Composite API の1往復で取得し、残りは類似ケース検索のみ
+            try:
+                bundle["case_data"], bundle["case_history"] = self.get_case_with_history(case_id)
+                include_case = include_history = False
+                if subject is None:
+                    subject = bundle["case_data"].get("Subject") or ""
+                if description is None:
+                    description = bundle["case_data"].get("Description") or ""
+            except Exception as e:
+                logger.warning("Composite case fetch failed, falling back to separate requests: %s", e)
+
+        # 計測・トレースが呼び出し元のリクエストに属するよう、コンテキストを引き継いで実行する
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            history_future = (
+                executor.submit(contextvars.copy_context().run, self.get_case_history, case_id)
+                if include_history
+                else None
+            )
+
+            # ケース情報の取得失敗はバンドル全体のエラーとして扱う
+            if include_case:
+                bundle["case_data"] = self.get_case(case_id)
+                if subject is None:
+                    subject = bundle["case_data"].get("Subject") or ""
+                if description is None:
+                    description = bundle["case_data"].get("Description") or ""
+
+            similar_future = (
+                executor.submit(
+                    contextvars.copy_context().run,
+                    self.find_similar_cases,
+                    subject or "",
+                    description or "",
+                )
+                if include_similar_cases
+                else None
+            )
+
+            for key, future in (
+                ("case_history", history_future),
+                ("similar_cases", similar_future),
+            ):
+                if future is None:
+                    continue
+                try:
+                    bundle[key] = future.result()
+                except Exception as e:
+                    logger.warning("Failed to get %s for case %s: %s", key, case_id, e)
+                    bundle["errors"][key] = str(e)
+
+        return bundle
+
     def update_case(self, case_id, updates):
         """
         ケースを更新
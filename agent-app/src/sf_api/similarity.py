@@ -0,0 +1,188 @@
+"""
+文字 n-gram ベクトルによる類似ケースのスコアリング
+
+日本語は分かち書きなしでも扱えるよう単語ではなく文字 n-gram を使い、
+TF-IDF 重み付きコサイン類似度で全候補を一括でスコアリングする。
+"""
+import math
+import logging
+import unicodedata
+from collections import Counter
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """
+    全角・半角と大文字・小文字の揺れをなくし、空白を除去
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(text.split())
+
+
+def char_ngrams(text, ngram_range=(2, 3)):
+    """
+    正規化済みテキストから文字 n-gram を列挙（n-gram が作れない短い文字列はそのまま使う）
+    """
+    min_n, max_n = ngram_range
+    if len(text) < min_n:
+        return [text] if text else []
+
+    grams = []
+    for n in range(min_n, max_n + 1):
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+class NgramSimilarity:
+    """
+    クエリと候補テキスト群の TF-IDF コサイン類似度を計算
+    """
+
+    def __init__(self, ngram_range=(2, 3), use_idf=True, max_chars=1000):
+        self.ngram_range = ngram_range
+        self.use_idf = use_idf
+        self.max_chars = max_chars
+
+    def _grams(self, text):
+        return char_ngrams(normalize_text(text)[: self.max_chars], self.ngram_range)
+
+    def score(self, query, candidates):
+        """
+        クエリと各候補の類似度（0-1）を候補の順序で返す
+        """
+        if not candidates:
+            return []
+
+        query_grams = self._grams(query)
+        if not query_grams:
+            return [0.0] * len(candidates)
+
+        docs = [query_grams] + [self._grams(c) for c in candidates]
+        if NUMPY_AVAILABLE:
+            return self._score_numpy(docs)
+        return self._score_python(docs)
+
+    def _score_numpy(self, docs):
+        """
+        全候補の n-gram を1つの配列に展開し、ベクトル演算でまとめて計算
+        """
+        n_docs = len(docs)
+        lengths = np.fromiter((len(d) for d in docs), dtype=np.int64, count=n_docs)
+        flat = [g for d in docs for g in d]
+        if not flat:
+            return [0.0] * (n_docs - 1)
+
+        # n-gram 文字列を語彙 ID に変換（文字列のソートを避けるため辞書で採番）
+        vocab = {}
+        term_ids = np.fromiter(
+            (vocab.setdefault(g, len(vocab)) for g in flat), dtype=np.int64, count=len(flat)
+        )
+        n_terms = len(vocab)
+        doc_ids = np.repeat(np.arange(n_docs, dtype=np.int64), lengths)
+
+        # (文書, 語彙) ごとの出現回数
+        keys, counts = np.unique(doc_ids * n_terms + term_ids, return_counts=True)
+        pair_docs = keys // n_terms
+        pair_terms = keys % n_terms
+
+        # サブリニア TF × IDF
+        weights = 1.0 + np.log(counts.astype(np.float64))
+        if self.use_idf:
+            df = np.bincount(pair_terms, minlength=n_terms)
+            idf = np.log((1.0 + n_docs) / (1.0 + df)) + 1.0
+            weights *= idf[pair_terms]
+
+        norms = np.sqrt(np.bincount(pair_docs, weights=weights * weights, minlength=n_docs))
+
+        query_mask = pair_docs == 0
+        query_vector = np.zeros(n_terms)
+        query_vector[pair_terms[query_mask]] = weights[query_mask]
+
+        dots = np.bincount(pair_docs, weights=weights * query_vector[pair_terms], minlength=n_docs)
+        denom = norms * norms[0]
+        scores = np.divide(dots, denom, out=np.zeros(n_docs), where=denom > 0)
+        return np.clip(scores[1:], 0.0, 1.0).tolist()
+
+    def _score_python(self, docs):
+        """
+        NumPy が利用できない環境向けの同等実装
+        """
+        counters = [Counter(d) for d in docs]
+        n_docs = len(counters)
+
+        idf = {}
+        if self.use_idf:
+            df = Counter()
+            for counter in counters:
+                df.update(counter.keys())
+            idf = {t: math.log((1.0 + n_docs) / (1.0 + c)) + 1.0 for t, c in df.items()}
+
+        vectors = []
+        for counter in counters:
+            vector = {
+                t: (1.0 + math.log(c)) * idf.get(t, 1.0) for t, c in counter.items()
+            }
+            norm = math.sqrt(sum(w * w for w in vector.values()))
+            vectors.append((vector, norm))
+
+        query_vector, query_norm = vectors[0]
+        scores = []
+        for vector, norm in vectors[1:]:
+            if not norm or not query_norm:
+                scores.append(0.0)
+                continue
+            dot = sum(w * vector.get(t, 0.0) for t, w in query_vector.items())
+            scores.append(min(max(dot / (norm * query_norm), 0.0), 1.0))
+        return scores
+
+
+class SimilarCaseRanker:
+    """
+    件名と説明を重み付けして候補ケースを並べ替える
+    """
+
+    def __init__(self, subject_weight=0.7, description_weight=0.3, engine=None):
+        self.subject_weight = subject_weight
+        self.description_weight = description_weight
+        self.engine = engine or NgramSimilarity()
+
+    def rank(self, subject, candidates, description="", limit=10):
+        """
+        候補を Id で重複排除し、類似度（similarity）を付与して上位 limit 件を返す
+        """
+        unique = {}
+        for case in candidates:
+            case_id = case.get("Id")
+            if case_id and case_id not in unique:
+                unique[case_id] = dict(case)
+        cases = list(unique.values())
+        if not cases:
+            return []
+
+        scores = self.engine.score(subject or "", [c.get("Subject") or "" for c in cases])
+        if description:
+            description_scores = self.engine.score(
+                description, [c.get("Description") or "" for c in cases]
+            )
+            scores = [
+                self.subject_weight * s + self.description_weight * d
+                for s, d in zip(scores, description_scores)
+            ]
+
+        for case, score in zip(cases, scores):
+            case["similarity"] = round(float(score), 4)
+
+        # 同点の場合は検索結果の順序を保つ（sort は安定ソート）
+        cases.sort(key=lambda x: x["similarity"], reverse=True)
+        logger.debug("Ranked %s candidates, returning top %s", len(cases), limit)
+        return cases[:limit]
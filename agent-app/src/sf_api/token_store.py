@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+# プロセス（ウォームコンテナ）内で共有するトークン
+_MEMORY_TOKENS = {}
+_MEMORY_LOCK = threading.Lock()
+
+DEFAULT_TOKEN_DIR = "/tmp/sf_token_cache"
+
+
+class TokenStore(ABC):
+    """
+    アクセストークン保存先のインターフェース
+
+    外部の共有ストア（DynamoDB、ElastiCache など）を使う場合は
+    このクラスを継承して load / save / delete を実装する。
+    トークンは {"access_token": str, "expires_at": float(epoch秒)} の辞書で扱う。
+    """
+
+    @abstractmethod
+    def load(self, key):
+        pass
+
+    @abstractmethod
+    def save(self, key, token):
+        pass
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    モジュールレベルの辞書に保存（同一コンテナ内のリクエスト間で共有）
+    """
+
+    def load(self, key):
+        with _MEMORY_LOCK:
+            token = _MEMORY_TOKENS.get(key)
+            return dict(token) if token else None
+
+    def save(self, key, token):
+        with _MEMORY_LOCK:
+            _MEMORY_TOKENS[key] = dict(token)
+
+    def delete(self, key):
+        with _MEMORY_LOCK:
+            _MEMORY_TOKENS.pop(key, None)
+
+
+class FileTokenStore(TokenStore):
+    """
+    /tmp 配下のファイルに保存（コンテナ内の別プロセス・モジュール再読込後も共有）
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or os.environ.get(
+            "SALESFORCE_TOKEN_DIR", DEFAULT_TOKEN_DIR
+        )
+
+    def _path(self, key):
+        # キーには接続先とクライアントIDが含まれるため、ハッシュ化してファイル名にする
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def load(self, key):
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to read cached token: %s", e)
+            return None
+
+    def save(self, key, token):
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            # 書き込み途中のファイルを読まれないよう、一時ファイル経由で置き換える
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(token, f)
+            os.chmod(tmp_path, 0o600)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning("Failed to persist token: %s", e)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Failed to delete cached token: %s", e)
+
+
+class LayeredTokenStore(TokenStore):
+    """
+    複数のストアを順に参照する（下位層で見つかったトークンは上位層に書き戻す）
+    """
+
+    def __init__(self, stores):
+        self.stores = list(stores)
+
+    def load(self, key):
+        for i, store in enumerate(self.stores):
+            token = store.load(key)
+            if token:
+                for upper in self.stores[:i]:
+                    upper.save(key, token)
+                return token
+        return None
+
+    def save(self, key, token):
+        for store in self.stores:
+            store.save(key, token)
+
+    def delete(self, key):
+        for store in self.stores:
+            store.delete(key)
+
+
+class TokenCache:
+    """
+    有効期限を考慮してトークンを再利用し、更新は同時に1回だけ行う
+    """
+
+    def __init__(self, store, refresh_margin_seconds=60):
+        self.store = store
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+
+    def _lock_for(self, key):
+        with self._locks_guard:
+            if key not in self._locks:
+                self._locks[key] = threading.Lock()
+            return self._locks[key]
+
+    def _usable(self, token, rejected_token):
+        if not token or not token.get("access_token"):
+            return False
+        if rejected_token and token["access_token"] == rejected_token:
+            return False
+        return time.time() + self.refresh_margin_seconds < token.get("expires_at", 0)
+
+    def get_token(self, key, fetch, rejected_token=None):
+        """
+        有効なトークンを返す。無ければ fetch() で取得して保存する
+
+        Args:
+            key (str): 接続先を識別するキー
+            fetch (callable): 新しいトークン辞書を返す関数
+            rejected_token (str): 401 で拒否されたトークン（再利用しない）
+        """
+        token = self.store.load(key)
+        if self._usable(token, rejected_token):
+            return token
+
+        with self._lock_for(key):
+            # 待機中に別スレッドが更新済みであればそれを使う
+            token = self.store.load(key)
+            if self._usable(token, rejected_token):
+                return token
+
+            logger.info("Refreshing Salesforce access token")
+            token = fetch()
+            self.store.save(key, token)
+            return token
+
+    def invalidate(self, key):
+        self.store.delete(key)
+
+
+def create_token_store(backend=None):
+    """
+    設定に応じたトークンストアを生成
+
+    SALESFORCE_TOKEN_STORE: "memory" | "file"（既定: メモリ + /tmp ファイル）
+    """
+    backend = (backend or os.environ.get("SALESFORCE_TOKEN_STORE", "file")).lower()
+
+    if backend == "memory":
+        return MemoryTokenStore()
+    if backend == "file":
+        return LayeredTokenStore([MemoryTokenStore(), FileTokenStore()])
+
+    raise ValueError(f"Unknown token store backend: {backend}")
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """
+    コンテナ内で共有する TokenCache を取得
+    """
+    global _token_cache
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                _token_cache = TokenCache(create_token_store())
+    return _token_cache
+
+
+def set_token_store(store):
+    """
+    トークンストアを差し替える（外部共有ストアの利用時やテスト用）
+    """
+    global _token_cache
+    with _token_cache_lock:
+        _token_cache = TokenCache(store) if store is not None else None
+
+
+def reset_token_cache():
+    """
+    メモリ上のトークンと共有 TokenCache を破棄（テスト用）
+    """
+    set_token_store(None)
+    with _MEMORY_LOCK:
+        _MEMORY_TOKENS.clear()
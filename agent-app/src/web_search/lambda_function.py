@@ -1,66 +1,138 @@
-import json
 import logging
+import threading
 from tavily_client import TavilyClient
+from search_cache import create_search_cache
+from common.http_session import get_connection_stats
+from common.log import configure_logging, bind_request, lazy, lazy_json, log_event, verbose
+from common import metrics, tracing
+from common.recorder import record_traffic
 
-# ログ設定
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
+# ログ設定（JSON 形式、request_id はログ側で付与）
+configure_logging()
+logger = logging.getLogger(__name__)
 
-# ログフォーマット設定
-log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-if len(logger.handlers) == 0:
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(log_format))
-    logger.addHandler(handler)
+# ウォームコンテナ内で再利用する Tavily クライアントと検索結果キャッシュ
+_tavily_client = None
+_search_cache = None
+_init_lock = threading.Lock()
 
+# キャッシュキーに含める検索オプション
+SEARCH_OPTION_KEYS = (
+    'search_depth',
+    'include_answer',
+    'include_raw_content',
+    'include_domains',
+    'exclude_domains',
+    'include_images',
+    'include_image_descriptions'
+)
+
+
+def get_tavily_client():
+    """
+    コンテナ内で共有する TavilyClient を取得（遅延初期化）
+    """
+    global _tavily_client
+    if _tavily_client is None:
+        with _init_lock:
+            if _tavily_client is None:
+                _tavily_client = TavilyClient()
+    return _tavily_client
+
+
+def get_search_cache():
+    """
+    コンテナ内で共有する検索結果キャッシュを取得（遅延初期化）
+    """
+    global _search_cache
+    if _search_cache is None:
+        with _init_lock:
+            if _search_cache is None:
+                _search_cache = create_search_cache()
+    return _search_cache
+
+
+def reset_web_search_state():
+    """
+    共有クライアントとキャッシュを破棄（テスト用）
+    """
+    global _tavily_client, _search_cache
+    with _init_lock:
+        _tavily_client = None
+        _search_cache = None
+
+
+@record_traffic("web_search")
 def lambda_handler(event, context):
     """
     Web検索（Tavily API）用のLambda関数
     """
     request_id = context.aws_request_id if context else 'local'
-    logger.info(f"[{request_id}] Web Search Lambda function started")
+    bind_request(request_id)
+    metrics.start_request('web_search', request_id)
+    # 呼び出し元（Main Agent）のスパンを親としてリクエストのスパンを開始
+    request_span = tracing.start_request('web_search', event, request_id=request_id)
     
     try:
-        # イベントの詳細をログ出力
-        logger.info(f"[{request_id}] Received event keys: {list(event.keys())}")
-        logger.debug(f"[{request_id}] Full event: {json.dumps(event, default=str)}")
+        # イベントの詳細は詳細ログでのみ出力する（INFO では検索結果の概要を1行出力）
+        verbose(logger, "Web Search Lambda function started. Event: %s", lazy_json(event))
         
-        # Tavilyクライアントの初期化
-        logger.info(f"[{request_id}] Initializing Tavily client")
-        tavily_client = TavilyClient()
-        logger.info(f"[{request_id}] Tavily client initialized successfully")
-
         # 検索パラメータの取得
         query = event.get('query')
         if not query:
-            logger.error(f"[{request_id}] Missing required parameter: query")
+            logger.error("Missing required parameter: query")
             raise ValueError('query is required')
 
         max_results = event.get('max_results', 5)
-        logger.info(f"[{request_id}] Search parameters - Query: '{query}', Max results: {max_results}")
+        options = TavilyClient.resolve_options({key: event.get(key) for key in SEARCH_OPTION_KEYS})
+        bypass_cache = bool(event.get('bypass_cache', False))
+
+        # キャッシュの確認（同じケースへの追加質問では同一クエリが繰り返される）
+        search_cache = get_search_cache()
+        cache_key = search_cache.make_key(query, max_results, options)
+        search_results = None if bypass_cache else search_cache.get(cache_key)
+        from_cache = search_results is not None
+        metrics.increment('search_cache_hits' if from_cache else 'search_cache_misses')
+
+        if not from_cache:
+            # Web検索の実行
+            tavily_client = get_tavily_client()
+            search_results = tavily_client.search(query, max_results, **options)
+            search_cache.set(cache_key, search_results)
 
-        # Web検索の実行
-        logger.info(f"[{request_id}] Executing web search via Tavily API")
-        search_results = tavily_client.search(query, max_results)
-        
         # 検索結果の概要をログ出力
-        result_count = len(search_results.get('results', []))
-        logger.info(f"[{request_id}] Search completed - Found {result_count} results")
-        logger.debug(f"[{request_id}] Search response time: {search_results.get('response_time', 'N/A')}s")
+        log_event(
+            logger, logging.INFO, "Search completed",
+            query=query,
+            max_results=max_results,
+            bypass_cache=bypass_cache,
+            result_count=len(search_results.get('results', [])),
+            from_cache=from_cache,
+            cache=search_cache.stats,
+            response_time=search_results.get('response_time')
+        )
 
         response = {
             'statusCode': 200,
             'search_results': search_results,
-            'query': query
+            'query': query,
+            'from_cache': from_cache
         }
         
-        logger.info(f"[{request_id}] Web Search Lambda function completed successfully")
+        verbose(logger, "HTTP connection stats: %s", lazy(get_connection_stats))
         return response
 
     except Exception as e:
-        logger.error(f"[{request_id}] Web search error: {str(e)}", exc_info=True)
+        logger.error("Web search error: %s", e, exc_info=True)
+        metrics.increment('errors')
+        request_span.record_error(e)
         return {
             'statusCode': 500,
             'errorMessage': str(e),
             'request_id': request_id
-        }
\ No newline at end of file
+        }
+
+    finally:
+        # 処理時間・キャッシュ・Tavily API の呼び出し状況を EMF で出力
+        metrics.flush()
+        tracing.finish_request(request_span)
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+import unicodedata
+
+from common.ttl_cache import TTLCache
+
+# ログ設定
+logger = logging.getLogger(__name__)
+
+DEFAULT_DISK_DIR = "/tmp/search_cache"
+
+
+def normalize_query(query):
+    """
+    表記揺れ（全角・半角、大文字・小文字、連続する空白）を吸収した検索クエリ
+    """
+    query = unicodedata.normalize("NFKC", query or "").lower()
+    return " ".join(query.split())
+
+
+class SearchCache:
+    """
+    Tavily 検索結果のキャッシュ（メモリ LRU + 任意の /tmp ディスク層）
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=3600, disk_dir=None, max_disk_entries=1000):
+        self.memory = TTLCache(max_entries=max_entries, ttl_seconds=ttl_seconds)
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.disk_hits = 0
+        self.disk_evictions = 0
+        self._disk_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query, max_results, options=None):
+        """
+        正規化したクエリ・件数・検索オプションからキャッシュキーを生成
+        """
+        material = json.dumps(
+            {"q": normalize_query(query), "n": max_results, "o": options or {}},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+
+        entry = self._read_disk(key)
+        if entry is None:
+            return None
+
+        # ディスク層でヒットした場合はメモリ層に戻す（残り有効期限を引き継ぐ）
+        self.disk_hits += 1
+        self.memory.set(key, entry["value"], expires_at=entry["expires_at"])
+        return entry["value"]
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl_seconds
+        self.memory.set(key, value, expires_at=expires_at)
+        self._write_disk(key, value, expires_at)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats["disk_hits"] = self.disk_hits
+        stats["disk_evictions"] = self.disk_evictions
+        stats["disk_enabled"] = bool(self.disk_dir)
+        return stats
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to read search cache entry: %s", e)
+            return None
+
+        if entry.get("expires_at", 0) <= time.time():
+            self._remove_disk(key)
+            return None
+        return entry
+
+    def _write_disk(self, key, value, expires_at):
+        if not self.disk_dir:
+            return
+        try:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"expires_at": expires_at, "value": value}, f, ensure_ascii=False)
+            os.replace(tmp_path, self._disk_path(key))
+            self._prune_disk()
+        except OSError as e:
+            logger.warning("Failed to write search cache entry: %s", e)
+
+    def _remove_disk(self, key):
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _prune_disk(self):
+        """
+        ディスク層の件数が上限を超えたら古いファイルから削除
+        """
+        with self._disk_lock:
+            entries = [
+                os.path.join(self.disk_dir, name)
+                for name in os.listdir(self.disk_dir)
+                if name.endswith(".json")
+            ]
+            if len(entries) <= self.max_disk_entries:
+                return
+
+            entries.sort(key=lambda path: os.stat(path).st_mtime)
+            for path in entries[: len(entries) - self.max_disk_entries]:
+                try:
+                    os.remove(path)
+                    self.disk_evictions += 1
+                except OSError:
+                    pass
+
+
+def create_search_cache():
+    """
+    環境変数の設定に従って SearchCache を生成
+    """
+    disk_enabled = os.environ.get("SEARCH_CACHE_DISK_ENABLED", "true").lower() == "true"
+    return SearchCache(
+        max_entries=int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "256")),
+        ttl_seconds=int(os.environ.get("SEARCH_CACHE_TTL_SECONDS", "3600")),
+        disk_dir=os.environ.get("SEARCH_CACHE_DIR", DEFAULT_DISK_DIR) if disk_enabled else None,
+        max_disk_entries=int(os.environ.get("SEARCH_CACHE_MAX_DISK_ENTRIES", "1000")),
+    )
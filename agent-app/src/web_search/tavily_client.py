@@ -2,6 +2,10 @@ import os
 import requests
 import logging
 
+from common.http_session import PoolConfig, get_session, retry_count
+from common import metrics, tracing
+from common.log import lazy, log_event, verbose
+
 # ログ設定
 logger = logging.getLogger(__name__)
 
@@ -21,55 +25,76 @@ class TavilyClient:
             logger.error("TAVILY_API_KEY environment variable not found")
             raise ValueError('TAVILY_API_KEY environment variable is required')
 
-        logger.info(f"API Key configured (length: {len(self.api_key)} chars)")
-        self.base_url = 'https://api.tavily.com'
-        logger.info(f"Base URL: {self.base_url}")
+        logger.info("API Key configured (length: %s chars)", len(self.api_key))
+        self.base_url = os.environ.get('TAVILY_API_URL', 'https://api.tavily.com').rstrip('/')
+        logger.info("Base URL: %s", self.base_url)
+
+        # ウォームコンテナ内で共有されるキープアライブ接続（検索は冪等なため POST もリトライ対象）
+        self.session = get_session(
+            'tavily',
+            PoolConfig.from_env('TAVILY_HTTP', read_timeout=30, retry_methods=('GET', 'POST'))
+        )
+
+    # 検索オプションの既定値（呼び出し側で上書き可能）
+    DEFAULT_OPTIONS = {
+        'search_depth': 'basic',  # 'basic' or 'advanced'
+        'include_answer': True,
+        'include_raw_content': False,
+        'include_domains': [],
+        'exclude_domains': [],
+        'include_images': True,
+        'include_image_descriptions': True
+    }
+
+    @classmethod
+    def resolve_options(cls, options=None):
+        """
+        既定値に呼び出し側のオプションを重ねた検索オプション（未知のキーは無視）
+        """
+        resolved = dict(cls.DEFAULT_OPTIONS)
+        for key, value in (options or {}).items():
+            if key in resolved and value is not None:
+                resolved[key] = value
+        return resolved
 
-    def search(self, query, max_results=5):
+    def search(self, query, max_results=5, **options):
         """
         Web検索を実行
         """
-        logger.info(f"Starting search - Query: '{query}', Max results: {max_results}")
-
         try:
             url = f"{self.base_url}/search"
-            logger.debug(f"API URL: {url}")
 
+            search_options = self.resolve_options(options)
             payload = {
                 'api_key': self.api_key,
                 'query': query,
-                'search_depth': 'basic',  # 'basic' or 'advanced'
-                'include_answer': True,
-                'include_raw_content': False,
                 'max_results': max_results,
-                'include_domains': [],
-                'exclude_domains': [],
-                'include_images': True,
-                'include_image_descriptions': True
+                **search_options
             }
 
-            logger.debug(f"Search payload (excluding API key): {{'query': '{query}', 'max_results': {max_results}, 'search_depth': 'basic', 'include_images': True}}")
+            verbose(
+                logger, "Search request: %s (query: '%s', max_results: %s, search_depth: %s, include_images: %s)",
+                url, query, max_results, search_options['search_depth'], search_options['include_images']
+            )
 
             headers = {
                 'Content-Type': 'application/json'
             }
 
-            logger.info("Sending request to Tavily API")
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            logger.info(f"Tavily API response status: {response.status_code}")
-
+            with metrics.timer('tavily_search'), tracing.span('tavily search', max_results=max_results) as http_span:
+                response = self.session.post(url, json=payload, headers=tracing.inject_headers(headers))
+                http_span.set_attribute('http.status_code', response.status_code)
+            metrics.increment('tavily_retries', retry_count(response))
+            metrics.record_size('tavily_response_bytes', response.content)
             response.raise_for_status()
 
             data = response.json()
-            logger.info(f"Received {len(data.get('results', []))} search results")
-            logger.info(f"Received {len(data.get('images', []))} images")
-            logger.debug(f"Response time: {data.get('response_time', 'N/A')}s")
 
             # レスポンスを整形
             formatted_results = []
 
             if 'results' in data:
-                for i, result in enumerate(data['results']):
+                for result in data['results']:
                     formatted_result = {
                         'title': result.get('title', ''),
                         'url': result.get('url', ''),
@@ -77,7 +102,6 @@ class TavilyClient:
                         'score': result.get('score', 0)
                     }
                     formatted_results.append(formatted_result)
-                    logger.debug(f"Result {i+1}: {result.get('title', 'No title')} (Score: {result.get('score', 0)})")
 
             search_response = {
                 'results': formatted_results,
@@ -87,17 +111,24 @@ class TavilyClient:
                 'response_time': data.get('response_time', 0)
             }
 
-            logger.info(f"Search completed successfully - Formatted {len(formatted_results)} results")
-            if data.get('answer'):
-                logger.info(f"AI-generated answer length: {len(data.get('answer', ''))} chars")
-            if data.get('images'):
-                logger.info(f"Images included: {len(data.get('images', []))} images")
+            # 件数などはフィールドとして1行にまとめ、結果ごとの詳細は詳細ログでのみ出力する
+            log_event(
+                logger, logging.INFO, "Tavily search completed",
+                status=response.status_code,
+                result_count=len(formatted_results),
+                image_count=len(search_response['images']),
+                answer_chars=len(search_response['answer'] or ''),
+                response_time=search_response['response_time']
+            )
+            verbose(logger, "Search results: %s", lazy(lambda: [
+                (result['title'], result['score']) for result in formatted_results
+            ]))
 
             return search_response
 
         except requests.exceptions.RequestException as e:
-            logger.error(f"Request error: {str(e)}", exc_info=True)
+            logger.error("Request error: %s", e, exc_info=True)
             raise e
         except Exception as e:
-            logger.error(f"Tavily search error: {str(e)}", exc_info=True)
+            logger.error("Tavily search error: %s", e, exc_info=True)
             raise e
\ No newline at end of file
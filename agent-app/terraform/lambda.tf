@@ -13,12 +13,61 @@ resource "aws_lambda_function" "main_agent" {
     variables = {
       SF_API_FUNCTION_NAME     = aws_lambda_function.sf_api.function_name
       WEB_SEARCH_FUNCTION_NAME = aws_lambda_function.web_search.function_name
+      JOB_STORE                = "dynamodb"
+      JOB_TABLE_NAME           = aws_dynamodb_table.support_jobs.name
     }
   }
 
   depends_on = [aws_iam_role_policy_attachment.lambda_basic_execution]
 }
 
+# 非同期ジョブの自己呼び出しは失敗時もジョブに記録するため、自動リトライしない
+resource "aws_lambda_function_event_invoke_config" "main_agent_jobs" {
+  function_name          = aws_lambda_function.main_agent.function_name
+  maximum_retry_attempts = 0
+}
+
+# ストリーミング用 Main Agent（Lambda Web Adapter の背後で stream_server を起動し、NDJSON を逐次返す）
+locals {
+  lambda_web_adapter_layer_arn = coalesce(
+    var.lambda_web_adapter_layer_arn,
+    "arn:aws:lambda:${var.aws_region}:753240598075:layer:LambdaAdapterLayerX86:24"
+  )
+}
+
+resource "aws_lambda_function" "main_agent_stream" {
+  count            = var.streaming_enabled ? 1 : 0
+  filename         = "main_agent.zip"
+  function_name    = "${var.project_name}-main-agent-stream"
+  role             = aws_iam_role.lambda_execution_role.arn
+  handler          = "run.sh"
+  runtime          = "python3.11"
+  timeout          = 60
+  memory_size      = 512
+  source_code_hash = filebase64sha256("main_agent.zip")
+  layers           = [local.lambda_web_adapter_layer_arn]
+
+  environment {
+    variables = {
+      SF_API_FUNCTION_NAME         = aws_lambda_function.sf_api.function_name
+      WEB_SEARCH_FUNCTION_NAME     = aws_lambda_function.web_search.function_name
+      AWS_LAMBDA_EXEC_WRAPPER      = "/opt/bootstrap"
+      AWS_LWA_INVOKE_MODE          = "response_stream"
+      AWS_LWA_READINESS_CHECK_PATH = "/health"
+      PORT                         = "8080"
+    }
+  }
+
+  depends_on = [aws_iam_role_policy_attachment.lambda_basic_execution]
+}
+
+resource "aws_lambda_function_url" "main_agent_stream" {
+  count              = var.streaming_enabled ? 1 : 0
+  function_name      = aws_lambda_function.main_agent_stream[0].function_name
+  authorization_type = var.stream_function_url_auth_type
+  invoke_mode        = "RESPONSE_STREAM"
+}
+
 # Salesforce API Lambda
 resource "aws_lambda_function" "sf_api" {
   filename         = "sf_api.zip"
@@ -32,9 +81,11 @@ resource "aws_lambda_function" "sf_api" {
 
   environment {
     variables = {
-      SALESFORCE_INSTANCE_URL  = var.salesforce_instance_url
-      SALESFORCE_CLIENT_ID     = var.salesforce_client_id
-      SALESFORCE_CLIENT_SECRET = var.salesforce_client_secret
+      SALESFORCE_INSTANCE_URL    = var.salesforce_instance_url
+      SALESFORCE_CLIENT_ID       = var.salesforce_client_id
+      SALESFORCE_CLIENT_SECRET   = var.salesforce_client_secret
+      SIMILAR_CASE_INDEX_ENABLED = tostring(var.similar_case_index_enabled)
+      SIMILAR_CASE_INDEX_BUCKET  = var.similar_case_index_enabled ? aws_s3_bucket.similar_case_index[0].bucket : ""
     }
   }
 
@@ -60,3 +111,29 @@ resource "aws_lambda_function" "web_search" {
 
   depends_on = [aws_iam_role_policy_attachment.lambda_basic_execution]
 }
+
+# 類似ケースインデックスの同期（リクエストの処理中には同期しない）
+resource "aws_cloudwatch_event_rule" "similar_case_index_sync" {
+  count               = var.similar_case_index_enabled ? 1 : 0
+  name                = "${var.project_name}-similar-case-index-sync"
+  schedule_expression = var.similar_case_index_schedule
+}
+
+resource "aws_cloudwatch_event_target" "similar_case_index_sync" {
+  count = var.similar_case_index_enabled ? 1 : 0
+  rule  = aws_cloudwatch_event_rule.similar_case_index_sync[0].name
+  arn   = aws_lambda_function.sf_api.arn
+  input = jsonencode({
+    action      = "sync_case_index"
+    max_batches = 5
+  })
+}
+
+resource "aws_lambda_permission" "similar_case_index_sync" {
+  count         = var.similar_case_index_enabled ? 1 : 0
+  statement_id  = "AllowSimilarCaseIndexSync"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.sf_api.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.similar_case_index_sync[0].arn
+}
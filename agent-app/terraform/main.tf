@@ -65,3 +65,82 @@ resource "aws_iam_role_policy" "lambda_invoke_policy" {
     ]
   })
 }
+
+# 非同期ジョブ（submit / poll）の状態保存用テーブル
+resource "aws_dynamodb_table" "support_jobs" {
+  name         = "${var.project_name}-support-jobs"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "job_id"
+
+  attribute {
+    name = "job_id"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled        = true
+  }
+}
+
+resource "aws_iam_role_policy" "support_jobs_policy" {
+  name = "${var.project_name}-support-jobs-policy"
+  role = aws_iam_role.lambda_execution_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "dynamodb:GetItem",
+          "dynamodb:PutItem",
+          "dynamodb:UpdateItem"
+        ]
+        Resource = aws_dynamodb_table.support_jobs.arn
+      }
+    ]
+  })
+}
+
+# 類似ケースインデックスの共有先（スケジュール実行の同期で書き込み、各コンテナは読み込みのみ）
+resource "aws_s3_bucket" "similar_case_index" {
+  count         = var.similar_case_index_enabled ? 1 : 0
+  bucket_prefix = "${var.project_name}-case-index-"
+  force_destroy = true
+}
+
+resource "aws_s3_bucket_public_access_block" "similar_case_index" {
+  count                   = var.similar_case_index_enabled ? 1 : 0
+  bucket                  = aws_s3_bucket.similar_case_index[0].id
+  block_public_acls       = true
+  block_public_policy     = true
+  ignore_public_acls      = true
+  restrict_public_buckets = true
+}
+
+resource "aws_iam_role_policy" "similar_case_index_policy" {
+  count = var.similar_case_index_enabled ? 1 : 0
+  name  = "${var.project_name}-similar-case-index-policy"
+  role  = aws_iam_role.lambda_execution_role.id
+
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect = "Allow"
+        Action = [
+          "s3:GetObject",
+          "s3:PutObject",
+          "s3:DeleteObject"
+        ]
+        Resource = "${aws_s3_bucket.similar_case_index[0].arn}/*"
+      },
+      {
+        Effect   = "Allow"
+        Action   = ["s3:ListBucket"]
+        Resource = aws_s3_bucket.similar_case_index[0].arn
+      }
+    ]
+  })
+}
@@ -22,3 +22,8 @@ output "api_gateway_id" {
   description = "API Gateway ID"
   value       = aws_api_gateway_rest_api.sf_support_api.id
 }
+
+output "stream_function_url" {
+  description = "Streaming (NDJSON) Function URL"
+  value       = var.streaming_enabled ? aws_lambda_function_url.main_agent_stream[0].function_url : null
+}
@@ -41,3 +41,35 @@ variable "tavily_api_key" {
   type        = string
   sensitive   = true
 }
+
+# 類似ケースインデックス（スケジュール実行で同期し、S3 経由で各コンテナが読み込む）
+variable "similar_case_index_enabled" {
+  description = "Build the similar case index on a schedule and serve similar case searches from it"
+  type        = bool
+  default     = false
+}
+
+variable "similar_case_index_schedule" {
+  description = "Schedule expression for the similar case index sync"
+  type        = string
+  default     = "rate(15 minutes)"
+}
+
+# ストリーミング（Lambda Web Adapter + Function URL の RESPONSE_STREAM）
+variable "streaming_enabled" {
+  description = "Deploy the NDJSON streaming endpoint as a Lambda Function URL"
+  type        = bool
+  default     = false
+}
+
+variable "lambda_web_adapter_layer_arn" {
+  description = "Lambda Web Adapter layer ARN (defaults to the AWS published x86_64 layer in aws_region)"
+  type        = string
+  default     = ""
+}
+
+variable "stream_function_url_auth_type" {
+  description = "Authorization type of the streaming Function URL (AWS_IAM or NONE)"
+  type        = string
+  default     = "AWS_IAM"
+}